@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+access_filter.py
+
+Benchmarks filtering user account rows against an admin's access, comparing
+the old row by row check_access() loop with Authorise.filter_access(), which
+checks each distinct (roles, countries) signature only once.
+
+Run from the repository root with MEERKAT_AUTH_SETTINGS set:
+
+    python -m benchmarks.access_filter [--sizes 10000 100000 1000000]
+"""
+from meerkat_auth.authorise import Authorise
+import argparse
+import gc
+import random
+import time
+
+COUNTRIES = ['demo', 'jordan', 'madagascar', 'somalia', 'somaliland']
+ROLES = ['registered', 'clinic', 'district', 'directorate', 'central',
+         'personal', 'shared', 'manager', 'admin']
+
+
+def synthetic_rows(size, seed=0):
+    """Generates user rows holding one to three random roles."""
+    rng = random.Random(seed)
+    rows = []
+    for i in range(size):
+        count = rng.randint(1, 3)
+        rows.append({
+            'username': 'user{}'.format(i),
+            'roles': [rng.choice(ROLES) for _ in range(count)],
+            'countries': [rng.choice(COUNTRIES) for _ in range(count)]
+        })
+    return rows
+
+
+def row_by_row(auth, rows, acc):
+    """The original get_users() filter, deleting rows as it goes."""
+    rows = list(rows)
+    for j in range(len(rows)-1, -1, -1):
+        access = (rows[j]['roles'], rows[j]['countries'], acc)
+        if not auth.check_access(*access, 'AND'):
+            del rows[j]
+    return rows
+
+
+def timed(function, *args):
+    """Times a call with garbage collection off, as timeit does."""
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        result = function(*args)
+        return time.perf_counter() - start, result
+    finally:
+        gc.enable()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[10000, 100000, 1000000]
+    )
+    args = parser.parse_args()
+
+    auth = Authorise()
+    acc = {
+        'demo': ROLES,
+        'jordan': ['directorate', 'clinic', 'registered'],
+        'somalia': ['personal', 'registered']
+    }
+    # Warm up both filters, so the first size isn't charged for it.
+    warm_up = synthetic_rows(1000, seed=1)
+    row_by_row(auth, warm_up, acc)
+    auth.filter_access(warm_up, acc, 'AND')
+
+    print('{:>10} {:>12} {:>12} {:>8}'.format(
+        'rows', 'row by row', 'batched', 'speedup'
+    ))
+    for size in args.sizes:
+        rows = synthetic_rows(size)
+        old_time, old = timed(row_by_row, auth, rows, acc)
+        new_time, new = timed(auth.filter_access, rows, acc, 'AND')
+        assert old == new, 'Filters disagree.'
+        print('{:>10} {:>11.3f}s {:>11.3f}s {:>7.1f}x'.format(
+            size, old_time, new_time, old_time / new_time
+        ))
+
+
+if __name__ == '__main__':
+    main()
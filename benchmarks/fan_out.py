@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+fan_out.py
+
+Benchmarks the request paths that make many independent database reads,
+with the reads made one after another (a single fan-out thread) and at the
+same time (see meerkat_auth.db.gather()). The database is the in-memory
+backend, with a fixed latency added to every request to stand in for the
+round trip to DynamoDB.
+
+Run from the repository root with MEERKAT_AUTH_SETTINGS set:
+
+    python -m benchmarks.fan_out [--latency 0.01] [--workers 1 4 16]
+"""
+from meerkat_auth.role import Role
+from meerkat_auth.role_graph import RoleGraph
+from meerkat_auth.role_index import RoleIndex
+from meerkat_auth.user import User
+from meerkat_auth import app, db
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import time
+
+COUNTRIES = ['demo', 'jordan', 'madagascar', 'somalia', 'somaliland', 'car']
+# A chain of roles, each inheriting from the role before.
+CHAIN = ['registered', 'clinic', 'district', 'directorate', 'central']
+USERS = 500
+
+
+def populate():
+    """Writes the roles and users to the in-memory database."""
+    roles = []
+    for country in COUNTRIES:
+        roles += [Role(country, CHAIN[0], '', [])]
+        roles += [
+            Role(country, role, '', [parent])
+            for parent, role in zip(CHAIN, CHAIN[1:])
+        ]
+        roles += [Role(country, 'personal', '', [])]
+        roles += [Role(country, 'admin', '', CHAIN[-1:] + ['personal'])]
+    Role.batch_write(roles)
+
+    graph = RoleGraph.from_db(COUNTRIES)
+    users = []
+    for i in range(USERS):
+        role = CHAIN[i % len(CHAIN)]
+        users.append({
+            'username': 'user{}'.format(i),
+            'email': 'user{}@test.org.uk'.format(i),
+            'countries': COUNTRIES,
+            'roles': [role] * len(COUNTRIES),
+            'state': 'live',
+            'access': User.compute_access(
+                COUNTRIES, [role] * len(COUNTRIES), graph
+            )
+        })
+    User.batch_put(users)
+
+
+def load_roles():
+    """The roles of many countries, as loaded into a RoleGraph."""
+    return len(Role.get_all(COUNTRIES))
+
+
+def batch_users():
+    """Many users at once, as by /api/get_users."""
+    usernames = ['user{}'.format(i) for i in range(USERS)]
+    return len(User.batch_get(usernames))
+
+
+def user_roles():
+    """A user's access across countries, computed role by role."""
+    user = User(
+        'user4', 'user4@test.org.uk', None,
+        COUNTRIES, ['admin'] * len(COUNTRIES)
+    )
+    return sum(len(roles) for roles in user.get_access().values())
+
+
+def ancestors():
+    """A role's complete access, loading each ancestor in turn."""
+    return len(Role.from_db('demo', 'admin').all_access())
+
+
+def holders():
+    """Every holder of a role and of the roles inheriting from it."""
+    return len(RoleIndex.holders('demo', 'registered', RoleGraph.cached()))
+
+
+def asyncio_roles():
+    """Each of a user's roles awaited by asyncio code, on a thread pool."""
+    async def main(executor):
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(*[
+            loop.run_in_executor(executor, Role.from_db, country, 'admin')
+            for country in COUNTRIES
+        ])
+    with ThreadPoolExecutor(app.config['DB_FANOUT_WORKERS']) as executor:
+        return len(asyncio.run(main(executor)))
+
+
+SCENARIOS = [
+    load_roles, batch_users, user_roles, ancestors, holders, asyncio_roles
+]
+
+
+def timed(function, repeat):
+    """The best of `repeat` timed calls, with the result of the last."""
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument(
+        '--latency', type=float, default=0.01,
+        help='Seconds added to every database request.'
+    )
+    parser.add_argument(
+        '--workers', type=int, nargs='+', default=[1, 4, 16],
+        help='Fan-out pool sizes to compare. 1 makes the reads in turn.'
+    )
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    app.config.from_object('meerkat_auth.config.Testing')
+    app.config.update(DB_BACKEND='memory', ACCESS_REFRESH_ASYNC=False)
+    populate()
+    db.resource().latency = args.latency
+    # Cache the graph, so holders() only times the index queries.
+    RoleGraph.cached()
+
+    print('{:>14}'.format('workers') + ''.join(
+        '{:>10}'.format(w) for w in args.workers
+    ) + '{:>9}'.format('speedup'))
+    for scenario in SCENARIOS:
+        times = []
+        results = set()
+        for workers in args.workers:
+            app.config['DB_FANOUT_WORKERS'] = workers
+            elapsed, result = timed(scenario, args.repeat)
+            times.append(elapsed)
+            results.add(result)
+        assert len(results) == 1, 'Results differ between pool sizes.'
+        print('{:>14}'.format(scenario.__name__) + ''.join(
+            '{:>9.3f}s'.format(t) for t in times
+        ) + '{:>8.1f}x'.format(times[0] / times[-1]))
+
+
+if __name__ == '__main__':
+    main()
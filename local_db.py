@@ -26,6 +26,7 @@ import meerkat_auth
 import argparse
 from meerkat_auth.role import Role
 from meerkat_auth.user import User
+from meerkat_auth import role_io
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
@@ -67,6 +68,9 @@ if args.clear:
         print(response)
         response = db.Table(meerkat_auth.app.config['ROLES']).delete()
         print(response)
+        for table in ['REVOCATIONS', 'REFRESH_TOKENS', 'ROLE_INDEX']:
+            response = db.Table(meerkat_auth.app.config[table]).delete()
+            print(response)
         print('Cleaned the db.')
     except Exception as e:
         print(e)
@@ -110,6 +114,48 @@ if args.setup:
 
     print(response)
 
+    response = db.create_table(
+        TableName=meerkat_auth.app.config['REFRESH_TOKENS'],
+        AttributeDefinitions=[
+            {'AttributeName': 'id', 'AttributeType': 'S'}
+        ],
+        KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+        ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}
+    )
+
+    print(response)
+
+    # Revocations are partitioned by time, so nodes query just the newest.
+    response = db.create_table(
+        TableName=meerkat_auth.app.config['REVOCATIONS'],
+        AttributeDefinitions=[
+            {'AttributeName': 'bucket', 'AttributeType': 'S'},
+            {'AttributeName': 'id', 'AttributeType': 'S'}
+        ],
+        KeySchema=[
+            {'AttributeName': 'bucket', 'KeyType': 'HASH'},
+            {'AttributeName': 'id', 'KeyType': 'RANGE'}
+        ],
+        ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}
+    )
+
+    print(response)
+
+    response = db.create_table(
+        TableName=meerkat_auth.app.config['ROLE_INDEX'],
+        AttributeDefinitions=[
+            {'AttributeName': 'role_key', 'AttributeType': 'S'},
+            {'AttributeName': 'username', 'AttributeType': 'S'}
+        ],
+        KeySchema=[
+            {'AttributeName': 'role_key', 'KeyType': 'HASH'},
+            {'AttributeName': 'username', 'KeyType': 'RANGE'}
+        ],
+        ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}
+    )
+
+    print(response)
+
 if args.populate:
     # Create the client for the local database
     db = boto3.client(
@@ -224,8 +270,11 @@ if args.populate:
         Role('meerkat', 'root', ' ', ['admin'])
     ]
 
-    for role in roles:
-        print(role.to_db())
+    # Validate the whole network at once and write it parents first.
+    result = role_io.import_roles(roles)
+    print(result['diff'])
+    if result['errors']:
+        print('\n'.join(result['errors']))
 
     # Create registered, manager and root user objects for each country.
     users = []
@@ -0,0 +1,222 @@
+#!/usr/local/bin/python3
+"""
+This is a utility script for administering the Meerkat Auth database from the
+command line, e.g. inside the docker container. It works directly against the
+database specified by the app config, so no account or token is needed.
+
+Run:
+    `manage.py export-users` (To stream every account to stdout as NDJSON)
+    `manage.py export-users --format csv --country jordan -o users.csv`
+    `manage.py import-users users.csv --dry-run` (To check an import)
+    `manage.py import-users users.csv` (To create the accounts in a file)
+    `manage.py export-roles --country jordan -o jordan.json`
+    `manage.py import-roles jordan.json --replace --dry-run`
+    `manage.py rebuild-role-index` (To fill or repair the role index)
+    `manage.py audit-access --repair` (To fix users' stored access)
+"""
+from meerkat_auth.user import User
+from meerkat_auth.role_index import RoleIndex
+from meerkat_auth import export, importer, role_io
+import argparse
+import json
+import sys
+
+
+def export_users(args):
+    """Streams the accounts, a page at a time, to the output file."""
+    pages = User.get_pages(
+        args.country,
+        list(export.EXPORT_ATTRIBUTES),
+        role=args.role
+    )
+    output = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        for chunk in export.serialise(pages, args.format):
+            output.write(chunk)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+def import_users(args):
+    """Creates the accounts in the input file, reporting progress."""
+    format = args.format or ('csv' if args.input.endswith('.csv') else 'json')
+    with open(args.input, newline='') as f:
+        rows = importer.parse(f.read(), format)
+
+    def progress(stage, done, total):
+        print('{} {}/{}'.format(stage.capitalize(), done, total),
+              file=sys.stderr)
+
+    result = importer.import_users(
+        rows, dry_run=args.dry_run, workers=args.workers, progress=progress
+    )
+    for error in result['errors']:
+        print('Row {row} ({username}): {error}'.format(**error),
+              file=sys.stderr)
+    print(json.dumps({
+        'total': result['total'],
+        'created': len(result['created']),
+        'errors': len(result['errors']),
+        'dry_run': args.dry_run
+    }))
+    if result['errors']:
+        sys.exit(1)
+
+
+def role_format(args, path):
+    """The role file format given, or else implied by the file extension."""
+    if args.format:
+        return args.format
+    return 'yaml' if path and path.endswith(('.yaml', '.yml')) else 'json'
+
+
+def export_roles(args):
+    """Writes the role networks to the output file."""
+    format = role_format(args, args.output)
+    text = role_io.dump(role_io.export_roles(args.country), format)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+def import_roles(args):
+    """Validates and writes the roles in the input file."""
+    format = role_format(args, args.input)
+    with open(args.input) as f:
+        roles = role_io.load(f.read(), format)
+    result = role_io.import_roles(
+        roles, replace=args.replace, dry_run=args.dry_run
+    )
+    for error in result['errors']:
+        print(error, file=sys.stderr)
+    for change in ['added', 'changed', 'removed']:
+        for country, role in result['diff'][change]:
+            print('{:8} {}/{}'.format(change, country, role))
+    for country, role in result['failed']:
+        print('Failed to write {}/{}'.format(country, role), file=sys.stderr)
+    if result['errors'] or result['failed']:
+        sys.exit(1)
+
+
+def rebuild_role_index(args):
+    """Rewrites the reverse role index from the users table."""
+    users = User.get_pages([], ['countries', 'roles'])
+    count = RoleIndex.rebuild(user for page in users for user in page)
+    print('Indexed {} roles held.'.format(count))
+
+
+def audit_access(args):
+    """Lists, and optionally repairs, users whose stored access has drifted."""
+    drifted = User.audit_access(repair=args.repair)
+    for user in drifted:
+        print('{problem:8} {username}'.format(**user))
+    print('{} users with drifted access{}.'.format(
+        len(drifted), ' repaired' if args.repair else ''
+    ), file=sys.stderr)
+    if drifted and not args.repair:
+        sys.exit(1)
+
+
+parser = argparse.ArgumentParser(
+    description='Administer the Meerkat Auth database.'
+)
+subparsers = parser.add_subparsers(dest='command')
+subparsers.required = True
+
+export_parser = subparsers.add_parser(
+    'export-users',
+    help='Export user accounts as newline delimited JSON or CSV.'
+)
+export_parser.add_argument(
+    '--format', choices=list(export.FORMATS), default='ndjson',
+    help='The export format.'
+)
+export_parser.add_argument(
+    '--country', action='append', default=[],
+    help='Only export accounts with access to this country. Repeatable.'
+)
+export_parser.add_argument(
+    '--role', help='Only export accounts holding this role.'
+)
+export_parser.add_argument(
+    '-o', '--output', help='The file to write to. Defaults to stdout.'
+)
+export_parser.set_defaults(function=export_users)
+
+import_parser = subparsers.add_parser(
+    'import-users',
+    help='Create user accounts from a CSV or JSON file.'
+)
+import_parser.add_argument('input', help='The CSV or JSON file to import.')
+import_parser.add_argument(
+    '--format', choices=importer.FORMATS,
+    help='The import format. Defaults to csv for .csv files, else json.'
+)
+import_parser.add_argument(
+    '--dry-run', action='store_true',
+    help='Validate the accounts without creating them.'
+)
+import_parser.add_argument(
+    '--workers', type=int,
+    help='Processes to hash passwords with. Defaults to the number of CPUs.'
+)
+import_parser.set_defaults(function=import_users)
+
+export_roles_parser = subparsers.add_parser(
+    'export-roles',
+    help='Export the role networks as JSON or YAML.'
+)
+export_roles_parser.add_argument(
+    '--format', choices=list(role_io.FORMATS),
+    help='The export format. Defaults to yaml for .yaml files, else json.'
+)
+export_roles_parser.add_argument(
+    '--country', action='append', default=[],
+    help='Only export this country. Repeatable.'
+)
+export_roles_parser.add_argument(
+    '-o', '--output', help='The file to write to. Defaults to stdout.'
+)
+export_roles_parser.set_defaults(function=export_roles)
+
+import_roles_parser = subparsers.add_parser(
+    'import-roles',
+    help='Create and update roles from a JSON or YAML file.'
+)
+import_roles_parser.add_argument('input', help='The file to import.')
+import_roles_parser.add_argument(
+    '--format', choices=list(role_io.FORMATS),
+    help='The import format. Defaults to yaml for .yaml files, else json.'
+)
+import_roles_parser.add_argument(
+    '--replace', action='store_true',
+    help='Delete roles in the imported countries that are not in the file.'
+)
+import_roles_parser.add_argument(
+    '--dry-run', action='store_true',
+    help='Validate and list the changes without writing them.'
+)
+import_roles_parser.set_defaults(function=import_roles)
+
+rebuild_parser = subparsers.add_parser(
+    'rebuild-role-index',
+    help='Rewrite the index of which users hold each role.'
+)
+rebuild_parser.set_defaults(function=rebuild_role_index)
+
+audit_parser = subparsers.add_parser(
+    'audit-access',
+    help="Check each user's stored access against the role graph."
+)
+audit_parser.add_argument(
+    '--repair', action='store_true',
+    help='Rewrite the stored access of any users that have drifted.'
+)
+audit_parser.set_defaults(function=audit_access)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    args.function(args)
@@ -1,4 +1,7 @@
 from meerkat_auth.user import User
+from meerkat_auth.role_graph import RoleGraph
+from meerkat_auth.cache import TTLCache
+from meerkat_auth.revocation import revocations, RevokedTokenError
 from meerkat_auth import app
 from meerkat_libs.auth_client import Authorise as libs_auth
 import jwt
@@ -9,6 +12,11 @@ class Authorise(libs_auth):
     Extension of the meerkat_libs auth_client Authorise class. We override one
     of its functions so that it works smoothly in meerkat_auth.
     """
+
+    # Cache of access decisions. Each key includes everything a decision
+    # depends upon, so cached decisions can't go stale, only be evicted.
+    DECISIONS = TTLCache(ttl=3600, maxsize=app.config['DECISION_CACHE_SIZE'])
+
     # Override the get user method
     # Since we have direct access to the user model here.
     def get_user(self, token):
@@ -26,17 +34,115 @@ class Authorise(libs_auth):
         """
 
         # Decode the jwt.
+        payload = self.decode_token(token)
+
+        # Get the user details directly from the db, or the last details read
+        # if the db is failing. The cached role graph is only needed for users
+        # without stored access, and saves walking their roles.
+        item = User.get_public_item(payload['usr'])
+        graph = None if item.get('access') is not None else RoleGraph.cached()
+        user = User.from_item(item, graph).get_payload(payload['exp'])
+
+        # Return the combined information
+        return {**user, **payload}
+
+    def filter_access(self, rows, acc, logic='AND'):
+        """
+        Returns the user account rows whose access is within the given access,
+        i.e. the rows for which check_access(row['roles'], row['countries'],
+        acc, logic) is true. Many accounts share the same roles and countries,
+        so rows are grouped by their (roles, countries) signature and each
+        distinct signature is only checked once.
+
+        Args:
+            rows ([dict]): User account dictionaries, each with 'roles' and \
+                'countries' properties.
+            acc (dict): The access to compare against, as in check_access().
+            logic (str): 'AND' if all of a row's roles are required, 'OR' if \
+                any one is.
+
+        Returns:
+            ([dict]) The rows that are within the access, in the same order.
+        """
+        decisions = {}
+        filtered = []
+        for row in rows:
+            signature = (tuple(row['roles']), tuple(row['countries']))
+            allowed = decisions.get(signature)
+            if allowed is None:
+                allowed = bool(
+                    self.check_access(row['roles'], row['countries'], acc, logic)
+                )
+                decisions[signature] = allowed
+            if allowed:
+                filtered.append(row)
+        return filtered
+
+    def decode_token(self, token):
+        """
+        Verifies and decodes a token signed by Meerkat Auth, checking that it
+        hasn't been revoked. The revocation check is made against the
+        in-memory revocation list, so it doesn't need a database read.
+
+        Args:
+            token (str): The JWT to decode.
+
+        Returns:
+            (dict) The token's payload.
+
+        Raises:
+            jwt.InvalidTokenError (or a subclass) if the token is invalid,
+                including RevokedTokenError if the token has been revoked.
+        """
         payload = jwt.decode(
             token,
             app.config['JWT_PUBLIC_KEY'],
             algorithms=[app.config['JWT_ALGORITHM']]
         )
+        if revocations.is_revoked(payload):
+            raise RevokedTokenError('Token has been revoked.')
+        return payload
 
-        # Get the user details directly from the db.
-        user = User.from_db(payload['usr']).get_payload(payload['exp'])
+    def decide(self, username, access, countries, logic='OR'):
+        """
+        Decides whether the specified user has the required access, in the
+        same way as check_access(), but without needing the user's complete
+        access dictionary. Decisions are cached by the user's roles and
+        countries, the role graph version and the access requirements, so a
+        repeated decision needs neither database reads nor graph walks. Users
+        whose accounts are inactive (see User.INACTIVE_STATES) are denied.
 
-        # Return the combined information
-        return {**user, **payload}
+        Args:
+            username (str): The user to check the access of.
+            access ([str]): The required access roles.
+            countries ([str]): The country for each role in access.
+            logic (str): 'OR' if any one role is required, 'AND' if all are.
+
+        Returns:
+            bool True if the user has the required access, False if not.
+
+        Raises:
+            InvalidCredentialException if the user doesn't exist.
+            InvalidRoleException if the user's roles are broken.
+        """
+        item = User.get_access_item(username)
+        if item.get('state') in User.INACTIVE_STATES:
+            return False
+        graph = RoleGraph.cached()
+        key = (
+            tuple(item['countries']),
+            tuple(item['roles']),
+            graph.version,
+            tuple(access),
+            tuple(countries),
+            logic
+        )
+
+        def decision():
+            acc = graph.get_access(item['countries'], item['roles'])
+            return self.check_access(access, countries, acc, logic)
+
+        return self.DECISIONS.get_or_load(key, decision)
 
 # Create an instance of the class to import into the rest of the package.
 auth = Authorise()
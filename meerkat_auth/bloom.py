@@ -0,0 +1,151 @@
+"""
+bloom.py
+
+Approximate set membership for Meerkat Auth. A Bloom filter answers "is this
+item in the set?" with either "definitely not" or "probably", using a small,
+fixed number of bits per item. It lets us answer most lookups for items that
+don't exist without reading the database, and only read the database to
+confirm the probable hits.
+"""
+import threading
+import hashlib
+import logging
+import math
+import time
+
+
+class BloomFilter:
+    """
+    A fixed size Bloom filter of strings. Items can be added but not removed.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        """
+        Create a BloomFilter object.
+
+        Args:
+            capacity (int) The number of items the filter is sized for.
+            error_rate (float) The false positive rate once the filter holds
+                capacity items.
+        """
+        capacity = max(1, int(capacity))
+        self.size = max(8, int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2
+        )))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _positions(self, item):
+        """The bit positions for an item, by double hashing one digest."""
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        """Adds an item to the filter."""
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+
+class ApproximateSet:
+    """
+    A Bloom filter of a set of items held in the database, that is rebuilt in
+    a background thread from the database every so often. Items removed from
+    the database stay in the filter until the next rebuild, which is fine as
+    probable hits are always confirmed against the database. Items written by
+    this process are added as they are written. Items written by other
+    processes are only picked up by the next rebuild, so a "definitely not"
+    answer may be stale by up to the rebuild interval.
+    """
+
+    def __init__(self, loader, ttl=300, error_rate=0.01, min_capacity=1024):
+        """
+        Create an ApproximateSet object.
+
+        Args:
+            loader (function) Returns an iterable of every item in the set.
+            ttl (float) Seconds between rebuilds of the filter.
+            error_rate (float) The false positive rate of the filter.
+            min_capacity (int) The smallest filter to build. Filters are sized
+                for twice the number of items, leaving room for additions.
+        """
+        self.loader = loader
+        self.ttl = ttl
+        self.error_rate = error_rate
+        self.min_capacity = min_capacity
+        self.filter = None
+        self.built = None  # Time of the last successful rebuild.
+        self.attempted = None  # Time of the last rebuild attempt.
+        self.pending = None  # Items added while a rebuild is in progress.
+        self.lock = threading.Lock()
+        self.rebuilding = threading.Lock()
+
+    def add(self, item):
+        """Records an item written to the database by this process."""
+        with self.lock:
+            if self.filter is not None:
+                self.filter.add(item)
+            if self.pending is not None:
+                self.pending.append(item)
+
+    def rebuild(self):
+        """
+        Rebuilds the filter from the database. If another thread is already
+        rebuilding the filter this returns at once.
+        """
+        if not self.rebuilding.acquire(blocking=False):
+            return
+        try:
+            with self.lock:
+                self.pending = []
+            items = list(self.loader())
+            new_filter = BloomFilter(
+                max(self.min_capacity, 2 * len(items)), self.error_rate
+            )
+            for item in items:
+                new_filter.add(item)
+            with self.lock:
+                for item in self.pending:
+                    new_filter.add(item)
+                self.filter = new_filter
+                self.built = time.monotonic()
+            logging.info('Rebuilt filter of {} items.'.format(len(items)))
+        except Exception as e:
+            logging.warning('Failed to rebuild filter: ' + repr(e))
+        finally:
+            with self.lock:
+                self.pending = None
+            self.rebuilding.release()
+
+    def might_contain(self, item):
+        """
+        Checks whether an item might be in the set. A False answer means the
+        item definitely isn't in the set (as of the last rebuild). If the
+        filter is stale a rebuild is started in the background; until the
+        first build completes every item might be in the set.
+
+        Returns:
+            bool False if the item is not in the set, True if it might be.
+        """
+        now = time.monotonic()
+        stale = self.built is None or now - self.built > self.ttl
+        # After a failed rebuild, wait a little before trying again.
+        retry = (self.attempted is None or
+                 now - self.attempted > min(self.ttl, 30))
+        if stale and retry and not self.rebuilding.locked():
+            self.attempted = now
+            threading.Thread(target=self.rebuild, daemon=True).start()
+        current = self.filter
+        return current is None or item in current
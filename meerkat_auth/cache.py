@@ -0,0 +1,248 @@
+"""
+cache.py
+
+Small in-process caching utilities shared across Meerkat Auth. Caches are per
+worker process, so anything cached here may be a little stale compared to the
+database. Each cache's time to live bounds how stale it can be.
+
+SingleFlight doesn't cache at all: it only lets concurrent identical loads
+share one database call, so it never returns stale data.
+"""
+from collections import OrderedDict
+import threading
+import logging
+import time
+
+
+class TTLCache:
+    """
+    A thread safe, size bounded cache whose entries expire after a time to
+    live. When full, the least recently used entry is evicted.
+    """
+
+    def __init__(self, ttl=60, maxsize=1024):
+        """
+        Create a TTLCache object.
+
+        Args:
+            ttl (float) Default seconds an entry lives for.
+            maxsize (int) Maximum number of entries.
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self._items = OrderedDict()
+        self._revalidating = set()  # Keys being reloaded in the background.
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        """
+        Returns the cached value for the key, or default if the key isn't
+        cached or has expired.
+        """
+        with self.lock:
+            entry = self._items.get(key)
+            if entry is None:
+                return default
+            if entry[1] < time.monotonic():
+                del self._items[key]
+                return default
+            self._items.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        """
+        Caches the value for the key.
+
+        Args:
+            key The cache key, must be hashable.
+            value The value to cache.
+            ttl (float) Seconds to cache the value for, if not the default.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            self._items[key] = (value, time.monotonic() + ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def pop(self, key):
+        """Removes the key from the cache, if present."""
+        with self.lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        """Removes everything from the cache."""
+        with self.lock:
+            self._items.clear()
+
+    def get_or_load(self, key, loader, ttl=None):
+        """
+        Returns the cached value for the key, calling loader() to create and
+        cache the value if it isn't already cached.
+        """
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = loader()
+            self.set(key, value, ttl)
+        return value
+
+    def get_or_revalidate(self, key, loader, ttl=None, stale=0,
+                          transient=None):
+        """
+        Like get_or_load(), but stale-while-revalidate: for `stale` seconds
+        after an entry expires, the expired value is still returned at once,
+        while loader() reloads it in a background thread. So a slow or
+        failing loader only delays the first load of a key, or a load long
+        after the value was last used.
+
+        Args:
+            key The cache key, must be hashable.
+            loader (function) Creates the value.
+            ttl (float) Seconds the value is fresh for, if not the default.
+            stale (float) Seconds after expiry that the value may be served.
+            transient (function) Given an exception raised by a background
+                reload, returns whether it is temporary. The stale value is
+                kept after temporary failures, but dropped after others, so
+                the next call loads the value itself and gets the error. By
+                default all failures are temporary.
+
+        Raises:
+            Anything raised by the loader when the value isn't cached, or is
+                too stale to use.
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self._items.get(key)
+            if entry is not None:
+                self._items.move_to_end(key)
+        if entry is not None and now <= entry[1]:
+            return entry[0]
+        if entry is not None and now <= entry[1] + stale:
+            self._revalidate(key, loader, ttl, transient)
+            return entry[0]
+        value = loader()
+        self.set(key, value, ttl)
+        return value
+
+    def _revalidate(self, key, loader, ttl, transient):
+        """Reloads a key in a background thread, unless already reloading."""
+        with self.lock:
+            if key in self._revalidating:
+                return
+            self._revalidating.add(key)
+
+        def reload():
+            try:
+                self.set(key, loader(), ttl)
+            except Exception as e:
+                logging.warning(
+                    'Failed to revalidate {!r}: {!r}'.format(key, e)
+                )
+                if transient is not None and not transient(e):
+                    self.pop(key)
+            finally:
+                with self.lock:
+                    self._revalidating.discard(key)
+
+        threading.Thread(target=reload, daemon=True).start()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical loads, e.g. many threads of a worker
+    loading the same user at once. The first caller for a key runs the
+    loader, and callers arriving while it is running wait for and share its
+    result, or its exception, instead of each making the same database call.
+    Nothing is kept once the load completes.
+
+    Shared results are the same object for every caller, so callers must
+    copy any result they intend to change.
+    """
+
+    # Every SingleFlight created, indexed by name, for reporting stats.
+    ALL = {}
+
+    def __init__(self, name):
+        """
+        Create a SingleFlight object.
+
+        Args:
+            name (str) Identifies the loads in stats().
+        """
+        self.name = name
+        self.lock = threading.Lock()
+        self._flights = {}
+        self.calls = 0
+        self.loads = 0
+        SingleFlight.ALL[name] = self
+
+    def do(self, key, loader):
+        """
+        Returns loader(), sharing the call with any other callers loading
+        the same key at the same time.
+
+        Args:
+            key The load's key, must be hashable.
+            loader (function) Makes the load.
+
+        Raises:
+            Any exception raised by the loader.
+        """
+        with self.lock:
+            self.calls += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                self.loads += 1
+                flight = self._flights[key] = _Flight()
+
+        if leader:
+            try:
+                flight.result = loader()
+            except BaseException as e:
+                flight.error = e
+            finally:
+                with self.lock:
+                    del self._flights[key]
+                flight.done.set()
+        else:
+            flight.done.wait()
+
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def stats(self):
+        """
+        Returns the number of 'calls' made, the number of 'loads' actually
+        run, the number of calls 'coalesced' into another call's load, and
+        the coalescing 'ratio': the fraction of calls that were coalesced.
+        """
+        with self.lock:
+            calls, loads = self.calls, self.loads
+        return {
+            'calls': calls,
+            'loads': loads,
+            'coalesced': calls - loads,
+            'ratio': (calls - loads) / calls if calls else 0.0
+        }
+
+    @staticmethod
+    def all_stats():
+        """Returns stats() for every SingleFlight, indexed by name."""
+        return {
+            name: flight.stats() for name, flight in SingleFlight.ALL.items()
+        }
+
+
+class _Flight:
+    """A load in progress, and its result once done."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
@@ -0,0 +1,197 @@
+"""
+circuit.py
+
+Circuit breakers for the database. When DynamoDB is throttling us or timing
+out, every request that reads it waits for its own timeout and retries,
+tying up workers. A circuit breaker notices a run of such failures and then
+fails calls straight away for a while, so that requests fall back to cached
+data (see TTLCache.get_or_revalidate()) instead of hanging. After a while a
+single trial call is let through, and if it succeeds the circuit closes.
+"""
+from botocore.exceptions import ClientError, HTTPClientError
+from botocore.exceptions import ConnectionError as BotoConnectionError
+import threading
+import logging
+import time
+
+# DynamoDB error codes meaning the database is overloaded or unavailable.
+TRANSIENT_CODES = [
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'InternalServerError',
+    'ServiceUnavailable'
+]
+
+# The table and resource methods that make database calls.
+GUARDED_METHODS = [
+    'get_item', 'put_item', 'update_item', 'delete_item', 'query', 'scan',
+    'batch_get_item', 'batch_write_item'
+]
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling the database while a circuit is open.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return 'The {} database is unavailable, try again.'.format(self.name)
+
+
+def is_transient(error):
+    """
+    Whether an exception means the database is overloaded or unreachable,
+    rather than that the request itself was wrong.
+
+    Args:
+        error (Exception) The exception raised by a database call.
+
+    Returns:
+        bool True if the call may succeed if tried again later.
+    """
+    if isinstance(error, CircuitOpenError):
+        return True
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code')
+        return code in TRANSIENT_CODES
+    # Timeouts, refused connections and dropped connections.
+    return isinstance(error, (BotoConnectionError, HTTPClientError))
+
+
+class CircuitBreaker:
+    """
+    A thread safe circuit breaker. The circuit opens after `threshold`
+    transient failures in a row, and stays open for `reset_timeout` seconds.
+    Then one trial call is allowed; the circuit closes if it succeeds and
+    opens again if it fails.
+    """
+
+    def __init__(self, name, threshold=5, reset_timeout=30):
+        """
+        Create a CircuitBreaker object.
+
+        Args:
+            name (str) Names the circuit in errors and logs.
+            threshold (int) Transient failures in a row that open the circuit.
+            reset_timeout (float) Seconds to stay open before a trial call.
+        """
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened = None  # When the circuit opened, if open.
+        self.trial = False  # Whether a trial call is in progress.
+
+    @property
+    def state(self):
+        """'closed', 'open' or 'half-open'."""
+        with self.lock:
+            if self.opened is None:
+                return 'closed'
+            if time.monotonic() - self.opened < self.reset_timeout:
+                return 'open'
+            return 'half-open'
+
+    def _before(self):
+        """Decides whether a call may go ahead, raising if not."""
+        with self.lock:
+            if self.opened is None:
+                return False
+            waited = time.monotonic() - self.opened
+            if waited < self.reset_timeout or self.trial:
+                raise CircuitOpenError(self.name)
+            self.trial = True
+            return True
+
+    def _after(self, trial, error=None):
+        """Records the outcome of a call."""
+        with self.lock:
+            if trial:
+                self.trial = False
+            if error is not None and is_transient(error):
+                self.failures += 1
+                if trial or self.failures >= self.threshold:
+                    if self.opened is None or trial:
+                        logging.warning(
+                            'Opening {} circuit after: {!r}'.format(
+                                self.name, error
+                            )
+                        )
+                    self.opened = time.monotonic()
+            else:
+                if self.opened is not None:
+                    logging.warning('Closing {} circuit.'.format(self.name))
+                self.failures = 0
+                self.opened = None
+
+    def call(self, function, *args, **kwargs):
+        """
+        Calls function(*args, **kwargs) through the circuit.
+
+        Raises:
+            CircuitOpenError if the circuit is open, else anything raised by
+                the function.
+        """
+        trial = self._before()
+        try:
+            result = function(*args, **kwargs)
+        except Exception as e:
+            self._after(trial, e)
+            raise
+        self._after(trial)
+        return result
+
+
+class GuardedResource:
+    """
+    Wraps a boto3 DynamoDB resource, or one of its Tables, so that every
+    database call goes through a circuit breaker. Anything else, e.g.
+    `meta.client.exceptions`, is passed straight through.
+    """
+
+    def __init__(self, resource, breaker):
+        """
+        Create a GuardedResource object.
+
+        Args:
+            resource The boto3 DynamoDB resource or Table to wrap.
+            breaker (CircuitBreaker) The circuit to make calls through.
+        """
+        self.resource = resource
+        self.breaker = breaker
+
+    def Table(self, name):
+        """Returns the named Table, guarded by the same circuit."""
+        return GuardedResource(self.resource.Table(name), self.breaker)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.resource, name)
+        if name not in GUARDED_METHODS:
+            return attribute
+
+        def guarded(*args, **kwargs):
+            return self.breaker.call(attribute, *args, **kwargs)
+        return guarded
+
+
+def guard(resource, name, threshold=5, reset_timeout=30):
+    """
+    Wraps a boto3 DynamoDB resource in a new circuit breaker.
+
+    Args:
+        resource The boto3 DynamoDB resource.
+        name (str) Names the circuit.
+        threshold (int) Transient failures in a row that open the circuit.
+        reset_timeout (float) Seconds to stay open before a trial call.
+
+    Returns:
+        GuardedResource The guarded resource.
+    """
+    return GuardedResource(
+        resource, CircuitBreaker(name, threshold, reset_timeout)
+    )
@@ -12,6 +12,8 @@ class Config(object):
 
     # Load the secret settings config file.
     # File must define JWT_COOKIE_NAME, JWT_ALGORITHM and JWT_PUBLIC_KEY variables.
+    # It may define JWT_PREVIOUS_PUBLIC_KEYS, listing retired public keys that
+    # should still be published in the JWKS until their tokens have expired.
     filename = os.environ.get('MEERKAT_AUTH_SETTINGS')
     try:
         spec = util.spec_from_file_location('config', filename)
@@ -26,7 +28,65 @@ class Config(object):
 
     USERS = 'auth_users'
     ROLES = 'auth_roles'
+    REVOCATIONS = 'auth_revocations'
+    REFRESH_TOKENS = 'auth_refresh_tokens'
+    ROLE_INDEX = 'auth_role_index'
     TOKEN_LIFE = 3600  # Max length of a sign in session in seconds.
+    MAX_TOKEN_LIFE = 2592000  # Longest any token, incl. per user, can last.
+    JWKS_MAX_AGE = 86400  # Seconds services may cache the JWKS for.
+    # Sessions with refresh tokens (i.e. logging in with 'refresh': true).
+    REFRESH_COOKIE_NAME = 'meerkat_refresh'
+    ACCESS_TOKEN_LIFE = 900  # Seconds an access token lasts when refreshable.
+    REFRESH_TOKEN_LIFE = 86400  # Seconds a session can go without a refresh.
+    REFRESH_SESSION_LIFE = 604800  # Max seconds a session can be extended to.
+
+    # What users can change in their own accounts through /api/update_account
+    SELF_UPDATE_ATTRIBUTES = ['email', 'data', 'password']
+    SELF_UPDATE_PROTECTED_DATA = ['TOKEN_LIFE']
+
+    # Bulk account imports through /users/import_users.
+    IMPORT_MAX_ROWS = 5000
+    IMPORT_HASH_WORKERS = None  # Processes hashing passwords. None: all CPUs.
+    BULK_UPDATE_WORKERS = 8  # Parallel updates sent by /users/bulk_update.
+
+    # Access required to resolve users by username through /api/get_users.
+    BATCH_USER_ACCESS = (['admin'], [''])
+
+    # In-process caches. These times bound how stale a cached value can be.
+    ROLE_GRAPH_TTL = 60  # Seconds to cache the complete role graph.
+    ROLE_GRAPH_STALE_TTL = 3600  # Seconds more to serve it while reloading.
+    USER_ACCESS_TTL = 30  # Seconds to cache a user's roles and countries.
+    USER_ACCESS_STALE_TTL = 300  # Seconds more to serve them while reloading.
+    DECISION_CACHE_SIZE = 10000  # Max number of cached access decisions.
+    USERNAME_FILTER_TTL = 300  # Seconds between rebuilds of username filter.
+
+    # The connection to the database, shared by every model in a process
+    # (see meerkat_auth.db). Retry mode is 'standard' or 'adaptive'. The
+    # backend is 'dynamodb', 'memory' or 'sqlite' (see meerkat_auth.storage).
+    DB_BACKEND = os.environ.get('DB_BACKEND', 'dynamodb')
+    DB_SQLITE_PATH = os.environ.get('DB_SQLITE_PATH', 'auth.sqlite3')
+    DB_REGION = 'eu-west-1'
+    DB_MAX_POOL_CONNECTIONS = 50
+    DB_TCP_KEEPALIVE = True
+    DB_MAX_ATTEMPTS = 3
+    DB_RETRY_MODE = 'standard'
+    DB_FANOUT_WORKERS = 16  # Threads making independent reads at once.
+
+    # Bound the time spent waiting on a slow or throttled database. After
+    # DB_BREAKER_THRESHOLD timeouts or throttles in a row, calls fail at once
+    # for DB_BREAKER_RESET seconds (see meerkat_auth.circuit).
+    DB_CONNECT_TIMEOUT = 2
+    DB_READ_TIMEOUT = 5
+    DB_BREAKER_THRESHOLD = 5
+    DB_BREAKER_RESET = 30
+
+    # Refresh users' stored access in the background after role changes.
+    ACCESS_REFRESH_ASYNC = True
+
+    # Revoked tokens are shared between nodes through this store.
+    REVOCATION_STORE = 'meerkat_auth.revocation.DynamoRevocationStore'
+    REVOCATION_SYNC_INTERVAL = 10  # Seconds between reads of the store.
+    REVOCATION_BUCKET = 86400  # Seconds of revocations per table partition.
 
     DEFAULT_LANGUAGE = "en"
     SUPPORTED_LANGUAGES = ["en", "fr"]
@@ -60,4 +120,9 @@ class Testing(Config):
     TESTING = True
     USERS = 'test_auth_users'
     ROLES = 'test_auth_roles'
+    REVOCATIONS = 'test_auth_revocations'
+    REFRESH_TOKENS = 'test_auth_refresh_tokens'
+    ROLE_INDEX = 'test_auth_role_index'
+    ACCESS_REFRESH_ASYNC = False  # So tests see refreshed access at once.
+    DB_BACKEND = os.environ.get('DB_BACKEND', 'memory')
     DB_URL = "https://dynamodb.eu-west-1.amazonaws.com"
@@ -0,0 +1,236 @@
+"""
+db.py
+
+The connection to DynamoDB shared by all of Meerkat Auth's models. Each
+process has a single boto3 session and resource, so that every model shares
+one pool of HTTP connections. The resource is only created when the database
+is first used, from the app config at that time, rather than when the models
+are imported.
+
+boto3 sessions and their connection pools mustn't be shared across a fork,
+so a process that finds it has been forked creates its own resource. Under
+uWSGI, which forks its workers from a master process that has already
+imported the app, the resource is also dropped explicitly after each fork
+(see init_after_fork()).
+
+The pool size, TCP keep-alive, timeouts and retries are set by the DB_*
+values in the app config. config['DB_BACKEND'] can instead put one of the
+local backends in meerkat_auth.storage behind the models.
+
+Independent reads, e.g. of each country's roles, can be made at the same
+time with gather() and fan_out(), on a pool of threads that is also
+recreated after a fork.
+"""
+from meerkat_auth import app, circuit, storage
+from concurrent.futures import ThreadPoolExecutor, wait
+from botocore.config import Config
+import functools
+import threading
+import logging
+import boto3
+import os
+
+_lock = threading.Lock()
+_resource = None
+_settings = None  # The process id and config the resource was created for.
+_pool = None  # The fan-out threads, with the pid and size they were made for.
+_local = threading.local()  # Marks the pool's own threads.
+
+
+def _config():
+    """The settings the shared resource is created with."""
+    backend = app.config['DB_BACKEND']
+    if backend != 'dynamodb':
+        return (os.getpid(), backend, app.config['DB_SQLITE_PATH'])
+    return (
+        os.getpid(),
+        backend,
+        app.config['DB_URL'],
+        app.config['DB_REGION'],
+        app.config['DB_MAX_POOL_CONNECTIONS'],
+        app.config['DB_TCP_KEEPALIVE'],
+        app.config['DB_CONNECT_TIMEOUT'],
+        app.config['DB_READ_TIMEOUT'],
+        app.config['DB_MAX_ATTEMPTS'],
+        app.config['DB_RETRY_MODE']
+    )
+
+
+def _dynamodb(url, region, pool, keepalive, connect, read, attempts, mode):
+    """Creates a boto3 DynamoDB resource with its own session."""
+    logging.info('Connecting to DynamoDB at ' + str(url))
+    session = boto3.session.Session()
+    return session.resource(
+        'dynamodb',
+        endpoint_url=url,
+        region_name=region,
+        config=Config(
+            max_pool_connections=pool,
+            tcp_keepalive=keepalive,
+            connect_timeout=connect,
+            read_timeout=read,
+            retries={'max_attempts': attempts, 'mode': mode}
+        )
+    )
+
+
+def resource():
+    """
+    Returns this process's shared database resource, creating it if this
+    process hasn't yet used the database, or if the database config has
+    changed since it did. This is a boto3 DynamoDB resource, unless
+    config['DB_BACKEND'] names one of the local backends in
+    meerkat_auth.storage. Either is thread safe once created.
+
+    Returns:
+        The boto3 DynamoDB resource, or the storage.Backend standing in for
+        one.
+    """
+    global _resource, _settings
+    settings = _config()
+    if _settings != settings:
+        with _lock:
+            if _settings != settings:
+                if settings[1] == 'dynamodb':
+                    _resource = _dynamodb(*settings[2:])
+                else:
+                    _resource = storage.create(*settings[1:])
+                _settings = settings
+    return _resource
+
+
+def reset():
+    """
+    Drops the shared resource, so that the next database call creates a new
+    one. Call this in a newly forked process.
+    """
+    global _resource, _settings, _pool
+    with _lock:
+        if _pool is not None and _pool[0][0] == os.getpid():
+            _pool[1].shutdown(wait=False)
+        _resource = None
+        _settings = None
+        _pool = None
+
+
+def init_after_fork():
+    """
+    Makes a newly forked worker process start with its own database
+    connections. This is registered with uWSGI's postfork hook when running
+    under uWSGI, and with os.register_at_fork() otherwise.
+    """
+    global _lock, _local, _resource, _settings, _pool
+    # Another thread may have held the lock when the process forked. That
+    # thread doesn't exist in this process, so the lock is replaced rather
+    # than taken. The parent's pool threads don't exist here either.
+    _lock = threading.Lock()
+    _local = threading.local()
+    _resource = None
+    _settings = None
+    _pool = None
+
+
+def _mark_worker():
+    _local.worker = True
+
+
+def _executor():
+    """
+    Returns this process's pool of fan-out threads, creating it if need be,
+    or if config['DB_FANOUT_WORKERS'] has changed.
+    """
+    global _pool
+    settings = (os.getpid(), app.config['DB_FANOUT_WORKERS'])
+    with _lock:
+        if _pool is None or _pool[0] != settings:
+            if _pool is not None and _pool[0][0] == os.getpid():
+                _pool[1].shutdown(wait=False)
+            _pool = (settings, ThreadPoolExecutor(
+                max_workers=settings[1],
+                thread_name_prefix='db-fan-out',
+                initializer=_mark_worker
+            ))
+        return _pool[1]
+
+
+def gather(*calls):
+    """
+    Makes independent database calls at the same time, so that a request
+    needing many reads waits roughly as long as the slowest one rather than
+    for all of them in turn. The calls run on a pool of
+    config['DB_FANOUT_WORKERS'] threads shared by the process. Calls made
+    from the pool's own threads run in turn instead, as waiting on the pool
+    from inside it could deadlock.
+
+    Args:
+        calls (functions) The calls to make, each taking no arguments.
+
+    Returns:
+        list The calls' results, in order.
+
+    Raises:
+        The exception raised by the first call that failed, once every call
+        has finished.
+    """
+    if len(calls) < 2 or getattr(_local, 'worker', False):
+        return [call() for call in calls]
+    futures = [_executor().submit(call) for call in calls]
+    wait(futures)
+    return [future.result() for future in futures]
+
+
+def fan_out(function, items):
+    """
+    Calls function(item) for every item at the same time, as gather().
+
+    Args:
+        function (function) The database call to make for each item.
+        items (iterable) The items.
+
+    Returns:
+        list The results, in the order of the items.
+    """
+    return gather(*[functools.partial(function, item) for item in items])
+
+
+# uWSGI forks its workers in C, which doesn't run Python's fork hooks.
+try:
+    # Only importable when running under uWSGI.
+    from uwsgidecorators import postfork
+    postfork(init_after_fork)
+except ImportError:
+    os.register_at_fork(after_in_child=init_after_fork)
+
+
+class Database(circuit.GuardedResource):
+    """
+    Stands in for the shared DynamoDB resource, as the DB attribute of a
+    model, so that the resource is only created when it is first used. Every
+    database call goes through a circuit breaker for the model (see
+    meerkat_auth.circuit), set up from config['DB_BREAKER_THRESHOLD'] and
+    config['DB_BREAKER_RESET'] when first needed.
+    """
+
+    def __init__(self, name):
+        """
+        Create a Database object.
+
+        Args:
+            name (str) Names the database's circuit.
+        """
+        self.name = name
+        self._breaker = None
+
+    @property
+    def resource(self):
+        return resource()
+
+    @property
+    def breaker(self):
+        if self._breaker is None:
+            self._breaker = circuit.CircuitBreaker(
+                self.name,
+                app.config['DB_BREAKER_THRESHOLD'],
+                app.config['DB_BREAKER_RESET']
+            )
+        return self._breaker
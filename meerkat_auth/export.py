@@ -0,0 +1,109 @@
+"""
+export.py
+
+Serialises user accounts for bulk export, as newline delimited JSON (one
+account per line) or as CSV. The serialisers are generators that consume
+accounts a page at a time and yield text as they go, so an export of the whole
+users table can be streamed without ever holding the table in memory.
+"""
+from decimal import Decimal
+import json
+import csv
+import io
+
+# The account attributes exported. Password hashes are never exported.
+EXPORT_ATTRIBUTES = [
+    'username', 'email', 'countries', 'roles', 'state', 'creation', 'updated',
+    'data'
+]
+
+# The supported export formats and their mimetypes.
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+
+def _default(value):
+    """Serialises the Decimal and Set values that DynamoDB returns."""
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError(repr(value) + ' is not JSON serializable')
+
+
+def to_ndjson(pages):
+    """
+    Serialises accounts as newline delimited JSON.
+
+    Args:
+        pages (iterable) Lists of user account dictionaries, e.g. as yielded
+            by User.get_pages().
+
+    Yields:
+        str One chunk of text per page of accounts.
+    """
+    for page in pages:
+        if page:
+            yield ''.join(
+                json.dumps(row, default=_default, sort_keys=True) + '\n'
+                for row in page
+            )
+
+
+def to_csv(pages, attributes=EXPORT_ATTRIBUTES):
+    """
+    Serialises accounts as CSV with a header row. List attributes (countries
+    and roles) are joined with ';' and the data blob is written as JSON.
+
+    Args:
+        pages (iterable) Lists of user account dictionaries, e.g. as yielded
+            by User.get_pages().
+        attributes ([str]) The columns to write.
+
+    Yields:
+        str The header row, then one chunk of text per page of accounts.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return text
+
+    writer.writerow(attributes)
+    yield flush()
+    for page in pages:
+        if not page:
+            continue
+        for row in page:
+            writer.writerow([_cell(row.get(a, '')) for a in attributes])
+        yield flush()
+
+
+def _cell(value):
+    """Converts an account attribute into a single CSV cell."""
+    if isinstance(value, dict):
+        return json.dumps(value, default=_default, sort_keys=True)
+    if isinstance(value, (list, tuple, set)):
+        return ';'.join(str(v) for v in value)
+    if isinstance(value, Decimal):
+        return _default(value)
+    return value
+
+
+def serialise(pages, format):
+    """
+    Serialises accounts in the given format, one of FORMATS.
+
+    Raises:
+        ValueError if the format isn't supported.
+    """
+    if format == 'ndjson':
+        return to_ndjson(pages)
+    if format == 'csv':
+        return to_csv(pages)
+    raise ValueError('Export format must be one of ' + ', '.join(FORMATS))
@@ -0,0 +1,227 @@
+"""
+importer.py
+
+Bulk creation of user accounts from CSV or JSON, e.g. when onboarding a new
+country. Every row is validated before anything is written: roles are checked
+against a single RoleGraph loaded for all the countries in the import, and
+existing usernames are found with one batched read. Passwords are hashed on a
+pool of processes, since hashing is deliberately slow, and the accounts are
+then written in BatchWriteItem chunks. A problem with one row is reported
+against that row and doesn't stop the rest of the import.
+
+The CSV columns are those written by export.py, plus a 'password' column.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from meerkat_auth.user import User, UnreadUsersException
+from meerkat_auth.role import InvalidRoleException
+from meerkat_auth.role_graph import RoleGraph
+from meerkat_auth.authorise import auth
+import logging
+import json
+import csv
+import io
+
+# The supported import formats.
+FORMATS = ['json', 'csv']
+
+
+def parse(text, format):
+    """
+    Parses the accounts to import. A CSV 'data' cell that isn't valid JSON
+    is left as text, so that _validate() reports it as an error on that row.
+
+    Args:
+        text (str) The CSV text, or a JSON list of account objects.
+        format (str) One of FORMATS.
+
+    Returns:
+        [dict] The account rows.
+
+    Raises:
+        ValueError if the text can't be parsed.
+    """
+    if format == 'json':
+        rows = json.loads(text)
+        if not isinstance(rows, list):
+            raise ValueError('JSON imports must be a list of accounts.')
+        return rows
+    if format == 'csv':
+        rows = []
+        for row in csv.DictReader(io.StringIO(text)):
+            for attribute in ['countries', 'roles']:
+                value = row.get(attribute) or ''
+                row[attribute] = [v for v in value.split(';') if v]
+            try:
+                row['data'] = json.loads(row.get('data') or '{}')
+            except ValueError:
+                pass  # Reported by _validate().
+            rows.append(row)
+        return rows
+    raise ValueError('Import format must be one of ' + ', '.join(FORMATS))
+
+
+def _validate(row, graph, taken, acc):
+    """
+    Checks a single row, returning an error message or None if it is valid.
+    """
+    if not isinstance(row, dict):
+        return 'Each account must be an object.'
+    username = row.get('username')
+    if not username or not isinstance(username, str):
+        return 'A username is required.'
+    if username in taken:
+        return "A 'new' username must not match an existing username."
+    if not isinstance(row.get('email'), str) or \
+            not User.EMAIL_REGEX.match(row['email']):
+        return 'The email address is not valid.'
+    if not row.get('password') or not isinstance(row['password'], str):
+        return 'A password is required.'
+    if not isinstance(row.get('data', {}), dict):
+        return 'The account data must be a JSON object.'
+    countries = row.get('countries')
+    roles = row.get('roles')
+    if not isinstance(countries, list) or not isinstance(roles, list) or \
+            not roles or len(countries) != len(roles):
+        return 'Each role needs a corresponding country.'
+    try:
+        for country, role in zip(countries, roles):
+            graph.all_access(country, role)
+    except InvalidRoleException as e:
+        return str(e)
+    if acc is not None and not auth.check_access(roles, countries, acc, 'AND'):
+        return 'You are not authorised to create this account.'
+    return None
+
+
+def hash_passwords(passwords, workers=None, progress=None):
+    """
+    Hashes passwords according to Meerkat's password hashing policy, spread
+    over a pool of processes.
+
+    Args:
+        passwords ([str]) The unhashed passwords.
+        workers (int) The number of processes. Defaults to the number of CPUs.
+            If 1, passwords are hashed in this process.
+        progress (function) Called as progress(hashed, total) periodically.
+
+    Returns:
+        [str] The hashes, in the same order as the passwords.
+    """
+    def hash_all(hashes):
+        done = []
+        for hashed in hashes:
+            done.append(hashed)
+            if progress and (len(done) % 25 == 0 or
+                             len(done) == len(passwords)):
+                progress(len(done), len(passwords))
+        return done
+
+    if workers == 1 or len(passwords) < 2:
+        return hash_all(User.hash_password(p) for p in passwords)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return hash_all(
+            pool.map(User.hash_password, passwords, chunksize=8)
+        )
+
+
+def import_users(rows, acc=None, dry_run=False, workers=None, progress=None):
+    """
+    Validates and creates user accounts.
+
+    Args:
+        rows ([dict]) The accounts, each with a username, email, password,
+            countries and roles, and optionally data.
+        acc (dict) If given, only accounts within this access are created,
+            as with check_access(roles, countries, acc, 'AND').
+        dry_run (bool) If true, validate the rows but write nothing.
+        workers (int) The number of processes to hash passwords with.
+        progress (function) Called as progress(stage, done, total) as the
+            passwords are hashed ('hashed') and accounts written ('written').
+
+    Returns:
+        A dictionary with the number of rows in 'total', the usernames
+        created (or that would be created, in a dry run) in 'created', and a
+        list of {'row', 'username', 'error'} dictionaries in 'errors'.
+    """
+    errors = []
+
+    def fail(index, row, message):
+        username = row.get('username') if isinstance(row, dict) else None
+        errors.append({'row': index, 'username': username, 'error': message})
+
+    # Load everything needed to validate the rows up front, in one go.
+    countries = set()
+    usernames = []
+    for row in rows:
+        if isinstance(row, dict):
+            if isinstance(row.get('countries'), list):
+                countries.update(c for c in row['countries'] if c)
+            if isinstance(row.get('username'), str):
+                usernames.append(row['username'])
+    graph = RoleGraph([])
+    if countries:
+        graph = RoleGraph.from_db(sorted(countries))
+    taken = set()
+    unread = {}
+    if usernames:
+        try:
+            taken.update(User.batch_get(usernames, ['username']))
+        except UnreadUsersException as e:
+            taken.update(e.items)
+            unread = {username: str(e) for username in e.usernames}
+
+    valid = []
+    for index, row in enumerate(rows):
+        error = _validate(row, graph, taken, acc)
+        if not error and row['username'] in unread:
+            error = unread[row['username']]
+        if error:
+            fail(index, row, error)
+        else:
+            taken.add(row['username'])  # Catch repeats within the import.
+            valid.append((index, row))
+
+    if dry_run or not valid:
+        return {
+            'total': len(rows),
+            'created': [row['username'] for index, row in valid],
+            'errors': errors
+        }
+
+    def on_hashed(done, total):
+        if progress:
+            progress('hashed', done, total)
+
+    hashes = hash_passwords(
+        [row['password'] for index, row in valid], workers, on_hashed
+    )
+
+    now = datetime.now().isoformat()
+    items = [{
+        'username': row['username'],
+        'email': row['email'],
+        'password': hashed,
+        'countries': row['countries'],
+        'roles': row['roles'],
+        'state': 'live',
+        'creation': now,
+        'updated': now,
+        'data': row.get('data', {}),
+        'access': User.compute_access(row['countries'], row['roles'], graph)
+    } for (index, row), hashed in zip(valid, hashes)]
+
+    def on_written(done, total):
+        if progress:
+            progress('written', done, total)
+
+    failed = set(User.batch_put(items, progress=on_written))
+    created = []
+    for index, row in valid:
+        if row['username'] in failed:
+            fail(index, row, 'The database was too busy, try again.')
+        else:
+            created.append(row['username'])
+    errors.sort(key=lambda e: e['row'])
+    logging.info('Imported {} of {} users.'.format(len(created), len(rows)))
+    return {'total': len(rows), 'created': created, 'errors': errors}
@@ -0,0 +1,278 @@
+"""
+jwks.py
+
+Publishing and consuming the public keys used to sign Meerkat Auth tokens as a
+JSON Web Key Set (JWKS, RFC 7517). Meerkat Auth serves its key set from
+/api/.well-known/jwks.json, and other services can use the KeySet class to
+verify both the small cookie token and the larger user details token locally,
+without a request to Meerkat Auth on every page load.
+"""
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+import functools
+import threading
+import requests
+import hashlib
+import base64
+import logging
+import json
+import time
+import jwt
+import re
+
+# Map between the JWK curve names and the cryptography curve classes.
+CURVES = {
+    'P-256': ec.SECP256R1,
+    'P-384': ec.SECP384R1,
+    'P-521': ec.SECP521R1
+}
+
+
+def _b64(value):
+    """Encodes bytes as unpadded base64url, as JWK requires."""
+    return base64.urlsafe_b64encode(value).rstrip(b'=').decode('ascii')
+
+
+def _b64_uint(value, length=None):
+    """Encodes an unsigned integer as unpadded base64url."""
+    if length is None:
+        length = max(1, (value.bit_length() + 7) // 8)
+    return _b64(value.to_bytes(length, 'big'))
+
+
+def _uint_b64(value):
+    """Decodes an unpadded base64url string into an unsigned integer."""
+    padded = value + '=' * (-len(value) % 4)
+    return int.from_bytes(base64.urlsafe_b64decode(padded), 'big')
+
+
+def load_public_key(pem):
+    """
+    Loads a PEM encoded public key.
+
+    Args:
+        pem (str or bytes) The PEM encoded public key.
+
+    Returns:
+        The cryptography public key object.
+    """
+    if isinstance(pem, str):
+        pem = pem.encode('utf-8')
+    return serialization.load_pem_public_key(pem, backend=default_backend())
+
+
+def to_jwk(public_key):
+    """
+    Creates the JWK parameters for an RSA or elliptic curve public key,
+    excluding the key ID and usage parameters.
+
+    Args:
+        public_key The cryptography public key object.
+
+    Returns:
+        A dict of the JWK's key parameters.
+    """
+    if isinstance(public_key, rsa.RSAPublicKey):
+        numbers = public_key.public_numbers()
+        return {
+            'kty': 'RSA',
+            'n': _b64_uint(numbers.n),
+            'e': _b64_uint(numbers.e)
+        }
+    elif isinstance(public_key, ec.EllipticCurvePublicKey):
+        numbers = public_key.public_numbers()
+        curve = next(
+            (k for k, v in CURVES.items() if v.name == public_key.curve.name),
+            None
+        )
+        if not curve:
+            raise ValueError('Unsupported curve ' + public_key.curve.name)
+        size = (public_key.curve.key_size + 7) // 8
+        return {
+            'kty': 'EC',
+            'crv': curve,
+            'x': _b64_uint(numbers.x, size),
+            'y': _b64_uint(numbers.y, size)
+        }
+    else:
+        raise ValueError('Unsupported key type ' + type(public_key).__name__)
+
+
+def from_jwk(jwk):
+    """
+    Creates a cryptography public key object from a JWK dict, that can be
+    passed directly to jwt.decode().
+
+    Args:
+        jwk (dict) The JSON Web Key.
+
+    Returns:
+        The cryptography public key object.
+    """
+    if jwk['kty'] == 'RSA':
+        numbers = rsa.RSAPublicNumbers(_uint_b64(jwk['e']), _uint_b64(jwk['n']))
+    elif jwk['kty'] == 'EC':
+        numbers = ec.EllipticCurvePublicNumbers(
+            _uint_b64(jwk['x']),
+            _uint_b64(jwk['y']),
+            CURVES[jwk['crv']]()
+        )
+    else:
+        raise ValueError('Unsupported key type ' + str(jwk['kty']))
+    return numbers.public_key(default_backend())
+
+
+@functools.lru_cache(maxsize=16)
+def key_id(pem):
+    """
+    Returns the key ID for a public key. This is the RFC 7638 thumbprint of the
+    key, so every node derives the same ID from the same key without further
+    configuration.
+
+    Args:
+        pem (str or bytes) The PEM encoded public key.
+
+    Returns:
+        str The key ID.
+    """
+    canonical = json.dumps(
+        to_jwk(load_public_key(pem)), sort_keys=True, separators=(',', ':')
+    )
+    digest = hashlib.sha256(canonical.encode('utf-8')).digest()
+    return _b64(digest)
+
+
+def get_jwks(public_keys, algorithm):
+    """
+    Assembles the JSON Web Key Set for the given public keys.
+
+    Args:
+        public_keys ([str]) A list of PEM encoded public keys. The first should
+            be the key currently used for signing. Retired keys are kept in
+            the list until all tokens signed with them have expired.
+        algorithm (str) The JWT algorithm used with the keys e.g. 'RS256'.
+
+    Returns:
+        A dict with a single property 'keys', listing the JWKs.
+    """
+    keys = []
+    for pem in public_keys:
+        jwk = to_jwk(load_public_key(pem))
+        jwk.update({'kid': key_id(pem), 'use': 'sig', 'alg': algorithm})
+        keys.append(jwk)
+    return {'keys': keys}
+
+
+class KeySet:
+    """
+    A client side cache of a remote JSON Web Key Set, used to verify Meerkat
+    Auth tokens without contacting Meerkat Auth on every request. The key set
+    is refetched once the cache lifetime advertised by the server is over, or
+    when a token is signed with a key ID that isn't cached (i.e. a key has been
+    rotated). Refetching on an unknown key ID is rate limited so that junk
+    tokens can't be used to flood Meerkat Auth with requests.
+    """
+
+    def __init__(self, url, max_age=3600, min_refresh=30, timeout=5):
+        """
+        Create a KeySet object.
+
+        Args:
+            url (str) The url of the JWKS e.g.
+                https://auth.example.org/api/.well-known/jwks.json
+            max_age (int) Seconds to cache the key set for if the server
+                doesn't specify a max-age in its Cache-Control header.
+            min_refresh (int) Minimum number of seconds between refetches.
+            timeout (int) Timeout in seconds for fetching the key set.
+        """
+        self.url = url
+        self.max_age = max_age
+        self.min_refresh = min_refresh
+        self.timeout = timeout
+        self.keys = {}
+        self.expires = 0
+        self.fetched = 0
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """Fetches the key set from the server and replaces the cached keys."""
+        response = requests.get(self.url, timeout=self.timeout)
+        response.raise_for_status()
+        keys = {}
+        for jwk in response.json().get('keys', []):
+            try:
+                keys[jwk.get('kid')] = from_jwk(jwk)
+            except (KeyError, ValueError) as e:
+                logging.warning('Skipping unusable JWK: ' + repr(e))
+
+        max_age = self.max_age
+        match = re.search(
+            r'max-age=(\d+)', response.headers.get('Cache-Control', '')
+        )
+        if match:
+            max_age = int(match.group(1))
+
+        self.fetched = time.time()
+        self.expires = self.fetched + max_age
+        self.keys = keys
+
+    def get_key(self, kid):
+        """
+        Returns the public key object for the given key ID, fetching the key
+        set from the server only if needed.
+
+        Args:
+            kid (str) The key ID.
+
+        Returns:
+            The public key object.
+
+        Raises:
+            jwt.InvalidTokenError if no key with the given ID is published.
+        """
+        key = self.keys.get(kid)
+        if key is not None and time.time() < self.expires:
+            return key
+
+        with self.lock:
+            # Another thread may have refreshed whilst we were waiting.
+            stale = time.time() >= self.expires
+            unknown = kid not in self.keys
+            throttled = time.time() - self.fetched < self.min_refresh
+            if stale or (unknown and not throttled):
+                try:
+                    self.refresh()
+                except requests.RequestException as e:
+                    # Keep using the keys we already have rather than fail,
+                    # and back off before trying the server again.
+                    logging.warning('Failed to refresh JWKS: ' + repr(e))
+                    self.fetched = time.time()
+                    self.expires = self.fetched + self.min_refresh
+                    if not self.keys:
+                        raise jwt.InvalidTokenError('No signing keys available')
+
+        key = self.keys.get(kid)
+        if key is None:
+            raise jwt.InvalidTokenError('Unknown signing key ' + str(kid))
+        return key
+
+    def verify(self, token, algorithms, **kwargs):
+        """
+        Verifies and decodes a Meerkat Auth token, i.e. the cookie token or the
+        user details token returned by /api/get_user.
+
+        Args:
+            token (str) The encoded JWT.
+            algorithms ([str]) The accepted JWT algorithms e.g. ['RS256'].
+            Any further keyword arguments are passed to jwt.decode().
+
+        Returns:
+            dict The decoded payload.
+
+        Raises:
+            jwt.InvalidTokenError (or a subclass) if the token is not valid.
+        """
+        header = jwt.get_unverified_header(token)
+        key = self.get_key(header.get('kid'))
+        return jwt.decode(token, key, algorithms=algorithms, **kwargs)
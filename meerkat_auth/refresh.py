@@ -0,0 +1,171 @@
+"""
+refresh.py
+
+Long lived, rotating refresh tokens. A refresh token lets a user extend their
+session by getting a new short lived access token from /api/refresh, without
+logging in again, and so without the cost of verifying their password hash.
+
+Only a hash of each refresh token is stored in the database table specified
+by config['REFRESH_TOKENS']. Every refresh token can be used once: using it
+returns a new refresh token for the same session. If a used token is presented
+again it has probably been stolen, so the session's refresh tokens, and every
+token of that user, are revoked.
+"""
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+from meerkat_auth.revocation import revocations
+from meerkat_auth.user import User, InvalidCredentialException
+from meerkat_auth import app, db
+import logging
+import hashlib
+import secrets
+import time
+import uuid
+
+
+class RefreshToken:
+    """
+    Class to manage issuing, rotating and revoking refresh tokens in the
+    database.
+    """
+
+    # The shared database resource (see meerkat_auth.db).
+    DB = db.Database('refresh_tokens')
+
+    @staticmethod
+    def _hash(token):
+        """Returns the hash under which a refresh token is stored."""
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def issue(username, session_expires=None, session=None):
+        """
+        Creates a new refresh token for a user and stores its hash.
+
+        Args:
+            username (str) The user the token is issued to.
+            session_expires (int) The time after which the session can't be
+                extended any more, however often it is refreshed. Defaults to
+                config['REFRESH_SESSION_LIFE'] seconds from now.
+            session (str) The unique ID shared by every refresh token of the
+                session. Defaults to a new session.
+
+        Returns:
+            (str, int) The refresh token and its expiry time.
+        """
+        now = int(time.time())
+        if session_expires is None:
+            session_expires = now + app.config['REFRESH_SESSION_LIFE']
+        expires = min(now + app.config['REFRESH_TOKEN_LIFE'], session_expires)
+        token = secrets.token_urlsafe(32)
+        if session is None:
+            session = uuid.uuid4().hex
+
+        table = RefreshToken.DB.Table(app.config['REFRESH_TOKENS'])
+        table.put_item(Item={
+            'id': RefreshToken._hash(token),
+            'username': username,
+            'created': now,
+            'expires': expires,
+            'session_expires': int(session_expires),
+            'session': session,
+            'used': False,
+            'ttl': expires
+        })
+        return token, expires
+
+    @staticmethod
+    def rotate(token):
+        """
+        Uses up a refresh token, returning the user it was issued to and a new
+        refresh token for the same session. The token is marked as used with a
+        conditional write, so a token can't be used twice even by concurrent
+        requests.
+
+        Args:
+            token (str) The refresh token.
+
+        Returns:
+            (str, str, int) The username, the new refresh token and its expiry.
+
+        Raises:
+            InvalidRefreshTokenException if the token isn't valid, or if the
+                user's account is no longer active.
+        """
+        now = int(time.time())
+        table = RefreshToken.DB.Table(app.config['REFRESH_TOKENS'])
+        key = {'id': RefreshToken._hash(token)}
+
+        try:
+            item = table.update_item(
+                Key=key,
+                UpdateExpression='SET #u = :true',
+                ConditionExpression=(
+                    Attr('used').eq(False) & Attr('expires').gt(now)
+                ),
+                ExpressionAttributeNames={'#u': 'used'},
+                ExpressionAttributeValues={':true': True},
+                ReturnValues='ALL_NEW'
+            )['Attributes']
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            item = table.get_item(Key=key).get('Item')
+            if item and item['used']:
+                # Reuse of a rotated token: assume theft and end every session.
+                # The tokens rotated from it are revoked explicitly, as they
+                # may have been issued since the user's tokens were revoked.
+                logging.warning(
+                    'Refresh token reused for ' + item['username'] +
+                    '. Revoking all their tokens.'
+                )
+                if item.get('session'):
+                    revocations.revoke_session(
+                        item['session'], item['session_expires']
+                    )
+                revocations.revoke_user(item['username'])
+            raise InvalidRefreshTokenException('Refresh token is not valid.')
+
+        # Tokens issued before the user's tokens were revoked are also revoked.
+        claims = {
+            'usr': item['username'],
+            'iat': int(item['created']),
+            'sid': item.get('session')
+        }
+        if revocations.is_revoked(claims):
+            raise InvalidRefreshTokenException('Refresh token was revoked.')
+
+        # Sessions can't be extended once an account is deleted or suspended.
+        try:
+            user = User.get_access_item(item['username'], fresh=True)
+        except InvalidCredentialException:
+            raise InvalidRefreshTokenException('The account does not exist.')
+        if user.get('state') in User.INACTIVE_STATES:
+            raise InvalidRefreshTokenException('The account is inactive.')
+
+        new_token, expires = RefreshToken.issue(
+            item['username'], int(item['session_expires']), item.get('session')
+        )
+        return item['username'], new_token, expires
+
+    @staticmethod
+    def revoke(token):
+        """
+        Deletes a refresh token so that it can't be used again.
+
+        Args:
+            token (str) The refresh token.
+
+        Returns:
+            The amazon dynamodb response.
+        """
+        table = RefreshToken.DB.Table(app.config['REFRESH_TOKENS'])
+        return table.delete_item(Key={'id': RefreshToken._hash(token)})
+
+
+class InvalidRefreshTokenException(Exception):
+    """
+    An exception to be raised when a refresh token is unknown, expired, already
+    used or revoked.
+    """
+    pass
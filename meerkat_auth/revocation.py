@@ -0,0 +1,319 @@
+"""
+revocation.py
+
+Server side revocation of Meerkat Auth tokens. A token can be revoked by its
+unique ID (the 'jti' claim), or all of a user's tokens issued before a given
+time can be revoked at once (e.g. "log out everywhere" or a suspended account).
+The refresh tokens of a session (the 'sid' claim) can also be revoked at once.
+
+Every node keeps the revocations in memory, so checking a token is a couple of
+dictionary lookups rather than a database read. Revocations are shared between
+nodes through a RevocationStore, which each node polls for new entries at most
+once every config['REVOCATION_SYNC_INTERVAL'] seconds.
+"""
+from boto3.dynamodb.conditions import Key
+from meerkat_auth import app, db
+import importlib
+import threading
+import logging
+import math
+import time
+import jwt
+
+
+class RevokedTokenError(jwt.InvalidTokenError):
+    """Raised when a token has been revoked before its expiry time."""
+    pass
+
+
+class RevocationStore:
+    """
+    Interface for the store through which nodes share revocations. Entries are
+    dicts with a 'kind' of 'jti', 'user' or 'session':
+
+        {'kind': 'jti', 'jti': <token id>, 'expires': <token exp>}
+        {'kind': 'user', 'username': <username>, 'before': <time>,
+         'expires': <time after which no revoked token can still be valid>,
+         'keep': <token ids issued before that time that stay valid>}
+        {'kind': 'session', 'session': <session id>,
+         'expires': <session expiry>}
+    """
+
+    def add(self, entry):
+        """Shares a new revocation entry with the other nodes."""
+        raise NotImplementedError
+
+    def load(self, since):
+        """Returns the entries added at or after the time given by since."""
+        raise NotImplementedError
+
+
+class DynamoRevocationStore(RevocationStore):
+    """
+    Shares revocations through the DynamoDB table specified by
+    config['REVOCATIONS']. Each item carries a 'ttl' attribute, so if time to
+    live is enabled on the table, DynamoDB deletes entries once they expire.
+
+    Items are partitioned by the time they were added, in buckets of
+    config['REVOCATION_BUCKET'] seconds (the hash key 'bucket'), and sorted
+    within a bucket by that time (the range key 'id' starts with it). So a
+    sync only queries the buckets since the last sync, and only reads the
+    entries added since then, rather than scanning the whole table.
+    """
+
+    # The shared database resource (see meerkat_auth.db).
+    DB = db.Database('revocations')
+
+    def add(self, entry):
+        table = DynamoRevocationStore.DB.Table(app.config['REVOCATIONS'])
+        if entry['kind'] == 'jti':
+            entry_id = 'jti:' + entry['jti']
+        elif entry['kind'] == 'session':
+            entry_id = 'session:' + entry['session']
+        else:
+            entry_id = 'user:' + entry['username']
+        created = int(time.time())
+        item = {
+            **entry,
+            'bucket': str(created // app.config['REVOCATION_BUCKET']),
+            'id': DynamoRevocationStore._sort_key(created) + ':' + entry_id,
+            'created': created,
+            'ttl': int(entry['expires'])
+        }
+        return table.put_item(Item=item)
+
+    @staticmethod
+    def _sort_key(created):
+        """Fixed width, so that ids sort in the order they were created."""
+        return '{:010d}'.format(max(int(created), 0))
+
+    def load(self, since):
+        table = DynamoRevocationStore.DB.Table(app.config['REVOCATIONS'])
+        now = int(time.time())
+        # No token can be valid for longer, so nor can its revocation matter.
+        since = max(int(since), now - app.config['MAX_TOKEN_LIFE'])
+        size = app.config['REVOCATION_BUCKET']
+
+        def query(bucket):
+            kwargs = {'KeyConditionExpression': (
+                Key('bucket').eq(str(bucket)) &
+                Key('id').gte(DynamoRevocationStore._sort_key(since))
+            )}
+            response = table.query(**kwargs)
+            items = response.get('Items', [])
+            while response.get('LastEvaluatedKey'):
+                kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+                response = table.query(**kwargs)
+                items += response.get('Items', [])
+            return items
+
+        pages = db.fan_out(query, range(since // size, now // size + 1))
+        return [item for page in pages for item in page]
+
+
+class RevocationList:
+    """
+    The in-memory record of revoked tokens. Revoked token IDs are held in time
+    buckets according to the token's expiry time, so that a whole bucket can
+    be dropped once every token in it has expired, and so that checking a
+    token only needs to look in a single small set.
+    """
+
+    def __init__(self, store=None, bucket_size=300, sync_interval=10):
+        """
+        Create a RevocationList object.
+
+        Args:
+            store (RevocationStore) The store shared with other nodes. If None
+                revocations are only known to this process.
+            bucket_size (int) The width of each time bucket in seconds.
+            sync_interval (int) Minimum seconds between reads from the store.
+        """
+        self.store = store
+        self.bucket_size = bucket_size
+        self.sync_interval = sync_interval
+        self.buckets = {}  # Bucket index: set of compacted jtis.
+        # Username: (revoked before time, expiry time, kept token ids).
+        self.users = {}
+        self.sessions = {}  # Session id: session expiry time.
+        self.synced = 0  # Time of the last attempt to read the store.
+        self.loaded = 0  # Time up to which entries have been read.
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _compact(jti):
+        """Hex token IDs (as we issue them) are stored as bytes, half size."""
+        try:
+            return bytes.fromhex(jti)
+        except (TypeError, ValueError):
+            return jti
+
+    def _add(self, entry):
+        """Adds an entry to the in-memory record, if not already expired."""
+        expires = int(entry['expires'])
+        if expires < time.time():
+            return
+        if entry['kind'] == 'jti':
+            bucket = self.buckets.setdefault(expires // self.bucket_size, set())
+            bucket.add(RevocationList._compact(entry['jti']))
+        elif entry['kind'] == 'session':
+            self.sessions[entry['session']] = expires
+        else:
+            before, old_expires, keep = self.users.get(
+                entry['username'], (0, 0, frozenset())
+            )
+            new_before = int(entry['before'])
+            new_keep = frozenset(entry.get('keep', []))
+            # A token is only kept if no revocation as late revoked it.
+            if new_before > before:
+                keep = new_keep
+            elif new_before == before:
+                keep = keep & new_keep
+            self.users[entry['username']] = (
+                max(before, new_before), max(old_expires, expires), keep
+            )
+
+    def purge(self):
+        """Drops every entry for tokens that have expired anyway."""
+        now = time.time()
+        current = int(now // self.bucket_size)
+        for bucket in [b for b in self.buckets if b < current]:
+            del self.buckets[bucket]
+        for user in [u for u, v in self.users.items() if v[1] < now]:
+            del self.users[user]
+        for session in [s for s, e in self.sessions.items() if e < now]:
+            del self.sessions[session]
+
+    def sync(self, force=False):
+        """
+        Loads new entries from the shared store, if the sync interval has
+        passed since the last load. Only one thread syncs at a time; other
+        threads carry on with the entries already loaded.
+        """
+        now = time.time()
+        if self.store is None:
+            return
+        if not force and now - self.synced < self.sync_interval:
+            return
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            self.synced = now
+            # Overlap loads slightly in case of clock differences.
+            entries = self.store.load(self.loaded - self.sync_interval)
+            for entry in entries:
+                self._add(entry)
+            self.purge()
+            self.loaded = now
+        except Exception as e:
+            # Keep checking against what we have rather than fail requests.
+            logging.warning('Failed to sync token revocations: ' + repr(e))
+        finally:
+            self.lock.release()
+
+    def revoke_token(self, jti, expires):
+        """
+        Revokes a single token.
+
+        Args:
+            jti (str) The token's unique ID.
+            expires (int) The token's expiry time.
+        """
+        entry = {'kind': 'jti', 'jti': jti, 'expires': int(expires)}
+        self._add(entry)
+        if self.store is not None:
+            self.store.add(entry)
+
+    def revoke_session(self, session, expires):
+        """
+        Revokes every token of a session, e.g. a chain of rotated refresh
+        tokens.
+
+        Args:
+            session (str) The session's unique ID.
+            expires (int) The time after which the session ends anyway.
+        """
+        entry = {
+            'kind': 'session', 'session': session, 'expires': int(expires)
+        }
+        self._add(entry)
+        if self.store is not None:
+            self.store.add(entry)
+
+    def revoke_user(self, username, before=None, max_life=None, keep=None):
+        """
+        Revokes all of a user's tokens issued before the given time.
+
+        Args:
+            username (str) The user whose tokens should be revoked.
+            before (float) Revoke tokens issued before this time. Defaults to
+                now, i.e. every token issued so far.
+            max_life (int) The longest any token can be valid for, after which
+                the revocation can be forgotten. Defaults to
+                config['MAX_TOKEN_LIFE'].
+            keep (str) The unique ID of a token that should stay valid, e.g.
+                one issued to the session that revoked every other.
+        """
+        # The tokens' 'iat' claims are whole seconds, so every token issued in
+        # the same second as the revocation is revoked too.
+        before = math.ceil(time.time() if before is None else before)
+        if max_life is None:
+            max_life = app.config['MAX_TOKEN_LIFE']
+        entry = {
+            'kind': 'user',
+            'username': username,
+            'before': before,
+            'expires': before + max_life
+        }
+        if keep:
+            entry['keep'] = [keep]
+        self._add(entry)
+        if self.store is not None:
+            self.store.add(entry)
+
+    def is_revoked(self, payload):
+        """
+        Checks whether a decoded token has been revoked.
+
+        Args:
+            payload (dict) The decoded token payload.
+
+        Returns:
+            bool True if the token has been revoked.
+        """
+        self.sync()
+        if payload.get('sid') in self.sessions:
+            return True
+        jti = payload.get('jti')
+        cutoff = self.users.get(payload.get('usr'))
+        if cutoff and payload.get('iat', 0) < cutoff[0]:
+            if jti not in cutoff[2]:
+                return True
+        if jti is None:
+            return False
+        bucket = self.buckets.get(int(payload['exp']) // self.bucket_size, ())
+        return RevocationList._compact(jti) in bucket
+
+
+def create_store(path):
+    """
+    Creates the shared store given by a dotted path, e.g.
+    'meerkat_auth.revocation.DynamoRevocationStore'.
+
+    Args:
+        path (str) The dotted path of the RevocationStore class, or None.
+
+    Returns:
+        The RevocationStore object, or None if path is None.
+    """
+    if not path:
+        return None
+    module, name = path.rsplit('.', 1)
+    return getattr(importlib.import_module(module), name)()
+
+
+# Create the list to import into the rest of the package.
+revocations = RevocationList(
+    store=create_store(app.config['REVOCATION_STORE']),
+    sync_interval=app.config['REVOCATION_SYNC_INTERVAL']
+)
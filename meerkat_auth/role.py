@@ -1,16 +1,20 @@
-from meerkat_auth import app
+from meerkat_auth.cache import SingleFlight
+from meerkat_auth.role_index import RoleIndex
+from meerkat_auth import app, db
 import logging
-import boto3
+import copy
+import threading
+import time
 
 
 class Role:
 
-    # The database resource
-    DB = boto3.resource(
-        'dynamodb',
-        endpoint_url=app.config['DB_URL'],
-        region_name='eu-west-1'
-    )
+    # The maximum number of items DynamoDB accepts in one BatchWriteItem.
+    BATCH_WRITE_SIZE = 25
+    # Coalesces concurrent loads of the same roles (see from_db, get_all).
+    LOADS = SingleFlight('roles')
+    # The shared database resource (see meerkat_auth.db).
+    DB = db.Database('roles')
 
     """
     Class to model a single access Role object and includes functions to handle
@@ -107,6 +111,7 @@ class Role:
 
         # Return the response.
         logging.info("Response from database:\n" + str(response))
+        Role.invalidate_graph([(self.country, self.role)])
         return response
 
     def all_access_objs(self):
@@ -124,9 +129,13 @@ class Role:
 
         def get_parents(role_obj):
             parents = [role_obj]
-            for parent in role_obj.parents:
-                    parent_obj = Role.from_db(self.country, parent)
-                    parents += get_parents(parent_obj)
+            # Load the parents at once, then their parents and so on.
+            parent_objs = db.fan_out(
+                lambda parent: Role.from_db(self.country, parent),
+                role_obj.parents
+            )
+            for parent_obj in parent_objs:
+                parents += get_parents(parent_obj)
             return parents
 
         # Remove duplicates but maintain order.
@@ -166,12 +175,11 @@ class Role:
             'Loading role "' + role + '" for ' + country + ' from database.'
         )
         roles = Role.DB.Table(app.config['ROLES'])
-        response = roles.get_item(
-            Key={
-                'country': country,
-                'role': role
-            }
+        response = Role.LOADS.do(
+            ('role', country, role),
+            lambda: roles.get_item(Key={'country': country, 'role': role})
         )
+        response = copy.deepcopy(response)  # The response may be shared.
         # Build and return object
         logging.info('Response from database:\n' + str(response))
         if not response.get('Item', None):
@@ -192,15 +200,33 @@ class Role:
             return role
 
     @staticmethod
-    def delete(country, role):
+    def delete(country, role, force=False):
         """
-        Static method that deletes account data corresponding to the given
-        username from the database table specified by config['USERS'].
+        Static method that deletes the given role from the database table
+        specified by config['ROLES']. Deleting a role that other roles
+        inherit from would break their ancestor lists, so this is refused
+        unless forced.
+
         Args:
-            username (str)
+            country (str) The country the role belongs to.
+            role (str) The title of the role.
+            force (bool) Delete the role even if other roles inherit from it.
         Returns:
             The amazon dynamodb response.
+        Raises:
+            InvalidRoleException if other roles inherit from the role, and
+                force is not set.
         """
+        if not force:
+            # Imported here because role_graph depends upon this module.
+            from meerkat_auth.role_graph import RoleGraph
+            graph = RoleGraph.from_db([country])
+            descendants = graph.descendants(country, role)
+            if descendants:
+                raise InvalidRoleException(country, role, (
+                    "Roles {} inherit from this role, and would lose the "
+                    "access of roles {}."
+                ).format(descendants, graph.inheritors(country, role)[1:]))
         logging.info('Deleting role ' + role + ' in ' + country)
         roles = Role.DB.Table(app.config['ROLES'])
         response = roles.delete_item(
@@ -210,8 +236,115 @@ class Role:
             }
         )
         logging.info("Response from database:\n" + str(response))
+        Role.invalidate_graph([(country, role)])
         return response
 
+    @staticmethod
+    def batch_write(roles, deletes=[], max_retries=8):
+        """
+        Writes and deletes many roles in the database table specified by
+        config['ROLES'] using as few BatchWriteItem requests as possible,
+        retrying unprocessed items with exponential backoff. Chunks are sent
+        in order, so if roles are given in topological order (see
+        RoleGraph.topological_order()) no role is written before its parents.
+        Unlike to_db() the roles are not validated, so callers must validate
+        the complete graph first (see RoleGraph.validate()).
+
+        Args:
+            roles ([Role]) The roles to write.
+            deletes ([(str, str)]) The (country, role) keys to delete.
+            max_retries (int) The number of times to retry unprocessed items.
+
+        Returns:
+            [(str, str)] The (country, role) keys that couldn't be written or
+            deleted.
+        """
+        table_name = app.config['ROLES']
+        requests = [{'PutRequest': {'Item': {
+            'country': r.country,
+            'role': r.role,
+            'description': r.description,
+            'parents': r.parents,
+            'visible': r.visible
+        }}} for r in roles]
+        requests += [{'DeleteRequest': {'Key': {
+            'country': country, 'role': role
+        }}} for country, role in deletes]
+        logging.info('Batch writing {} roles.'.format(len(requests)))
+
+        failed = []
+        for i in range(0, len(requests), Role.BATCH_WRITE_SIZE):
+            request_items = {
+                table_name: requests[i:i + Role.BATCH_WRITE_SIZE]
+            }
+            retries = 0
+            while request_items:
+                response = Role.DB.batch_write_item(RequestItems=request_items)
+                request_items = response.get('UnprocessedItems', {})
+                # Back off exponentially if DynamoDB is throttling us.
+                if request_items:
+                    if retries == max_retries:
+                        failed += request_items[table_name]
+                        break
+                    time.sleep(min(0.05 * 2 ** retries, 1))
+                    retries += 1
+
+        Role.invalidate_graph(
+            [(r.country, r.role) for r in roles] + list(deletes)
+        )
+        failed = [r.get('PutRequest', {}).get('Item') or
+                  r['DeleteRequest']['Key'] for r in failed]
+        return [(f['country'], f['role']) for f in failed]
+
+    @staticmethod
+    def holders(country, role, inherited=True):
+        """
+        Returns the users that have a role's access, using the reverse role
+        index rather than scanning the users.
+
+        Args:
+            country (str) The country the role belongs to.
+            role (str) The title of the role.
+            inherited (bool) If true, include the users that inherit the role
+                from another role they hold, as well as its direct holders.
+
+        Returns:
+            [str] The sorted usernames.
+        """
+        # Imported here because role_graph depends upon this module.
+        from meerkat_auth.role_graph import RoleGraph
+        return RoleIndex.holders(country, role, RoleGraph.cached(), inherited)
+
+    @staticmethod
+    def invalidate_graph(changed=()):
+        """
+        Discards the cached role graph after roles have been written, so the
+        change takes effect immediately in this process. The materialised
+        access of the users holding the changed roles is then refreshed, in
+        a background thread if config['ACCESS_REFRESH_ASYNC'] is set.
+
+        Args:
+            changed ([(str, str)]) The (country, role) keys of the roles
+                written or deleted.
+        """
+        # Imported here because these modules depend upon this module.
+        from meerkat_auth.role_graph import RoleGraph
+        from meerkat_auth.user import User
+        RoleGraph.invalidate()
+        if not changed:
+            return
+
+        def refresh():
+            try:
+                User.refresh_role_holders(changed)
+            except Exception as e:
+                logging.warning('Failed to refresh access: ' + repr(e))
+
+        if app.config['ACCESS_REFRESH_ASYNC']:
+            threading.Thread(target=refresh, daemon=True).start()
+        else:
+            refresh()
+
     @staticmethod
     def validate_role(country, role):
         """
@@ -233,7 +366,7 @@ class Role:
         obj.all_access_objs()
 
     @staticmethod
-    def get_all(countries):
+    def get_all(countries, consistent=False):
         """
         Fetches from the database the requested all roles that belong to the
         specified country.
@@ -241,6 +374,10 @@ class Role:
 
         Args:
             countries ([str]) A list of countries for which we want the roles.
+            consistent (bool) If true, use strongly consistent reads, so that
+                every role written before the call is read as written. Such
+                loads aren't shared with concurrent loads, which may have
+                started before the write.
         Returns:
             A list where each element is a python dictionary detailing a single
             role.
@@ -260,23 +397,48 @@ class Role:
         if not isinstance(countries, list):
             countries = [countries]
 
-        if not countries:
-            # If no country is specified, get all roles and return as list.
-            return table.scan().get("Items", [])
+        def load():
+            if not countries:
+                # If no country is specified, get all roles and return as list.
+                return Role._all_pages(table.scan, ConsistentRead=consistent)
+
+            else:
+                # Load each country separately because can't query for OR,
+                # but query them all at once.
+                def query(country):
+                    return Role._all_pages(
+                        table.query,
+                        KeyConditions={
+                            'country': {
+                                'AttributeValueList': [country],
+                                'ComparisonOperator': 'EQ'
+                            }
+                        },
+                        ConsistentRead=consistent
+                    )
+                pages = db.fan_out(query, countries)
+                return [role for page in pages for role in page]
+
+        if consistent:
+            return load()
+
+        # Share the load with any concurrent loads of the same countries.
+        roles = Role.LOADS.do(('all', tuple(countries)), load)
+        return copy.deepcopy(roles)  # The loaded roles may be shared.
 
-        else:
-            roles = []
-            # Load data separately for each country because can't query for OR.
-            for country in countries:
-                roles = roles + table.query(
-                    KeyConditions={
-                        'country': {
-                            'AttributeValueList': [country],
-                            'ComparisonOperator': 'EQ'
-                        }
-                    }
-                ).get("Items", [])
-            return roles
+    @staticmethod
+    def _all_pages(operation, **kwargs):
+        """
+        Calls a DynamoDB scan or query operation repeatedly until every page
+        of results has been read, and returns all of the items.
+        """
+        response = operation(**kwargs)
+        items = response.get("Items", [])
+        while response.get("LastEvaluatedKey"):
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+            response = operation(**kwargs)
+            items += response.get("Items", [])
+        return items
 
 
 class InvalidRoleException(Exception):
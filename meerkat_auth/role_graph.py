@@ -0,0 +1,464 @@
+"""
+role_graph.py
+
+An in-memory model of the access role network for one or more countries. The
+Role class walks the database one role at a time, which is fine for a single
+role, but costly when we need the complete access of many users. A RoleGraph
+loads all the roles for the countries concerned in one go and computes each
+role's complete access list once, so it can be shared across users.
+"""
+from meerkat_auth.role import Role, InvalidRoleException
+from meerkat_auth.cache import TTLCache
+from meerkat_auth import app
+import hashlib
+import logging
+import json
+
+
+class RoleGraph:
+    """
+    Class to model the complete set of access roles for some countries, and
+    compute the access inherited by each role without further database reads.
+    """
+
+    # Cache of the complete graph for all countries (see RoleGraph.cached()).
+    CACHE = TTLCache(maxsize=1)
+
+    def __init__(self, roles):
+        """
+        Create a RoleGraph object.
+
+        Args:
+            roles ([dict] or [Role]) The roles making up the graph, either as
+                Role objects or as role dictionaries like those returned by
+                Role.get_all().
+        """
+        self.roles = {}
+        for role in roles:
+            if not isinstance(role, Role):
+                role = Role(
+                    role['country'],
+                    role['role'],
+                    role.get('description', ''),
+                    role.get('parents', []),
+                    visible=role.get('visible', [])
+                )
+            self.roles.setdefault(role.country, {})[role.role] = role
+
+        # Complete access lists, computed lazily and indexed by (country, role)
+        self._access = {}
+        # Sets of the roles inheriting from each role, computed lazily from
+        # the access lists for a whole country at once, indexed by country.
+        self._descendants = {}
+        # The roles visible to users, computed lazily and indexed by
+        # (country, access signature). See visible_roles().
+        self._visible = {}
+
+        # A digest of everything that determines access, so that anything
+        # derived from the graph can be cached against the graph's version.
+        content = sorted(
+            (r.country, r.role, list(r.parents), list(r.visible))
+            for country in self.roles.values() for r in country.values()
+        )
+        self.version = hashlib.sha1(
+            json.dumps(content).encode('utf-8')
+        ).hexdigest()
+
+    def __repr__(self):
+        """
+        Override to create a better string representation of a RoleGraph.
+        """
+        return '<{}: {}>'.format(
+            self.__class__.__name__,
+            ', '.join(
+                '{}({})'.format(c, len(r)) for c, r in self.roles.items()
+            )
+        )
+
+    def countries(self):
+        """Returns a list of the countries in the graph."""
+        return list(self.roles.keys())
+
+    def get(self, country, role):
+        """
+        Returns the Role object for the given country and role title.
+
+        Args:
+            country (str) The country the role belongs to.
+            role (str) The title of the role.
+
+        Returns:
+            The Role object.
+
+        Raises:
+            InvalidRoleException if the role isn't in the graph.
+        """
+        try:
+            return self.roles[country][role]
+        except KeyError:
+            raise InvalidRoleException(
+                country, role, "Role not found in the database."
+            )
+
+    def all_access(self, country, role):
+        """
+        Returns the complete access list for a role i.e. the title of the role
+        and the titles of all the roles it inherits from. The list is ordered
+        exactly as Role.all_access() orders it.
+
+        Args:
+            country (str) The country the role belongs to.
+            role (str) The title of the role.
+
+        Returns:
+            List of ancestor role title strings, including the role itself.
+
+        Raises:
+            InvalidRoleException if an ancestor is missing, or if the role
+                inherits from itself.
+        """
+        return list(self._all_access(country, role, ()))
+
+    def _all_access(self, country, role, path):
+        key = (country, role)
+        if key not in self._access:
+            if role in path:
+                raise InvalidRoleException(
+                    country, role, "Role inherits access from itself."
+                )
+            access = [role]
+            for parent in self.get(country, role).parents:
+                for title in self._all_access(country, parent, path + (role,)):
+                    if title not in access:
+                        access.append(title)
+            self._access[key] = access
+        return self._access[key]
+
+    def children(self, country, role):
+        """
+        Returns the titles of the roles that inherit directly from a role,
+        i.e. that list it as a parent.
+
+        Args:
+            country (str) The country the role belongs to.
+            role (str) The title of the role.
+
+        Returns:
+            [str] The sorted role titles.
+        """
+        return sorted(
+            title for title, r in self.roles.get(country, {}).items()
+            if role in r.parents
+        )
+
+    def descendants(self, country, role):
+        """
+        Returns the titles of every role that inherits access from a role,
+        directly or through other roles: the reverse of all_access(). The
+        descendant sets for a country are computed from the reverse parent
+        edges, once for every role in the country. A role is included even if
+        some of its other ancestors are missing, since it would still lose
+        the access inherited from this role.
+
+        Args:
+            country (str) The country the role belongs to.
+            role (str) The title of the role.
+
+        Returns:
+            [str] The sorted role titles, not including the role itself.
+        """
+        if country not in self._descendants:
+            children = {}
+            for title, r in self.roles.get(country, {}).items():
+                for parent in r.parents:
+                    children.setdefault(parent, set()).add(title)
+            descendants = {}
+            for ancestor in children:
+                found = set()
+                stack = list(children[ancestor])
+                while stack:
+                    title = stack.pop()
+                    if title not in found:
+                        found.add(title)
+                        stack.extend(children.get(title, ()))
+                found.discard(ancestor)
+                descendants[ancestor] = found
+            self._descendants[country] = descendants
+        return sorted(self._descendants[country].get(role, ()))
+
+    def inheritors(self, country, role):
+        """
+        Returns the titles of every role that has the given role's access,
+        i.e. the role itself and every role that inherits from it. Roles with
+        broken ancestor lists are left out.
+
+        Args:
+            country (str) The country the role belongs to.
+            role (str) The title of the role.
+
+        Returns:
+            [str] The role titles, starting with the given role.
+        """
+        return [role] + self.descendants(country, role)
+
+    def get_access(self, countries, roles):
+        """
+        Returns the complete access for an account holding the given roles,
+        in the same form as User.get_access().
+
+        Args:
+            countries ([str]) The country for each role in roles.
+            roles ([str]) The role titles.
+
+        Returns:
+            A dictionary where each key is a country and each value is a list
+            of roles the account has access to in that country.
+        """
+        access = {}
+        for country, role in zip(countries, roles):
+            access.setdefault(country, []).extend(
+                self.all_access(country, role)
+            )
+        return access
+
+    def validate(self):
+        """
+        Checks the whole graph in a single pass, without any database reads:
+        every parent and every role required to see a role must exist in the
+        same country, and no role may inherit access from itself.
+
+        Returns:
+            [InvalidRoleException] Every problem found. Empty if valid.
+        """
+        problems = []
+        for country, roles in sorted(self.roles.items()):
+            for title, role in sorted(roles.items()):
+                for parent in role.parents:
+                    if parent not in roles:
+                        problems.append(InvalidRoleException(
+                            country, title,
+                            "Parent role '{}' not found.".format(parent)
+                        ))
+                for required in role.visible:
+                    if required not in roles:
+                        problems.append(InvalidRoleException(
+                            country, title,
+                            "Visibility role '{}' not found.".format(required)
+                        ))
+        for country, title in self._cycles():
+            problems.append(InvalidRoleException(
+                country, title, "Role inherits access from itself."
+            ))
+        return problems
+
+    def _cycles(self):
+        """
+        Returns (country, role) for one role on each inheritance cycle, using
+        an iterative depth first search that visits each role once.
+        """
+        cycles = []
+        for country, roles in sorted(self.roles.items()):
+            state = {}  # Title: 1 while on the search path, 2 when finished.
+            for start in sorted(roles):
+                if start in state:
+                    continue
+                stack = [(start, iter(roles[start].parents))]
+                state[start] = 1
+                while stack:
+                    title, parents = stack[-1]
+                    parent = next(parents, None)
+                    if parent is None:
+                        state[title] = 2
+                        stack.pop()
+                    elif parent not in roles:
+                        continue
+                    elif state.get(parent) == 1:
+                        cycles.append((country, parent))
+                    elif parent not in state:
+                        state[parent] = 1
+                        stack.append((parent, iter(roles[parent].parents)))
+        return cycles
+
+    def topological_order(self):
+        """
+        Returns every Role in the graph ordered so that each role comes after
+        all of its parents, e.g. for writing a graph to the database so that
+        readers never see a role whose parents don't exist yet. Roles on a
+        cycle or with missing parents are left out, so validate() first.
+
+        Returns:
+            [Role] The ordered roles.
+        """
+        ordered = []
+        for country, roles in sorted(self.roles.items()):
+            waiting = {
+                title: len([p for p in set(role.parents) if p in roles])
+                for title, role in roles.items()
+            }
+            children = {}
+            for title, role in roles.items():
+                for parent in set(role.parents):
+                    children.setdefault(parent, []).append(title)
+            ready = sorted(t for t, count in waiting.items() if count == 0)
+            while ready:
+                title = ready.pop(0)
+                if any(p not in roles for p in roles[title].parents):
+                    continue
+                ordered.append(roles[title])
+                for child in sorted(children.get(title, [])):
+                    waiting[child] -= 1
+                    if waiting[child] == 0:
+                        ready.append(child)
+        return ordered
+
+    def to_list(self):
+        """
+        Returns every role in the graph as a dictionary like those returned
+        by Role.get_all(), ordered by country and then topologically.
+        """
+        return [RoleGraph._as_dict(r) for r in self.topological_order()]
+
+    @staticmethod
+    def _as_dict(role):
+        """A role as a dictionary like those returned by Role.get_all()."""
+        return {
+            'country': role.country,
+            'role': role.role,
+            'description': role.description,
+            'parents': list(role.parents),
+            'visible': list(role.visible)
+        }
+
+    def visible_roles(self, country, access):
+        """
+        Returns the roles of a country that a user may see, i.e. those whose
+        'visible' requirements are all among the user's access roles. The
+        result is computed once for each distinct access signature and reused,
+        since many users share the same access.
+
+        Args:
+            country (str) The country whose roles we want.
+            access ([str]) The user's access roles in that country.
+
+        Returns:
+            [dict] The visible roles as dictionaries like those returned by
+            Role.get_all(), ordered by title.
+        """
+        key = (country, tuple(sorted(set(access))))
+        if key not in self._visible:
+            held = set(key[1])
+            self._visible[key] = [
+                RoleGraph._as_dict(r)
+                for title, r in sorted(self.roles.get(country, {}).items())
+                if held.issuperset(r.visible)
+            ]
+        return self._visible[key]
+
+    def closures(self, countries=None):
+        """
+        Returns every role in the graph with its complete access list, so
+        that a client can resolve any role's access without further requests.
+
+        Args:
+            countries ([str]) Only include these countries. If this equates to
+                false every country is included.
+
+        Returns:
+            A dictionary of countries, each a dictionary of role dictionaries
+            like those returned by Role.get_all(), indexed by role title. Each
+            role also has its complete access list in 'access', or an 'error'
+            message and an empty access list if its ancestors are broken.
+        """
+        closures = {}
+        for country, roles in self.roles.items():
+            if countries and country not in countries:
+                continue
+            closures[country] = {}
+            for title, r in roles.items():
+                role = RoleGraph._as_dict(r)
+                try:
+                    role['access'] = self.all_access(country, title)
+                except InvalidRoleException as e:
+                    role['access'] = []
+                    role['error'] = str(e)
+                closures[country][title] = role
+        return closures
+
+    def diff(self, other):
+        """
+        Compares this graph to another, e.g. a proposed graph to the current
+        one.
+
+        Args:
+            other (RoleGraph) The graph to compare against.
+
+        Returns:
+            A dictionary with lists of the (country, role) keys 'added' in this
+            graph, 'removed' from this graph and 'changed' between the graphs.
+        """
+        def content(role):
+            return (role.description, list(role.parents), list(role.visible))
+
+        mine = {
+            (c, t): r for c, roles in self.roles.items()
+            for t, r in roles.items()
+        }
+        theirs = {
+            (c, t): r for c, roles in other.roles.items()
+            for t, r in roles.items()
+        }
+        return {
+            'added': sorted(k for k in mine if k not in theirs),
+            'removed': sorted(k for k in theirs if k not in mine),
+            'changed': sorted(
+                k for k in mine
+                if k in theirs and content(mine[k]) != content(theirs[k])
+            )
+        }
+
+    @staticmethod
+    def from_db(countries, consistent=False):
+        """
+        Loads the graph for the specified countries from the database table
+        specified by config['ROLES'].
+
+        Args:
+            countries ([str]) The countries to load. If this equates to false
+                the roles for all countries are loaded.
+            consistent (bool) If true, use strongly consistent reads, e.g. to
+                load roles that have only just been written.
+
+        Returns:
+            The RoleGraph object.
+        """
+        logging.info('Loading role graph for ' + str(countries))
+        return RoleGraph(Role.get_all(countries, consistent))
+
+    @staticmethod
+    def cached():
+        """
+        Returns the graph for all countries, loading it from the database only
+        if the cached graph is older than config['ROLE_GRAPH_TTL'] seconds.
+        Roles change rarely, so this lets per request access calculations
+        avoid the database entirely. Role writes made by this process
+        invalidate the cache immediately.
+
+        Once expired, the last graph loaded is still served for up to
+        config['ROLE_GRAPH_STALE_TTL'] seconds while it is reloaded in the
+        background, so a slow or throttled roles table doesn't hold up
+        requests.
+
+        Returns:
+            The RoleGraph object.
+        """
+        return RoleGraph.CACHE.get_or_revalidate(
+            'graph',
+            lambda: RoleGraph.from_db(None),
+            app.config['ROLE_GRAPH_TTL'],
+            app.config['ROLE_GRAPH_STALE_TTL']
+        )
+
+    @staticmethod
+    def invalidate():
+        """Discards the cached graph so the next request reloads it."""
+        RoleGraph.CACHE.clear()
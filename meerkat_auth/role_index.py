@@ -0,0 +1,155 @@
+"""
+role_index.py
+
+A reverse index from access roles to the users that hold them, so that
+questions like "who has jordan emails access?" are answered with a keyed
+query rather than by scanning every user and computing their access.
+
+The index, held in the database table specified by config['ROLE_INDEX'],
+only records the users holding each role directly. It is kept up to date on
+every write of a user's roles. Users that inherit a role are found by looking
+up the holders of each role that inherits from it in the role graph, so role
+edits take effect without rewriting the index.
+"""
+from boto3.dynamodb.conditions import Key
+from meerkat_auth import app, db
+import logging
+
+
+class RoleIndex:
+    """
+    Class to maintain and query the reverse index of role holders.
+    """
+
+    # The shared database resource (see meerkat_auth.db).
+    DB = db.Database('role_index')
+
+    @staticmethod
+    def _key(country, role):
+        """The index key for a role."""
+        return '{}:{}'.format(country, role)
+
+    @staticmethod
+    def update(username, old_access, new_access):
+        """
+        Updates the index after a user's roles have changed. Failures are
+        logged rather than raised, so the user's own write still succeeds;
+        the index can be repaired with rebuild().
+
+        Args:
+            username (str) The user.
+            old_access ([(str, str)]) The (country, role) pairs held before.
+            new_access ([(str, str)]) The (country, role) pairs held now.
+        """
+        old_access = set(map(tuple, old_access))
+        new_access = set(map(tuple, new_access))
+        if old_access == new_access:
+            return
+        try:
+            table = RoleIndex.DB.Table(app.config['ROLE_INDEX'])
+            with table.batch_writer() as batch:
+                for pair in old_access - new_access:
+                    batch.delete_item(Key={
+                        'role_key': RoleIndex._key(*pair),
+                        'username': username
+                    })
+                for pair in new_access - old_access:
+                    batch.put_item(Item={
+                        'role_key': RoleIndex._key(*pair),
+                        'username': username
+                    })
+        except Exception as e:
+            logging.warning(
+                'Failed to update role index for ' + username + ': ' + repr(e)
+            )
+
+    @staticmethod
+    def direct_holders(country, role):
+        """
+        Returns the users holding a role directly, with one database query.
+
+        Args:
+            country (str) The country the role belongs to.
+            role (str) The title of the role.
+
+        Returns:
+            [str] The usernames, in order.
+        """
+        table = RoleIndex.DB.Table(app.config['ROLE_INDEX'])
+        kwargs = {
+            'KeyConditionExpression': (
+                Key('role_key').eq(RoleIndex._key(country, role))
+            ),
+            'ProjectionExpression': 'username'
+        }
+        response = table.query(**kwargs)
+        usernames = [i['username'] for i in response.get('Items', [])]
+        while response.get('LastEvaluatedKey'):
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+            response = table.query(**kwargs)
+            usernames += [i['username'] for i in response.get('Items', [])]
+        return usernames
+
+    @staticmethod
+    def holders(country, role, graph, inherited=True):
+        """
+        Returns the users that have a role's access.
+
+        Args:
+            country (str) The country the role belongs to.
+            role (str) The title of the role.
+            graph (RoleGraph) The role graph for the country.
+            inherited (bool) If true, include the users that inherit the role
+                from another role they hold, as well as its direct holders.
+
+        Returns:
+            [str] The sorted usernames.
+        """
+        roles = [role]
+        if inherited:
+            roles = graph.inheritors(country, role)
+        usernames = set()
+        holders = db.fan_out(
+            lambda title: RoleIndex.direct_holders(country, title), roles
+        )
+        for held in holders:
+            usernames.update(held)
+        return sorted(usernames)
+
+    @staticmethod
+    def rebuild(users):
+        """
+        Rewrites the whole index, e.g. to fill it for the first time.
+
+        Args:
+            users (iterable) User dictionaries, each with 'username',
+                'countries' and 'roles' properties, e.g. from User.get_all().
+
+        Returns:
+            int The number of index entries written.
+        """
+        table = RoleIndex.DB.Table(app.config['ROLE_INDEX'])
+        response = table.scan(ProjectionExpression='role_key, username')
+        stale = response.get('Items', [])
+        while response.get('LastEvaluatedKey'):
+            response = table.scan(
+                ProjectionExpression='role_key, username',
+                ExclusiveStartKey=response['LastEvaluatedKey']
+            )
+            stale += response.get('Items', [])
+
+        entries = set()
+        for user in users:
+            for pair in zip(user['countries'], user['roles']):
+                entries.add((RoleIndex._key(*pair), user['username']))
+
+        with table.batch_writer() as batch:
+            for item in stale:
+                if (item['role_key'], item['username']) not in entries:
+                    batch.delete_item(Key=item)
+            for role_key, username in entries:
+                batch.put_item(Item={
+                    'role_key': role_key, 'username': username
+                })
+        logging.info('Rebuilt role index of {} entries.'.format(len(entries)))
+        return len(entries)
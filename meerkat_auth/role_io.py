@@ -0,0 +1,160 @@
+"""
+role_io.py
+
+Bulk import and export of access role networks as JSON or YAML. Writing roles
+one at a time with Role.to_db() validates each role by walking its ancestors
+in the database, so the roles must be written parents first, and loading a
+whole country takes many round trips. Here the complete proposed graph is
+instead validated in memory in one pass, compared with the current graph,
+and then written in topological order with batch writes.
+
+YAML support needs the optional PyYAML package.
+"""
+from meerkat_auth.role import Role
+from meerkat_auth.role_graph import RoleGraph
+import logging
+import json
+
+# The supported formats and their mimetypes.
+FORMATS = {
+    'json': 'application/json',
+    'yaml': 'application/x-yaml'
+}
+
+
+def _yaml():
+    """Imports PyYAML only when it is needed, as it is optional."""
+    try:
+        import yaml
+    except ImportError:
+        raise ValueError('YAML support needs the PyYAML package installed.')
+    return yaml
+
+
+def dump(roles, format):
+    """
+    Serialises role dictionaries, e.g. as given by RoleGraph.to_list().
+
+    Args:
+        roles ([dict]) The roles.
+        format (str) One of FORMATS.
+
+    Returns:
+        str The serialised roles.
+    """
+    if format == 'json':
+        return json.dumps(roles, indent=2)
+    if format == 'yaml':
+        return _yaml().safe_dump(roles, sort_keys=False)
+    raise ValueError('Role format must be one of ' + ', '.join(FORMATS))
+
+
+def load(text, format):
+    """
+    Parses a list of roles, each with a 'country' and 'role' and optionally
+    a 'description', 'parents' and 'visible' list.
+
+    Args:
+        text (str) The serialised roles.
+        format (str) One of FORMATS.
+
+    Returns:
+        [dict] The roles.
+
+    Raises:
+        ValueError if the text isn't a valid list of roles.
+    """
+    if format == 'json':
+        roles = json.loads(text)
+    elif format == 'yaml':
+        roles = _yaml().safe_load(text)
+    else:
+        raise ValueError('Role format must be one of ' + ', '.join(FORMATS))
+
+    if not isinstance(roles, list):
+        raise ValueError('Roles must be given as a list.')
+    for role in roles:
+        if not isinstance(role, dict) or not role.get('country') or \
+                not role.get('role'):
+            raise ValueError('Each role needs a country and a role title.')
+        for attribute in ['parents', 'visible']:
+            if not isinstance(role.get(attribute, []), list):
+                raise ValueError('Role {} must be a list.'.format(attribute))
+    return roles
+
+
+def export_roles(countries):
+    """
+    Returns the complete role graph for the given countries, each role as a
+    dictionary, ordered so that each role comes after its parents.
+
+    Args:
+        countries ([str]) The countries to export. If this equates to false
+            every country is exported.
+    """
+    return RoleGraph.from_db(countries).to_list()
+
+
+def import_roles(roles, replace=False, dry_run=False):
+    """
+    Creates and updates many roles at once. The roles are merged into the
+    current graph for their countries, and the resulting graph is checked as
+    a whole before anything is written. Nothing is written if the graph
+    isn't valid.
+
+    Args:
+        roles ([dict] or [Role]) The roles to create or update.
+        replace (bool) If true, the roles given are the complete graph for
+            their countries, and any other roles in those countries are
+            deleted.
+        dry_run (bool) If true, just validate and compare the graphs.
+
+    Returns:
+        A dictionary with the validation error messages in 'errors', the
+        (country, role) keys 'added', 'changed' and 'removed' in 'diff', and
+        'written' set if the changes were written. Any keys that couldn't be
+        written are listed in 'failed'.
+    """
+    proposed = RoleGraph(roles)
+    countries = sorted(proposed.countries())
+    current = RoleGraph.from_db(countries) if countries else RoleGraph([])
+
+    errors = []
+    seen = set()
+    for role in roles:
+        if isinstance(role, Role):
+            key = (role.country, role.role)
+        else:
+            key = (role['country'], role['role'])
+        if key in seen:
+            errors.append(
+                "Role '{}' is given twice for '{}'.".format(key[1], key[0])
+            )
+        seen.add(key)
+
+    # Merge the given roles into the current graph, unless replacing it.
+    if not replace:
+        merged = [
+            r for c in current.roles.values() for r in c.values()
+            if (r.country, r.role) not in seen
+        ]
+        proposed = RoleGraph(merged + [
+            r for c in proposed.roles.values() for r in c.values()
+        ])
+
+    errors += [str(e) for e in proposed.validate()]
+    diff = proposed.diff(current)
+    result = {'errors': errors, 'diff': diff, 'written': False, 'failed': []}
+    if errors or dry_run:
+        return result
+
+    # Write parents before children, then remove any roles being replaced.
+    changed = set(diff['added'] + diff['changed'])
+    writes = [
+        r for r in proposed.topological_order()
+        if (r.country, r.role) in changed
+    ]
+    result['failed'] = Role.batch_write(writes, deletes=diff['removed'])
+    result['written'] = True
+    logging.info('Imported roles: ' + str(diff))
+    return result
@@ -1,7 +1,11 @@
 function drawVis(country){
-    $.getJSON( root + '/en/roles/get_roles/'+country, function(data){
+    //One request gets every role in the country with its complete access.
+    $.getJSON( root + '/en/roles/graph?country=' + country, function(graph){
 
-        data = data.roles;
+        var graphRoles = graph.countries[country] || {};
+        var data = Object.keys(graphRoles).map( function( title ){
+            return graphRoles[title];
+        });
         console.log( 'Drawing vis');
         console.log( data );
 
@@ -68,49 +72,45 @@ function drawVis(country){
 
             //Conveniently the id is just the index of the level in the data object.
             var selected = data[params.nodes[0]];
-            var url = root + '/en/roles/get_all_access/' + selected.country + '/' + selected.role;
-            
+            if( !selected ) return;
+
             console.log( selected );
             console.log( selected.description.trim() || "(No Description)" );
 
-            //Get the selected access levels complete access list from the server.
-            $.getJSON( url, function(all_access){
-
-                //Get the complete role objects for the specified role's access list.
-                var roles = [];
-                all_access.access.map( function( level ){
-                    if( level != selected.role ) roles.push( getObj( data, 'role', level )[0] );
-                });
+            //Get the complete role objects for the specified role's access list.
+            var roles = [];
+            selected.access.map( function( level ){
+                var role = getObj( data, 'role', level )[0];
+                if( level != selected.role && role ) roles.push( role );
+            });
 
-                //Now we have all the data, we can start displaying it. 
-                var html = "<table class='selected col-xs-12 col-md-8 col-md-offset-2'>" +
-                           "<tbody class='selected-level'>"+
-                           "<tr><td colspan=2><label>Selected access level:</label></td></tr>" +
-                           "<tr class='level'><td class='level__title col-xs-6 col-sm-3 col-md-2'><div>" +
-                           caps(selected.role) + "</div></td>" + 
-                           "<td class='level__description no-pad col-xs-6 col-sm-9 col-md-10'><div>" +
-                           (selected.description.trim() || "(No Description)") + "</div></td></tr></tbody>";
-
-                if( roles.length > 0 ){
-                    html += "<tr><td colspan=2><label>Also inherits access levels:</label></td></tr>" +
-                            "<tbody class='inherits'>";
-                    for( var r in roles ){
-                        html += "<tr class='level'><td class='level__title col-xs-6 col-sm-3 col-md-2'><div>" +
-                                caps(roles[r].role) + "</div></td>" + 
-                                "<td class='level__description no-pad col-xs-6 col-sm-9 col-md-10'><div>" +
-                                (roles[r].description.trim() || "(No Description)") + 
-                                "</div></td></tr>";                    
-                    }
-                }else{
-                    html += "<tr><td colspan=2><label>Doesn't inherit any other access.</label></td></tr>" +
-                            "<tbody class='inherits'>";  
+            //Now we have all the data, we can start displaying it. 
+            var html = "<table class='selected col-xs-12 col-md-8 col-md-offset-2'>" +
+                       "<tbody class='selected-level'>"+
+                       "<tr><td colspan=2><label>Selected access level:</label></td></tr>" +
+                       "<tr class='level'><td class='level__title col-xs-6 col-sm-3 col-md-2'><div>" +
+                       caps(selected.role) + "</div></td>" + 
+                       "<td class='level__description no-pad col-xs-6 col-sm-9 col-md-10'><div>" +
+                       (selected.description.trim() || "(No Description)") + "</div></td></tr></tbody>";
+
+            if( roles.length > 0 ){
+                html += "<tr><td colspan=2><label>Also inherits access levels:</label></td></tr>" +
+                        "<tbody class='inherits'>";
+                for( var r in roles ){
+                    html += "<tr class='level'><td class='level__title col-xs-6 col-sm-3 col-md-2'><div>" +
+                            caps(roles[r].role) + "</div></td>" + 
+                            "<td class='level__description no-pad col-xs-6 col-sm-9 col-md-10'><div>" +
+                            (roles[r].description.trim() || "(No Description)") + 
+                            "</div></td></tr>";                    
                 }
-                html += "</tbody></table>";
-
-                //Draw!
-                $('.selection-details').html(html);
+            }else{
+                html += "<tr><td colspan=2><label>Doesn't inherit any other access.</label></td></tr>" +
+                        "<tbody class='inherits'>";  
+            }
+            html += "</tbody></table>";
 
-            });
+            //Draw!
+            $('.selection-details').html(html);
         });
     });
 }
@@ -38,18 +38,9 @@ function drawUserTable(){
             'title': i18n.gettext('Account Creation'),
             'align': "left",
             'class': "header",
-            'sortable': false,
+            'sortable': true,
             'visible': true,
             'width': "25%"
-        },{
-            'field': "data",
-            'title': i18n.gettext('Data'),
-            'align': "left",
-            'class': "header",
-            'sortable': false,
-            'visible': false,
-            'searchable': true,
-            'width': "25%"
         }
     ];
 
@@ -66,33 +57,21 @@ function drawUserTable(){
             }
             row.access = access.slice(0, -3);
 
-            //Format the user data to make it searchable (but not visible)
-            data = "";
-            if( typeof(row.data) != "object" ){
-                console.error("Bad user data - not an object.");
-                row.data = {};
-            }
-            var keys = Object.keys( row.data );
-            for(var c in keys){
-                var element = row.data[keys[c]];
-                var val = element.val || element.value || "";
-                data += caps(keys[c]) + ": " + caps( val ) + " | ";
-            }
-            row.data = data.slice(0,-3);
-
             //TODO: Format the creation time stamp to make it more readable.
         }
-        return res.rows;
+        return res;
     }
 
     var tmp = root + '/en/users/get_users';
     console.log( "tmp: " + tmp );
 
     //Creat the bootstrap table.
+    //Paging, sorting and searching are done by the server, one page at a time.
     table = $('#user-table table').bootstrapTable({
         columns: columns,
         classes: 'table table-no-bordered table-hover',
         pagination: true,
+        sidePagination: 'server',
         pageSize: 20,
         search: true,
         url: tmp,
@@ -141,7 +120,7 @@ function drawUserTable(){
                     url: root + '/en/users/delete_users',
                     type: 'post',
                     success: function (data) {
-                        alert(data);
+                        alert(data.message);
                         $('#user-table table').bootstrapTable('refresh');
                         drawUserEditor("");
                     },
@@ -285,25 +264,20 @@ function drawUserEditor(username){
         }
 
         //Add tooltips that tell the user what access each role inherits.
+        //The role graph is fetched once, and each tooltip resolved from it.
         function createTooltips(){
-            $('select.role option').each( function(){
-                console.log( this );
-                var country = $('select.country').val();
-                var role = $(this).attr('value');
-                var element = $(this);
-                console.log( "Country: " + country + " Role: " + role );
-                $.getJSON( root + '/en/roles/get_all_access/' + country +'/' + role, function(data){
+            getRoleGraph( function(graph){
+                $('select.role option').each( function(){
+                    var country = $('select.country').val();
+                    var role = graph[country] && graph[country][$(this).attr('value')];
                     var tooltip = "";
-                    console.log( element );
-                    if( data.access.length > 1 ){
+                    if( role && role.access.length > 1 ){
                         tooltip = i18n.gettext("Complete access from: ");
-                        tooltip += data.access.map(caps).join(', ') + ".";
+                        tooltip += role.access.map(caps).join(', ') + ".";
                     }else{
                         tooltip += i18n.gettext("Does not inherit any access.");
                     }
-                    console.log( tooltip );
-                    element.attr('title', tooltip);
-
+                    $(this).attr('title', tooltip);
                 });
             });
         }
@@ -600,6 +574,18 @@ function drawUserEditor(username){
 
 }
 
+//The role graph for the current user's countries, fetched at most once per page.
+var roleGraph = null;
+
+function getRoleGraph( callback ){
+    if( roleGraph ) return roleGraph.done( callback );
+    roleGraph = $.getJSON( root + '/en/roles/graph' ).then( function( data ){
+        return data.countries;
+    });
+    roleGraph.fail( function(){ roleGraph = null; } );
+    return roleGraph.done( callback );
+}
+
 function formValid(){
 
     var valid = true;
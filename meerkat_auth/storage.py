@@ -0,0 +1,855 @@
+"""
+storage.py
+
+Storage backends for Meerkat Auth's models. The models read and write their
+items through the boto3 DynamoDB resource interface (see meerkat_auth.db),
+and config['DB_BACKEND'] chooses what lies behind it:
+
+    'dynamodb'  DynamoDB itself, at config['DB_URL'].
+    'memory'    Items held in memory by each process, e.g. for tests and
+                benchmarks that shouldn't need a database.
+    'sqlite'    A SQLite database file at config['DB_SQLITE_PATH'], shared by
+                the processes of a small deployment without DynamoDB.
+
+The local backends implement the part of the DynamoDB resource interface
+that the models use, on top of a few methods that store and fetch whole
+items (see Backend). Items are kept in DynamoDB's own serialised form, so
+they come back just as DynamoDB would return them, e.g. with numbers as
+Decimals. Condition, filter and key condition expressions must be built
+with boto3.dynamodb.conditions, update expressions may only SET and REMOVE
+attributes, and every key must be a string.
+"""
+from boto3.dynamodb.conditions import AttributeBase, ConditionBase
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+from botocore.exceptions import ClientError
+from meerkat_auth import app
+import contextlib
+import copy
+import operator
+import sqlite3
+import threading
+import bisect
+import time
+import types
+import json
+import re
+
+# The (hash, range) key attributes of each table, by config name.
+TABLE_KEYS = {
+    'USERS': ('username', None),
+    'ROLES': ('country', 'role'),
+    'ROLE_INDEX': ('role_key', 'username'),
+    'REFRESH_TOKENS': ('id', None),
+    'REVOCATIONS': ('bucket', 'id')
+}
+
+# Comparisons in condition expressions, and in the older Expected and
+# KeyConditions parameters.
+COMPARISONS = {
+    '=': operator.eq, '<>': operator.ne, '<': operator.lt,
+    '<=': operator.le, '>': operator.gt, '>=': operator.ge,
+    'EQ': operator.eq, 'NE': operator.ne, 'LT': operator.lt,
+    'LE': operator.le, 'GT': operator.gt, 'GE': operator.ge
+}
+
+_MISSING = object()  # The value of an attribute an item doesn't have.
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+
+
+class ConditionalCheckFailedException(ClientError):
+    """Raised when a write's condition isn't met, as by DynamoDB."""
+
+    def __init__(self, operation):
+        super().__init__({'Error': {
+            'Code': 'ConditionalCheckFailedException',
+            'Message': 'The conditional request failed'
+        }}, operation)
+
+
+class ResourceNotFoundException(ClientError):
+    """Raised for a table the backend doesn't know, as by DynamoDB."""
+
+    def __init__(self, operation, table):
+        super().__init__({'Error': {
+            'Code': 'ResourceNotFoundException',
+            'Message': 'Requested resource not found: ' + str(table)
+        }}, operation)
+
+
+class ValidationException(ClientError):
+    """Raised for a request DynamoDB would reject, e.g. a missing key."""
+
+    def __init__(self, operation, message):
+        super().__init__({'Error': {
+            'Code': 'ValidationException',
+            'Message': message
+        }}, operation)
+
+
+_PATH_PART = re.compile(r'([^.\[\]\s]+)|\[(\d+)\]')
+
+
+def _path(name, names=None):
+    """
+    Splits an attribute path, e.g. '#a.b[2]', into its attribute names and
+    list indexes, substituting any #name placeholders.
+    """
+    names = names or {}
+    return [
+        names.get(part, part) if part else int(index)
+        for part, index in _PATH_PART.findall(name)
+    ]
+
+
+def _lookup(item, path):
+    """The value at an attribute path, or _MISSING."""
+    for part in path:
+        if isinstance(part, int):
+            if not isinstance(item, list) or part >= len(item):
+                return _MISSING
+        elif not isinstance(item, dict) or part not in item:
+            return _MISSING
+        item = item[part]
+    return item
+
+
+def _operand(value, item):
+    """Resolves an operand of a condition against an item."""
+    if isinstance(value, ConditionBase):
+        # The only condition that is also an operand is size().
+        attribute = _operand(value.get_expression()['values'][0], item)
+        return _MISSING if attribute is _MISSING else len(attribute)
+    if isinstance(value, AttributeBase):
+        return _lookup(item, _path(value.name))
+    return value
+
+
+def matches(condition, item):
+    """
+    Evaluates a condition built with boto3.dynamodb.conditions against an
+    item, as DynamoDB would.
+
+    Args:
+        condition (ConditionBase) The condition.
+        item (dict) The item, or an empty dict if there isn't one.
+
+    Returns:
+        bool Whether the item meets the condition.
+    """
+    if isinstance(condition, str):
+        raise NotImplementedError(
+            'Local backends only support expressions built with '
+            'boto3.dynamodb.conditions.'
+        )
+    expression = condition.get_expression()
+    name = expression['operator']
+    values = expression['values']
+    if name == 'AND':
+        return all(matches(value, item) for value in values)
+    if name == 'OR':
+        return any(matches(value, item) for value in values)
+    if name == 'NOT':
+        return not matches(values[0], item)
+
+    operands = [_operand(value, item) for value in values]
+    if name == 'attribute_exists':
+        return operands[0] is not _MISSING
+    if name == 'attribute_not_exists':
+        return operands[0] is _MISSING
+    if any(operand is _MISSING for operand in operands):
+        return False
+    value = operands[0]
+    if name == 'contains':
+        if isinstance(value, str):
+            return isinstance(operands[1], str) and operands[1] in value
+        return isinstance(value, (list, set)) and operands[1] in value
+    if name == 'begins_with':
+        return isinstance(value, str) and value.startswith(operands[1])
+    if name == 'IN':
+        return value in operands[1]
+    try:
+        if name == 'BETWEEN':
+            return operands[1] <= value <= operands[2]
+        if name in COMPARISONS:
+            return COMPARISONS[name](value, operands[1])
+    except TypeError:
+        # Values of different types never compare as ordered.
+        return False
+    raise NotImplementedError(
+        'Local backends do not support ' + repr(name) + ' conditions.'
+    )
+
+
+def _legacy_matches(conditions, item):
+    """
+    Evaluates the older Expected, KeyConditions, QueryFilter and ScanFilter
+    style of condition against an item.
+    """
+    for name, condition in conditions.items():
+        value = item.get(name, _MISSING)
+        if 'ComparisonOperator' not in condition:
+            # An Expected entry: {'Value': v} or {'Exists': False}.
+            if condition.get('Exists', True) is False:
+                condition = {'ComparisonOperator': 'NULL'}
+            else:
+                condition = {
+                    'ComparisonOperator': 'EQ',
+                    'AttributeValueList': [condition['Value']]
+                }
+        name = condition['ComparisonOperator']
+        values = condition.get('AttributeValueList', [])
+        if name == 'NULL':
+            ok = value is _MISSING
+        elif name == 'NOT_NULL':
+            ok = value is not _MISSING
+        elif value is _MISSING:
+            ok = False
+        elif name == 'CONTAINS':
+            ok = values[0] in value
+        elif name == 'BEGINS_WITH':
+            ok = isinstance(value, str) and value.startswith(values[0])
+        elif name == 'IN':
+            ok = value in values
+        elif name == 'BETWEEN':
+            ok = values[0] <= value <= values[1]
+        elif name in COMPARISONS:
+            ok = COMPARISONS[name](value, values[0])
+        else:
+            raise NotImplementedError(
+                'Local backends do not support ' + repr(name) + ' conditions.'
+            )
+        if not ok:
+            return False
+    return True
+
+
+def _projection(expression=None, names=None, attributes=None):
+    """The attribute paths to fetch, or None to fetch every attribute."""
+    if expression:
+        return [_path(p, names) for p in expression.split(',')]
+    if attributes:
+        return [[a] for a in attributes]
+    return None
+
+
+def _project(item, paths):
+    """Copies only the given attribute paths of an item."""
+    if paths is None:
+        return item
+    result = {}
+    for path in paths:
+        value = _lookup(item, path)
+        if value is _MISSING:
+            continue
+        target = result
+        for part in path[:-1]:
+            target = target.setdefault(part, {})
+        target[path[-1]] = value
+    return result
+
+
+_CLAUSES = re.compile(r'\b(SET|REMOVE|ADD|DELETE)\b', re.IGNORECASE)
+_FUNCTION = re.compile(r'^(list_append|if_not_exists)\((.*)\)$')
+
+
+def _split(text, separator=','):
+    """Splits text at separators that aren't inside brackets."""
+    parts = ['']
+    depth = 0
+    for character in text:
+        depth += {'(': 1, ')': -1}.get(character, 0)
+        if character == separator and depth == 0:
+            parts.append('')
+        else:
+            parts[-1] += character
+    return [part.strip() for part in parts]
+
+
+def _value(operand, item, names, values):
+    """Evaluates the value of a SET action against the item being updated."""
+    operand = operand.strip()
+    for sign in '+-':
+        terms = _split(operand, sign)
+        if len(terms) == 2:
+            left, right = [_value(t, item, names, values) for t in terms]
+            return left + right if sign == '+' else left - right
+    function = _FUNCTION.match(operand)
+    if function:
+        first, second = _split(function.group(2))
+        if function.group(1) == 'if_not_exists':
+            value = _lookup(item, _path(first, names))
+            if value is not _MISSING:
+                return value
+            return _value(second, item, names, values)
+        first = _value(first, item, names, values)
+        return first + _value(second, item, names, values)
+    if operand.startswith(':'):
+        return values[operand]
+    value = _lookup(item, _path(operand, names))
+    if value is _MISSING:
+        raise ValidationException('UpdateItem', (
+            'The provided expression refers to an attribute that does not '
+            'exist in the item'
+        ))
+    return value
+
+
+def _assign(item, path, value):
+    """Sets the value at an attribute path."""
+    target = _lookup(item, path[:-1])
+    if isinstance(path[-1], int):
+        if not isinstance(target, list):
+            raise ValidationException('UpdateItem', (
+                'The document path provided in the update expression is '
+                'invalid for update'
+            ))
+        if path[-1] < len(target):
+            target[path[-1]] = value
+        else:
+            target.append(value)
+    elif isinstance(target, dict):
+        target[path[-1]] = value
+    else:
+        raise ValidationException('UpdateItem', (
+            'The document path provided in the update expression is '
+            'invalid for update'
+        ))
+
+
+def _update(item, expression, names=None, values=None):
+    """
+    Applies an update expression's SET and REMOVE actions to an item, as
+    DynamoDB would, returning the names of the top level attributes they
+    change. Every value is worked out from the item as it was before the
+    update, so e.g. removing several list elements removes the elements at
+    those positions in the old list.
+    """
+    names = names or {}
+    values = values or {}
+    parts = _CLAUSES.split(expression)
+    if parts[0].strip():
+        raise ValidationException(
+            'UpdateItem', 'Invalid UpdateExpression: ' + expression
+        )
+    sets = []
+    removes = []
+    for action, clause in zip(parts[1::2], parts[2::2]):
+        action = action.upper()
+        for term in _split(clause):
+            if action == 'SET':
+                path, operand = _split(term, '=')
+                sets.append((
+                    _path(path, names), _value(operand, item, names, values)
+                ))
+            elif action == 'REMOVE':
+                removes.append(_path(term, names))
+            else:
+                raise NotImplementedError(
+                    'Local backends do not support ' + action + ' updates.'
+                )
+
+    for path, value in sets:
+        _assign(item, path, value)
+    # Remove later list elements first, so the earlier positions still hold.
+    def position(path):
+        return path[-1] if isinstance(path[-1], int) else -1
+    for path in sorted(removes, key=position, reverse=True):
+        target = _lookup(item, path[:-1])
+        if isinstance(path[-1], int):
+            if isinstance(target, list) and path[-1] < len(target):
+                del target[path[-1]]
+        elif isinstance(target, dict):
+            target.pop(path[-1], None)
+    return {path[0] for path, value in sets} | {path[0] for path in removes}
+
+
+class LocalTable:
+    """
+    A table in a local backend, with the methods of a boto3 DynamoDB Table
+    that the models use.
+    """
+
+    # Items read per page of a scan or query.
+    PAGE_SIZE = 100
+
+    def __init__(self, backend, name, hash_key, range_key=None):
+        """
+        Create a LocalTable object.
+
+        Args:
+            backend (Backend) The backend storing the table's items.
+            name (str) The table name.
+            hash_key (str) The name of the partition key attribute.
+            range_key (str) The name of the sort key attribute, if any.
+        """
+        self.backend = backend
+        self.name = name
+        self.hash_key = hash_key
+        self.range_key = range_key
+
+    def _key(self, item, operation):
+        """The stored key of an item, or of a Key argument."""
+        key = []
+        for attribute in [self.hash_key, self.range_key]:
+            if attribute is None:
+                key.append('')
+            elif not isinstance(item.get(attribute), str):
+                raise ValidationException(operation, (
+                    'The provided key element does not match the schema'
+                ))
+            else:
+                key.append(item[attribute])
+        return tuple(key)
+
+    def _key_item(self, key):
+        """The key attributes of the item with the given stored key."""
+        item = {self.hash_key: key[0]}
+        if self.range_key:
+            item[self.range_key] = key[1]
+        return item
+
+    def _read(self, key):
+        item = self.backend._read(self.name, key)
+        return None if item is None else Backend.decode(item)
+
+    def _check(self, operation, item, condition=None, expected=None):
+        """Raises if an item doesn't meet a write's condition."""
+        item = item or {}
+        if condition is not None and not matches(condition, item):
+            raise ConditionalCheckFailedException(operation)
+        if expected and not _legacy_matches(expected, item):
+            raise ConditionalCheckFailedException(operation)
+
+    def get_item(self, Key, ProjectionExpression=None,
+                 ExpressionAttributeNames=None, AttributesToGet=None,
+                 ConsistentRead=None):
+        key = self._key(Key, 'GetItem')
+        with self.backend._transaction():
+            item = self._read(key)
+        if item is None:
+            return {}
+        return {'Item': _project(item, _projection(
+            ProjectionExpression, ExpressionAttributeNames, AttributesToGet
+        ))}
+
+    def put_item(self, Item, ConditionExpression=None, Expected=None,
+                 ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None, ReturnValues='NONE'):
+        key = self._key(Item, 'PutItem')
+        stored = Backend.encode(Item)
+        with self.backend._transaction(write=True):
+            old = self._read(key)
+            self._check('PutItem', old, ConditionExpression, Expected)
+            self.backend._write(self.name, key, stored)
+        if ReturnValues == 'ALL_OLD' and old:
+            return {'Attributes': old}
+        return {}
+
+    def update_item(self, Key, UpdateExpression=None, AttributeUpdates=None,
+                    ConditionExpression=None, Expected=None,
+                    ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues='NONE'):
+        key = self._key(Key, 'UpdateItem')
+        with self.backend._transaction(write=True):
+            old = self._read(key)
+            self._check('UpdateItem', old, ConditionExpression, Expected)
+            item = copy.deepcopy(old) if old else self._key_item(key)
+            changed = set()
+            if UpdateExpression:
+                changed = _update(
+                    item,
+                    UpdateExpression,
+                    ExpressionAttributeNames,
+                    Backend.decode(Backend.encode(
+                        ExpressionAttributeValues or {}
+                    ))
+                )
+            for name, update in (AttributeUpdates or {}).items():
+                action = update.get('Action', 'PUT')
+                if action == 'PUT':
+                    item[name] = update['Value']
+                elif action == 'DELETE' and 'Value' not in update:
+                    item.pop(name, None)
+                else:
+                    raise NotImplementedError(
+                        'Local backends do not support ' + action +
+                        ' attribute updates.'
+                    )
+                changed.add(name)
+            if changed & {self.hash_key, self.range_key}:
+                raise ValidationException(
+                    'UpdateItem', 'Cannot update attribute in the key'
+                )
+            stored = Backend.encode(item)
+            self.backend._write(self.name, key, stored)
+        new = Backend.decode(stored)
+        old = old or {}
+        returned = {
+            'ALL_OLD': old,
+            'ALL_NEW': new,
+            'UPDATED_OLD': {k: v for k, v in old.items() if k in changed},
+            'UPDATED_NEW': {k: v for k, v in new.items() if k in changed}
+        }.get(ReturnValues)
+        return {'Attributes': returned} if returned else {}
+
+    def delete_item(self, Key, ConditionExpression=None, Expected=None,
+                    ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues='NONE'):
+        key = self._key(Key, 'DeleteItem')
+        with self.backend._transaction(write=True):
+            old = self._read(key)
+            self._check('DeleteItem', old, ConditionExpression, Expected)
+            self.backend._delete(self.name, key)
+        if ReturnValues == 'ALL_OLD' and old:
+            return {'Attributes': old}
+        return {}
+
+    def _page(self, operation, partition, key_condition, kwargs):
+        """Reads one page of a scan or query."""
+        start = kwargs.pop('ExclusiveStartKey', None)
+        if start is not None:
+            start = self._key(start, operation)
+        limit = min(kwargs.pop('Limit', None) or self.PAGE_SIZE,
+                    self.PAGE_SIZE)
+        paths = _projection(
+            kwargs.pop('ProjectionExpression', None),
+            kwargs.pop('ExpressionAttributeNames', None),
+            kwargs.pop('AttributesToGet', None)
+        )
+        condition = kwargs.pop('FilterExpression', None)
+        conditions = kwargs.pop('ScanFilter', kwargs.pop('QueryFilter', None))
+        kwargs.pop('ConsistentRead', None)
+        if kwargs:
+            raise TypeError('Unsupported arguments: ' + ', '.join(kwargs))
+
+        with self.backend._transaction():
+            evaluated = self.backend._range(
+                self.name, partition, start, limit + 1
+            )
+        response = {'Items': [], 'ScannedCount': 0}
+        for key, stored in evaluated[:limit]:
+            item = Backend.decode(stored)
+            response['ScannedCount'] += 1
+            if key_condition and not key_condition(item):
+                continue
+            if condition is not None and not matches(condition, item):
+                continue
+            if conditions and not _legacy_matches(conditions, item):
+                continue
+            response['Items'].append(_project(item, paths))
+        response['Count'] = len(response['Items'])
+        if len(evaluated) > limit:
+            last = evaluated[limit - 1][0]
+            response['LastEvaluatedKey'] = self._key_item(last)
+        return response
+
+    def scan(self, **kwargs):
+        return self._page('Scan', None, None, kwargs)
+
+    def query(self, KeyConditionExpression=None, KeyConditions=None,
+              **kwargs):
+        if KeyConditionExpression is not None:
+            partition = self._partition(KeyConditionExpression)
+
+            def key_condition(item):
+                return matches(KeyConditionExpression, item)
+        else:
+            partition = KeyConditions.get(self.hash_key, {}).get(
+                'AttributeValueList', [None]
+            )[0]
+
+            def key_condition(item):
+                return _legacy_matches(KeyConditions, item)
+        if not isinstance(partition, str):
+            raise ValidationException(
+                'Query', 'Query condition missed key schema element'
+            )
+        return self._page('Query', partition, key_condition, kwargs)
+
+    def _partition(self, condition):
+        """The hash key value that a key condition requires, if any."""
+        expression = condition.get_expression()
+        if expression['operator'] == 'AND':
+            for value in expression['values']:
+                partition = self._partition(value)
+                if partition is not None:
+                    return partition
+        elif expression['operator'] == '=':
+            attribute, value = expression['values']
+            if getattr(attribute, 'name', None) == self.hash_key:
+                return value
+        return None
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return _BatchWriter(self)
+
+
+class _BatchWriter:
+    """Stands in for boto3's BatchWriter, writing each item at once."""
+
+    def __init__(self, table):
+        self.table = table
+
+    def put_item(self, Item):
+        self.table.put_item(Item=Item)
+
+    def delete_item(self, Key):
+        self.table.delete_item(Key=Key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class Backend:
+    """
+    The base class of the local backends, which implements the methods of a
+    boto3 DynamoDB resource that the models use. Subclasses store the items,
+    in their serialised form, by implementing _transaction(), _read(),
+    _write(), _delete() and _range(). Stored keys are (hash, range) tuples,
+    with a range of '' for tables without a sort key.
+    """
+
+    # Mirrors boto3's `resource.meta.client.exceptions`.
+    meta = types.SimpleNamespace(client=types.SimpleNamespace(
+        exceptions=types.SimpleNamespace(
+            ConditionalCheckFailedException=ConditionalCheckFailedException,
+            ResourceNotFoundException=ResourceNotFoundException,
+            ValidationException=ValidationException
+        )
+    ))
+
+    @staticmethod
+    def encode(item):
+        """Serialises an item, raising TypeError for e.g. floats, as boto3."""
+        return {k: _serializer.serialize(v) for k, v in item.items()}
+
+    @staticmethod
+    def decode(item):
+        """Deserialises a stored item, as boto3 does."""
+        return {k: _deserializer.deserialize(v) for k, v in item.items()}
+
+    def Table(self, name):
+        """
+        Returns the named table. The table's key attributes are looked up in
+        TABLE_KEYS by the config value that names it.
+
+        Raises:
+            ResourceNotFoundException if no table config has that name.
+        """
+        for config, keys in TABLE_KEYS.items():
+            if app.config.get(config) == name:
+                return LocalTable(self, name, *keys)
+        raise ResourceNotFoundException('DescribeTable', name)
+
+    def batch_get_item(self, RequestItems):
+        responses = {}
+        for name, request in RequestItems.items():
+            table = self.Table(name)
+            paths = _projection(
+                request.get('ProjectionExpression'),
+                request.get('ExpressionAttributeNames'),
+                request.get('AttributesToGet')
+            )
+            items = responses[name] = []
+            with self._transaction():
+                for key in request['Keys']:
+                    item = table._read(table._key(key, 'BatchGetItem'))
+                    if item is not None:
+                        items.append(_project(item, paths))
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def batch_write_item(self, RequestItems):
+        with self._transaction(write=True):
+            for name, requests in RequestItems.items():
+                table = self.Table(name)
+                for request in requests:
+                    if 'PutRequest' in request:
+                        item = request['PutRequest']['Item']
+                        key = table._key(item, 'BatchWriteItem')
+                        self._write(name, key, Backend.encode(item))
+                    else:
+                        key = request['DeleteRequest']['Key']
+                        key = table._key(key, 'BatchWriteItem')
+                        self._delete(name, key)
+        return {'UnprocessedItems': {}}
+
+    def _transaction(self, write=False):
+        """
+        A context manager within which reads and writes are isolated from
+        other threads and, for writes, other processes.
+        """
+        raise NotImplementedError
+
+    def _read(self, table, key):
+        """Returns the stored item with the given key, or None."""
+        raise NotImplementedError
+
+    def _write(self, table, key, item):
+        """Stores an item, replacing any with the same key."""
+        raise NotImplementedError
+
+    def _delete(self, table, key):
+        """Deletes the stored item with the given key, if any."""
+        raise NotImplementedError
+
+    def _range(self, table, partition=None, after=None, limit=None):
+        """
+        Returns (key, item) pairs in key order.
+
+        Args:
+            table (str) The table name.
+            partition (str) Only return items with this hash key.
+            after (tuple) Only return items with keys after this key.
+            limit (int) The most items to return.
+        """
+        raise NotImplementedError
+
+
+class MemoryBackend(Backend):
+    """
+    Keeps the items in memory. Every process has its own items, which are
+    lost when it exits. Setting `latency` makes every request take that many
+    seconds more, without holding up other threads, as a stand in for a
+    remote database in benchmarks.
+    """
+
+    def __init__(self):
+        self.tables = {}  # Table name: {key: item}.
+        self.keys = {}  # Table name: sorted keys, rebuilt after changes.
+        self.lock = threading.RLock()
+        self.latency = 0
+
+    def _transaction(self, write=False):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.lock
+
+    def _read(self, table, key):
+        return self.tables.get(table, {}).get(key)
+
+    def _write(self, table, key, item):
+        items = self.tables.setdefault(table, {})
+        if key not in items:
+            self.keys.pop(table, None)
+        items[key] = item
+
+    def _delete(self, table, key):
+        if self.tables.get(table, {}).pop(key, None) is not None:
+            self.keys.pop(table, None)
+
+    def _range(self, table, partition=None, after=None, limit=None):
+        items = self.tables.get(table, {})
+        if table not in self.keys:
+            self.keys[table] = sorted(items)
+        keys = self.keys[table]
+        start = bisect.bisect_right(keys, after) if after else 0
+        if partition is not None:
+            start = max(start, bisect.bisect_left(keys, (partition,)))
+        result = []
+        for key in keys[start:]:
+            if partition is not None and key[0] != partition:
+                break
+            if limit is not None and len(result) == limit:
+                break
+            result.append((key, items[key]))
+        return result
+
+
+class SQLiteBackend(Backend):
+    """
+    Keeps the items in a SQLite database file, as JSON in a single table
+    keyed by table name, hash key and range key. Writes take SQLite's write
+    lock, so conditional writes are safe across processes sharing the file.
+    Each process must open its own SQLiteBackend.
+    """
+
+    def __init__(self, path):
+        """
+        Create a SQLiteBackend object, creating the database file if needed.
+
+        Args:
+            path (str) The database file.
+        """
+        self.path = path
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS items ('
+            'tbl TEXT NOT NULL, hash TEXT NOT NULL, range TEXT NOT NULL, '
+            'item TEXT NOT NULL, PRIMARY KEY (tbl, hash, range)'
+            ') WITHOUT ROWID'
+        )
+
+    @contextlib.contextmanager
+    def _transaction(self, write=False):
+        with self.lock:
+            if not write:
+                yield
+                return
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    def _read(self, table, key):
+        row = self.connection.execute(
+            'SELECT item FROM items WHERE tbl = ? AND hash = ? AND range = ?',
+            (table,) + key
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _write(self, table, key, item):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?)',
+            (table,) + key + (json.dumps(item),)
+        )
+
+    def _delete(self, table, key):
+        self.connection.execute(
+            'DELETE FROM items WHERE tbl = ? AND hash = ? AND range = ?',
+            (table,) + key
+        )
+
+    def _range(self, table, partition=None, after=None, limit=None):
+        sql = 'SELECT hash, range, item FROM items WHERE tbl = ?'
+        args = [table]
+        if partition is not None:
+            sql += ' AND hash = ?'
+            args.append(partition)
+        if after is not None:
+            sql += ' AND (hash, range) > (?, ?)'
+            args += after
+        sql += ' ORDER BY hash, range LIMIT ?'
+        args.append(-1 if limit is None else limit)
+        return [
+            ((hash, range), json.loads(item))
+            for hash, range, item in self.connection.execute(sql, args)
+        ]
+
+
+def create(name, path=None):
+    """
+    Creates a local backend.
+
+    Args:
+        name (str) 'memory' or 'sqlite'.
+        path (str) The database file, for the 'sqlite' backend.
+
+    Returns:
+        Backend The new backend.
+    """
+    if name == 'memory':
+        return MemoryBackend()
+    if name == 'sqlite':
+        return SQLiteBackend(path)
+    raise ValueError('Unknown database backend: ' + repr(name))
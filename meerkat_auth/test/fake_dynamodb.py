@@ -0,0 +1,124 @@
+"""
+Meerkat Auth Tests
+
+An in-memory stand-in for a boto3 DynamoDB resource that can inject faults,
+for testing how Meerkat Auth behaves when the database is slow, throttled or
+unreachable. Only the operations and arguments that Meerkat Auth's read
+paths use are supported.
+"""
+from botocore.exceptions import ClientError, ReadTimeoutError
+import threading
+import time
+
+
+class FakeDynamoDB:
+    """
+    A fake boto3 DynamoDB resource. Tables are created with create_table()
+    and faults are injected with fail() and delay.
+    """
+
+    def __init__(self):
+        self.tables = {}
+        self.lock = threading.Lock()
+        self.calls = 0  # Calls made, including failed ones.
+        self.delay = 0  # Seconds each call takes.
+        self._faults = []
+
+    def create_table(self, name, hash_key, range_key=None, items=[]):
+        """Creates a table with the given key schema and items."""
+        table = FakeTable(self, name, hash_key, range_key)
+        for item in items:
+            table.items[table._key(item)] = dict(item)
+        self.tables[name] = table
+        return table
+
+    def Table(self, name):
+        return self.tables[name]
+
+    def fail(self, count=1, error='throttle'):
+        """
+        Makes the next `count` calls fail.
+
+        Args:
+            count (int) The number of calls to fail.
+            error (str) 'throttle' to raise a throughput exceeded error,
+                'timeout' to raise a read timeout, or 'invalid' to raise a
+                validation error.
+        """
+        with self.lock:
+            self._faults += [error] * count
+
+    def _call(self, operation):
+        """Counts a call, applying any delay and injected fault."""
+        with self.lock:
+            self.calls += 1
+            fault = self._faults.pop(0) if self._faults else None
+        if self.delay:
+            time.sleep(self.delay)
+        if fault == 'timeout':
+            raise ReadTimeoutError(endpoint_url='http://fake-dynamodb')
+        if fault:
+            code = {
+                'throttle': 'ProvisionedThroughputExceededException',
+                'invalid': 'ValidationException'
+            }[fault]
+            raise ClientError(
+                {'Error': {'Code': code, 'Message': 'Injected fault.'}},
+                operation
+            )
+
+
+class FakeTable:
+    """A fake boto3 DynamoDB Table."""
+
+    # Items returned per page of a scan or query.
+    PAGE_SIZE = 2
+
+    def __init__(self, db, name, hash_key, range_key=None):
+        self.db = db
+        self.name = name
+        self.hash_key = hash_key
+        self.range_key = range_key
+        self.items = {}
+
+    def _key(self, item):
+        return (item[self.hash_key], item.get(self.range_key))
+
+    def get_item(self, Key, **kwargs):
+        # Projections are ignored, so every attribute is returned.
+        self.db._call('GetItem')
+        item = self.items.get(self._key(Key))
+        return {'Item': dict(item)} if item else {}
+
+    def put_item(self, Item, **kwargs):
+        self.db._call('PutItem')
+        self.items[self._key(Item)] = dict(Item)
+        return {}
+
+    def delete_item(self, Key, **kwargs):
+        self.db._call('DeleteItem')
+        self.items.pop(self._key(Key), None)
+        return {}
+
+    def _page(self, items, start):
+        """Returns one page of sorted items after the start key."""
+        items = sorted(items, key=self._key)
+        if start:
+            items = [i for i in items if self._key(i) > self._key(start)]
+        response = {'Items': [dict(i) for i in items[:self.PAGE_SIZE]]}
+        if len(items) > self.PAGE_SIZE:
+            last = items[self.PAGE_SIZE - 1]
+            response['LastEvaluatedKey'] = {
+                k: last[k] for k in [self.hash_key, self.range_key] if k
+            }
+        return response
+
+    def scan(self, ExclusiveStartKey=None, **kwargs):
+        self.db._call('Scan')
+        return self._page(self.items.values(), ExclusiveStartKey)
+
+    def query(self, KeyConditions, ExclusiveStartKey=None, **kwargs):
+        self.db._call('Query')
+        value = KeyConditions[self.hash_key]['AttributeValueList'][0]
+        items = [i for i in self.items.values() if i[self.hash_key] == value]
+        return self._page(items, ExclusiveStartKey)
@@ -6,6 +6,7 @@ Unit tests for REST API resources in Meerkat Auth.
 """
 from meerkat_auth.user import User
 from meerkat_auth.role import Role
+from meerkat_auth.revocation import revocations
 from unittest import mock
 from meerkat_auth import app
 import meerkat_auth
@@ -15,7 +16,6 @@ import jwt
 import calendar
 import time
 import logging
-import boto3
 import os
 
 
@@ -32,18 +32,10 @@ class MeerkatAuthAPITestCase(unittest.TestCase):
         """Setup for testing"""
         app.config.from_object('meerkat_auth.config.Testing')
         app.config.from_envvar('MEERKAT_AUTH_SETTINGS')
-        User.DB = boto3.resource(
-            'dynamodb',
-            endpoint_url=app.config['DB_URL'],
-            region_name='eu-west-1'
-        )
-        Role.DB = boto3.resource(
-            'dynamodb',
-            endpoint_url=app.config['DB_URL'],
-            region_name='eu-west-1'
-        )
         self.app = meerkat_auth.app.test_client()
         logging.warning(app.config['DB_URL'])
+        # Keep each test's revocations to itself.
+        mock.patch.object(revocations, 'store', None).start()
         # The database should have the following objects already in it
         roles = [
             Role('demo', 'registered', 'Registered description.', []),
@@ -90,6 +82,9 @@ class MeerkatAuthAPITestCase(unittest.TestCase):
         """Tear down after testing."""
         User.delete('testUser1')
         User.delete('testUser2')
+        mock.patch.stopall()
+        revocations.users.clear()
+        revocations.buckets.clear()
 
     @mock.patch('flask.Response.set_cookie')
     def test_login(self, request_mock):
@@ -155,7 +150,7 @@ class MeerkatAuthAPITestCase(unittest.TestCase):
 
         # Check that a InvalidRoleException is handled correctly.
         role = Role.from_db('demo', 'personal')
-        Role.delete('demo', 'personal')
+        Role.delete('demo', 'personal', force=True)
         post_data = json.dumps(
             {'username': 'testUser2', 'password': 'password2'}
         )
@@ -206,4 +201,187 @@ class MeerkatAuthAPITestCase(unittest.TestCase):
             (calendar.timegm(time.gmtime()) + 10) <= user_out['exp']
         )
 
+    def test_get_users(self):
+        """Test the batch user resource."""
+
+        # Resolve two users from their tokens.
+        exp = calendar.timegm(time.gmtime()) + 10
+        users = [User.from_db('testUser1'), User.from_db('testUser2')]
+        tokens = [u.get_jwt(exp).decode('UTF-8') for u in users]
+        response = self.app.post(
+            '/api/get_users',
+            data=json.dumps({'jwts': tokens + ['badtoken']}),
+            content_type='application/json'
+        )
+        response_json = json.loads(response.data.decode('UTF-8'))
+
+        # Check each user matches what /get_user would have returned.
+        for user in users:
+            user_out = response_json['users'][user.username]
+            self.assertEqual(user.username, user_out['usr'])
+            self.assertEqual(user.email, user_out['email'])
+            self.assertEqual(user.get_access(), user_out['acc'])
+        self.assertIn('jwts[2]', response_json['errors'])
+
+        # Check the users can be returned as signed tokens.
+        response = self.app.post(
+            '/api/get_users',
+            data=json.dumps({'jwts': tokens, 'signed': True}),
+            content_type='application/json'
+        )
+        response_json = json.loads(response.data.decode('UTF-8'))
+        user_out = jwt.decode(
+            response_json['users']['testUser2'],
+            JWT_PUBLIC_KEY,
+            algorithms=JWT_ALGORITHM
+        )
+        self.assertEqual(users[1].get_access(), user_out['acc'])
+
+        # Resolving users by username requires authorisation.
+        response = self.app.post(
+            '/api/get_users',
+            data=json.dumps({'usernames': ['testUser1']}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 401)
+
+    def test_check_access(self):
+        """Test the access decision resource."""
+        exp = calendar.timegm(time.gmtime()) + 10
+        token = User.from_db('testUser1').get_jwt(exp).decode('UTF-8')
+
+        def check(access, countries, logic='OR', jwt_token=token):
+            response = self.app.post(
+                '/api/check_access',
+                data=json.dumps({
+                    'jwt': jwt_token,
+                    'access': access,
+                    'countries': countries,
+                    'logic': logic
+                }),
+                content_type='application/json'
+            )
+            return json.loads(response.data.decode('UTF-8'))['allowed']
+
+        # Check decisions, and repeated decisions, match check_access().
+        for i in range(2):
+            self.assertTrue(check(['registered'], ['demo']))
+            self.assertTrue(check(['shared'], ['demo']))
+            self.assertFalse(check(['shared'], ['jordan']))
+            self.assertTrue(check(['shared', 'personal'], ['jordan']))
+            self.assertFalse(
+                check(['shared', 'personal'], ['jordan'], 'AND')
+            )
+        self.assertFalse(check(['registered'], ['demo'], jwt_token='bad'))
+
+        # Suspended users are denied, even where a decision is cached.
+        user = User.from_db('testUser1')
+        user.state = 'suspended'
+        user.to_db()
+        self.assertFalse(check(['registered'], ['demo']))
+
+    def test_refresh(self):
+        """Test refreshing a session with a rotating refresh token."""
+
+        # Log in with a refreshable session, using the client's cookie jar.
+        post_response = self.app.post(
+            '/api/login',
+            data=json.dumps({
+                'username': 'testUser1',
+                'password': 'password1',
+                'refresh': True
+            }),
+            content_type='application/json'
+        )
+        self.assertEqual(post_response.status_code, 200)
+        cookies = post_response.headers.getlist('Set-Cookie')
+        refresh_cookie = [
+            c for c in cookies if c.startswith(app.config['REFRESH_COOKIE_NAME'])
+        ][0]
+        refresh_token = refresh_cookie.split(';')[0].split('=', 1)[1]
+
+        # The refresh token in the cookie gets a new jwt and refresh token.
+        response = self.app.post('/api/refresh')
+        self.assertEqual(response.status_code, 200)
+        cookies = response.headers.getlist('Set-Cookie')
+        jwt_cookie = [c for c in cookies if c.startswith(JWT_COOKIE_NAME)][0]
+        token = jwt_cookie.split(';')[0].split('=', 1)[1]
+        payload = jwt.decode(token, JWT_PUBLIC_KEY, algorithms=JWT_ALGORITHM)
+        self.assertEqual(payload['usr'], 'testUser1')
+        max_exp = (calendar.timegm(time.gmtime()) +
+                   app.config['ACCESS_TOKEN_LIFE'])
+        self.assertTrue(payload['exp'] <= max_exp)
+
+        # Reusing the original refresh token fails, and ends the session.
+        response = self.app.post(
+            '/api/refresh',
+            data=json.dumps({'refresh_token': refresh_token}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 401)
+        response = self.app.post('/api/refresh')
+        self.assertEqual(response.status_code, 401)
+
+    def test_update_account(self):
+        """Test users updating their own accounts with their token."""
+        exp = calendar.timegm(time.gmtime()) + 30
+        token = User.from_db('testUser1').get_jwt(exp).decode('UTF-8')
+        headers = {'Authorization': 'Bearer ' + token}
+
+        def update(args):
+            response = self.app.post(
+                '/api/update_account',
+                data=json.dumps(args),
+                headers=headers,
+                content_type='application/json'
+            )
+            return response, json.loads(response.data.decode('UTF-8'))
+
+        # Only changed attributes are written.
+        response, response_json = update({
+            'email': 'test1@test.org.uk',
+            'data': {'name': 'Testy McTestface II'}
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response_json['updated'], ['data'])
+        user = User.from_db('testUser1')
+        self.assertEqual(user.data['name'], 'Testy McTestface II')
+        self.assertEqual(user.roles, ['manager', 'personal'])
+
+        # Requests without a token are refused in json.
+        response = self.app.post(
+            '/api/update_account',
+            data=json.dumps({'email': 'test1@test.org.uk'}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 401)
+        self.assertIn('message', json.loads(response.data.decode('UTF-8')))
+
+        # Access and protected account data can't be changed.
+        response, response_json = update({'roles': ['manager', 'manager']})
+        self.assertEqual(response.status_code, 403)
+        response, response_json = update({'data': {'TOKEN_LIFE': 1e6}})
+        self.assertEqual(response.status_code, 403)
+
+        # Changing the password requires the old password.
+        response, response_json = update({'password': 'new'})
+        self.assertEqual(response.status_code, 401)
+        response, response_json = update({
+            'password': 'new', 'old_password': 'password1'
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(User.authenticate('testUser1', 'new'))
+
+        # The password change revokes the old token, even if it was issued in
+        # the same second, but not the new one.
+        cookies = response.headers.getlist('Set-Cookie')
+        jwt_cookie = [c for c in cookies if c.startswith(JWT_COOKIE_NAME)][0]
+        new_token = jwt_cookie.split(';')[0].split('=', 1)[1]
+        self.assertTrue(revocations.is_revoked(
+            jwt.decode(token, JWT_PUBLIC_KEY, algorithms=JWT_ALGORITHM)
+        ))
+        self.assertFalse(revocations.is_revoked(
+            jwt.decode(new_token, JWT_PUBLIC_KEY, algorithms=JWT_ALGORITHM)
+        ))
+
         # TODO: Test logout and update user.
@@ -13,7 +13,6 @@ import unittest
 import calendar
 import time
 import logging
-import boto3
 import os
 
 # Hacky!
@@ -30,16 +29,6 @@ class MeerkatAuthAuthoriseTestCase(unittest.TestCase):
         """Setup for testing"""
         app.config.from_object('meerkat_auth.config.Testing')
         app.config.from_envvar('MEERKAT_AUTH_SETTINGS')
-        User.DB = boto3.resource(
-            'dynamodb',
-            endpoint_url=app.config['DB_URL'],
-            region_name='eu-west-1'
-        )
-        Role.DB = boto3.resource(
-            'dynamodb',
-            endpoint_url=app.config['DB_URL'],
-            region_name='eu-west-1'
-        )
         self.app = app.test_client()
 
         # The database should have the following objects already in it.
@@ -249,3 +238,27 @@ class MeerkatAuthAuthoriseTestCase(unittest.TestCase):
                 exceptions.Forbidden,
                 lambda: self.auth.check_auth(['directorate'], ['jordan'])
             )
+
+    def test_filter_access(self):
+        """Test filtering user rows agrees with check_access row by row."""
+        acc = User.from_db('testUser1').get_access()
+        rows = [
+            {'username': 'a', 'roles': ['clinic'], 'countries': ['jordan']},
+            {'username': 'b', 'roles': ['central'], 'countries': ['jordan']},
+            {'username': 'c', 'roles': ['clinic'], 'countries': ['jordan']},
+            {'username': 'd', 'roles': ['clinic', 'central'],
+             'countries': ['jordan', 'demo']},
+            {'username': 'e', 'roles': ['directorate', 'clinic'],
+             'countries': ['jordan', 'jordan']}
+        ]
+        filtered = self.auth.filter_access(rows, acc, 'AND')
+        self.assertEqual(
+            [row['username'] for row in filtered],
+            [r['username'] for r in rows if self.auth.check_access(
+                r['roles'], r['countries'], acc, 'AND'
+            )]
+        )
+        self.assertEqual(
+            [row['username'] for row in filtered], ['a', 'c', 'e']
+        )
+        self.assertEqual(self.auth.filter_access([], acc), [])
@@ -0,0 +1,63 @@
+# !/usr/bin/env python3
+"""
+Meerkat Auth Tests
+
+Unit tests for the bloom.py module in Meerkat Auth.
+"""
+from meerkat_auth.bloom import BloomFilter, ApproximateSet
+import unittest
+
+
+class MeerkatAuthBloomTestCase(unittest.TestCase):
+
+    def test_bloom_filter(self):
+        """Test there are no false negatives and few false positives."""
+        bloom = BloomFilter(1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add('user{}'.format(i))
+        self.assertEqual(len(bloom), 1000)
+        for i in range(1000):
+            self.assertIn('user{}'.format(i), bloom)
+        false_positives = sum(
+            'other{}'.format(i) in bloom for i in range(10000)
+        )
+        self.assertLess(false_positives, 300)
+
+    def test_approximate_set(self):
+        """Test the set is built from the loader and updated by add()."""
+        usernames = ['testUser1', 'testUser2']
+        approx = ApproximateSet(lambda: list(usernames), ttl=300)
+
+        # Before the first build everything might be in the set.
+        approx.rebuilding.acquire()
+        self.assertTrue(approx.might_contain('testUser3'))
+        approx.rebuilding.release()
+
+        approx.rebuild()
+        self.assertTrue(approx.might_contain('testUser1'))
+        self.assertFalse(approx.might_contain('testUser3'))
+
+        # Items added are found at once.
+        approx.add('testUser3')
+        self.assertTrue(approx.might_contain('testUser3'))
+
+        # Items added during a rebuild aren't lost when the filter is swapped.
+        def loader():
+            approx.add('testUser4')
+            return usernames
+        approx.loader = loader
+        approx.rebuild()
+        self.assertTrue(approx.might_contain('testUser4'))
+        self.assertFalse(approx.might_contain('testUser5'))
+
+    def test_failed_rebuild(self):
+        """Test a failed rebuild keeps the old filter."""
+        approx = ApproximateSet(lambda: ['testUser1'], ttl=300)
+        approx.rebuild()
+
+        def loader():
+            raise IOError('Database unavailable.')
+        approx.loader = loader
+        approx.rebuild()
+        self.assertTrue(approx.might_contain('testUser1'))
+        self.assertFalse(approx.might_contain('testUser2'))
@@ -0,0 +1,93 @@
+# !/usr/bin/env python3
+"""
+Meerkat Auth Tests
+
+Unit tests for the cache.py module in Meerkat Auth.
+"""
+from meerkat_auth.cache import TTLCache, SingleFlight
+from unittest import mock
+import threading
+import unittest
+
+
+class MeerkatAuthCacheTestCase(unittest.TestCase):
+
+    def test_ttl_cache(self):
+        """Test entries expire and the least recently used are evicted."""
+        with mock.patch('meerkat_auth.cache.time.monotonic') as clock:
+            clock.return_value = 100
+            cache = TTLCache(ttl=10, maxsize=2)
+            cache.set('a', 1)
+            cache.set('b', 2, ttl=20)
+            self.assertEqual(cache.get('a'), 1)
+            self.assertEqual(cache.get('b'), 2)
+
+            # 'a' expires before 'b'.
+            clock.return_value = 115
+            self.assertIsNone(cache.get('a'))
+            self.assertEqual(cache.get('b'), 2)
+
+            # Reading 'b' makes 'c' the least recently used.
+            cache.set('c', 3)
+            self.assertEqual(cache.get('b'), 2)
+            cache.set('d', 4)
+            self.assertIsNone(cache.get('c'))
+            self.assertEqual(len(cache), 2)
+
+            cache.pop('b')
+            self.assertIsNone(cache.get('b'))
+            cache.clear()
+            self.assertEqual(len(cache), 0)
+
+    def test_get_or_load(self):
+        """Test values are only loaded when they aren't cached."""
+        cache = TTLCache()
+        loader = mock.Mock(return_value=None)
+        self.assertIsNone(cache.get_or_load('a', loader))
+        self.assertIsNone(cache.get_or_load('a', loader))
+        self.assertEqual(loader.call_count, 1)
+
+    def test_single_flight(self):
+        """Test concurrent loads of a key share one call."""
+        flight = SingleFlight('test')
+        started = threading.Event()
+        release = threading.Event()
+        loader = mock.Mock(return_value={'a': 1})
+
+        def slow_load():
+            started.set()
+            release.wait(5)
+            return loader()
+
+        results = []
+        leader = threading.Thread(
+            target=lambda: results.append(flight.do('a', slow_load))
+        )
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(
+            target=lambda: results.append(flight.do('a', loader))
+        ) for i in range(5)]
+        for thread in followers:
+            thread.start()
+        # Wait until every follower is waiting on the leader's load.
+        while flight.stats()['calls'] < 6:
+            threading.Event().wait(0.001)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+
+        self.assertEqual(loader.call_count, 1)
+        self.assertEqual(len(results), 6)
+        self.assertTrue(all(r is results[0] for r in results))
+        self.assertEqual(
+            flight.stats(),
+            {'calls': 6, 'loads': 1, 'coalesced': 5, 'ratio': 5 / 6}
+        )
+        self.assertIn('test', SingleFlight.all_stats())
+
+        # Later loads aren't coalesced, and errors reach the caller.
+        flight.do('a', loader)
+        self.assertEqual(loader.call_count, 2)
+        loader.side_effect = KeyError('a')
+        self.assertRaises(KeyError, lambda: flight.do('a', loader))
@@ -0,0 +1,183 @@
+# !/usr/bin/env python3
+"""
+Meerkat Auth Tests
+
+Unit tests for the circuit.py module, and for serving cached data while the
+database is failing, in Meerkat Auth. The database is replaced by the fault
+injecting FakeDynamoDB.
+"""
+from meerkat_auth.test.fake_dynamodb import FakeDynamoDB
+from meerkat_auth.circuit import CircuitOpenError
+from meerkat_auth.role import Role
+from meerkat_auth.role_graph import RoleGraph
+from meerkat_auth.user import User, InvalidCredentialException
+from meerkat_auth.authorise import Authorise
+from meerkat_auth import app, circuit
+from botocore.exceptions import ClientError, ReadTimeoutError
+from unittest import mock
+import unittest
+import time
+
+
+def wait_for_revalidation(cache):
+    """Waits for a cache's background reloads to finish."""
+    deadline = time.time() + 5
+    while cache._revalidating and time.time() < deadline:
+        time.sleep(0.001)
+
+
+class MeerkatAuthCircuitTestCase(unittest.TestCase):
+
+    def setUp(self):
+        """Setup for testing"""
+        self.db = FakeDynamoDB()
+        self.db.create_table('roles', 'country', 'role', items=[
+            {'country': 'demo', 'role': 'registered', 'description': '',
+             'parents': [], 'visible': []},
+            {'country': 'demo', 'role': 'personal', 'description': '',
+             'parents': ['registered'], 'visible': []}
+        ])
+        self.db.create_table('users', 'username', items=[
+            {'username': 'testUser1', 'email': 'test1@test.org.uk',
+             'countries': ['demo'], 'roles': ['personal'], 'state': 'live'}
+        ])
+        # The circuits and caches share this clock.
+        self.clock = mock.patch('time.monotonic').start()
+        self.clock.return_value = 100
+        tables = {'USERS': 'users', 'ROLES': 'roles'}
+        mock.patch.dict(app.config, tables).start()
+
+    def tearDown(self):
+        """Tear down after testing."""
+        mock.patch.stopall()
+        RoleGraph.invalidate()
+        User.ACCESS_CACHE.clear()
+        User.PUBLIC_ITEMS.clear()
+
+    def test_circuit_breaker(self):
+        """Test the circuit opens after failures and closes after a trial."""
+        db = circuit.guard(self.db, 'test', threshold=3, reset_timeout=30)
+        table = db.Table('users')
+        key = {'username': 'testUser1'}
+
+        # Errors in the request itself don't count as failures.
+        self.db.fail(5, 'invalid')
+        for i in range(5):
+            self.assertRaises(ClientError, lambda: table.get_item(Key=key))
+        self.assertEqual(db.breaker.state, 'closed')
+
+        # Throttles and timeouts do, and open the circuit.
+        self.db.fail(2, 'throttle')
+        self.db.fail(1, 'timeout')
+        self.assertRaises(ClientError, lambda: table.get_item(Key=key))
+        self.assertRaises(ClientError, lambda: table.get_item(Key=key))
+        self.assertEqual(db.breaker.state, 'closed')
+        self.assertRaises(ReadTimeoutError, lambda: table.get_item(Key=key))
+        self.assertEqual(db.breaker.state, 'open')
+
+        # While open, calls fail without reaching the database.
+        calls = self.db.calls
+        self.assertRaises(
+            CircuitOpenError, lambda: table.get_item(Key=key)
+        )
+        self.assertEqual(self.db.calls, calls)
+
+        # After the reset timeout one trial call is made. If it fails the
+        # circuit opens again straight away.
+        self.clock.return_value = 131
+        self.assertEqual(db.breaker.state, 'half-open')
+        self.db.fail(1, 'throttle')
+        self.assertRaises(ClientError, lambda: table.get_item(Key=key))
+        self.assertEqual(db.breaker.state, 'open')
+
+        # If it succeeds the circuit closes.
+        self.clock.return_value = 162
+        self.assertTrue(table.get_item(Key=key)['Item'])
+        self.assertEqual(db.breaker.state, 'closed')
+
+        # Attributes that aren't database calls are passed through.
+        self.assertEqual(table.name, 'users')
+
+    def test_stale_role_graph(self):
+        """Test the last graph is served while the roles table fails."""
+        db = circuit.guard(self.db, 'roles', threshold=2, reset_timeout=30)
+        mock.patch.object(Role, 'DB', db).start()
+
+        graph = RoleGraph.cached()
+        self.assertEqual(
+            graph.all_access('demo', 'personal'), ['personal', 'registered']
+        )
+
+        # Once expired the graph is still served while the database fails,
+        # and without waiting for the database.
+        self.clock.return_value = 100 + app.config['ROLE_GRAPH_TTL'] + 1
+        self.db.fail(10, 'throttle')
+        for i in range(3):
+            self.assertIs(RoleGraph.cached(), graph)
+            wait_for_revalidation(RoleGraph.CACHE)
+        self.assertEqual(db.breaker.state, 'open')
+
+        # When the database recovers, the graph is reloaded in the background.
+        self.clock.return_value += 30
+        self.db._faults = []
+        self.assertIs(RoleGraph.cached(), graph)
+        wait_for_revalidation(RoleGraph.CACHE)
+        self.assertIsNot(RoleGraph.cached(), graph)
+        self.assertEqual(db.breaker.state, 'closed')
+
+        # Too long after expiry the graph is no longer served.
+        self.clock.return_value += (
+            app.config['ROLE_GRAPH_TTL'] +
+            app.config['ROLE_GRAPH_STALE_TTL'] + 1
+        )
+        self.db.fail(1, 'throttle')
+        self.assertRaises(ClientError, RoleGraph.cached)
+
+    def test_stale_user_access(self):
+        """Test stale user access is served, unless the user has gone."""
+        db = circuit.guard(self.db, 'users', threshold=5, reset_timeout=30)
+        mock.patch.object(User, 'DB', db).start()
+
+        record = User.get_access_item('testUser1')
+        self.assertEqual(record.roles, ['personal'])
+
+        # Throttling keeps the stale record.
+        self.clock.return_value = 100 + app.config['USER_ACCESS_TTL'] + 1
+        self.db.fail(1, 'throttle')
+        self.assertIs(User.get_access_item('testUser1'), record)
+        wait_for_revalidation(User.ACCESS_CACHE)
+        self.assertIs(User.get_access_item('testUser1'), record)
+        wait_for_revalidation(User.ACCESS_CACHE)
+
+        # A deleted user isn't kept.
+        self.db.tables['users'].items.clear()
+        self.clock.return_value += app.config['USER_ACCESS_TTL'] + 1
+        User.get_access_item('testUser1')
+        wait_for_revalidation(User.ACCESS_CACHE)
+        self.assertRaises(
+            InvalidCredentialException,
+            lambda: User.get_access_item('testUser1')
+        )
+
+    def test_stale_user(self):
+        """Test the last user read is served to get_user() while failing."""
+        db = circuit.guard(self.db, 'users', threshold=2, reset_timeout=30)
+        mock.patch.object(User, 'DB', db).start()
+        mock.patch.object(Role, 'DB', self.db).start()
+        payload = {'usr': 'testUser1', 'exp': 200}
+        mock.patch.object(
+            Authorise, 'decode_token', return_value=payload
+        ).start()
+
+        user = Authorise().get_user('token')
+        self.assertEqual(user['acc'], {'demo': ['personal', 'registered']})
+
+        # The circuit opens, and the user is still served without waiting.
+        self.db.fail(10, 'throttle')
+        for i in range(3):
+            self.assertEqual(Authorise().get_user('token'), user)
+        self.assertEqual(db.breaker.state, 'open')
+
+        # Too long after the last read the user is no longer served.
+        self.clock.return_value += app.config['USER_ACCESS_STALE_TTL'] + 1
+        self.assertRaises(ClientError, lambda: Authorise().get_user('token'))
@@ -0,0 +1,99 @@
+# !/usr/bin/env python3
+"""
+Meerkat Auth Tests
+
+Unit tests for the db.py module in Meerkat Auth.
+"""
+from meerkat_auth import app, db, storage
+from unittest import mock
+import threading
+import unittest
+import time
+
+
+class MeerkatAuthDBTestCase(unittest.TestCase):
+
+    def setUp(self):
+        """Setup for testing"""
+        db.reset()
+        self.session = mock.patch('boto3.session.Session').start()
+        mock.patch.dict(app.config, {'DB_BACKEND': 'dynamodb'}).start()
+
+    def tearDown(self):
+        """Tear down after testing."""
+        mock.patch.stopall()
+        db.reset()
+
+    def test_shared_resource(self):
+        """Test one resource is created lazily and shared until reset."""
+        users = db.Database('users')
+        roles = db.Database('roles')
+        self.assertFalse(self.session.called)
+
+        users.Table('users')
+        roles.Table('roles')
+        self.assertEqual(self.session.call_count, 1)
+        self.assertIs(users.resource, roles.resource)
+        kwargs = self.session.return_value.resource.call_args[1]
+        config = kwargs['config']
+        self.assertEqual(kwargs['endpoint_url'], app.config['DB_URL'])
+        self.assertEqual(
+            config.max_pool_connections, app.config['DB_MAX_POOL_CONNECTIONS']
+        )
+        self.assertEqual(config.retries['mode'], app.config['DB_RETRY_MODE'])
+
+        # A forked process, or a change of config, gets a new resource. The
+        # fork may happen while another thread holds the lock.
+        db._lock.acquire()
+        db.init_after_fork()
+        users.Table('users')
+        self.assertEqual(self.session.call_count, 2)
+        with mock.patch.dict(app.config, {'DB_URL': 'http://other:8000'}):
+            users.Table('users')
+        self.assertEqual(self.session.call_count, 3)
+
+    def test_breakers(self):
+        """Test each database has its own circuit breaker."""
+        users = db.Database('users')
+        roles = db.Database('roles')
+        self.assertEqual(users.breaker.name, 'users')
+        self.assertIsNot(users.breaker, roles.breaker)
+        self.assertEqual(
+            users.breaker.threshold, app.config['DB_BREAKER_THRESHOLD']
+        )
+
+    def test_local_backend(self):
+        """Test config['DB_BACKEND'] can choose a local backend."""
+        with mock.patch.dict(app.config, {'DB_BACKEND': 'memory'}):
+            users = db.Database('users')
+            self.assertIsInstance(users.resource, storage.MemoryBackend)
+            self.assertIs(users.resource, db.resource())
+        self.assertFalse(self.session.called)
+
+    def test_fan_out(self):
+        """Test independent calls are made at once, with results in order."""
+        # The calls only all finish if they are all waiting at the same time.
+        barrier = threading.Barrier(3, timeout=5)
+
+        def call(i):
+            barrier.wait()
+            return i * 2
+        self.assertEqual(db.fan_out(call, [1, 2, 3]), [2, 4, 6])
+
+        # The first failure is raised, once every call has finished.
+        finished = []
+
+        def fail(i):
+            time.sleep(0.01 * i)
+            finished.append(i)
+            raise ValueError(i)
+        with self.assertRaises(ValueError) as raised:
+            db.gather(lambda: fail(2), lambda: fail(1))
+        self.assertEqual(raised.exception.args, (2,))
+        self.assertEqual(sorted(finished), [1, 2])
+
+        # Calls made from the pool's own threads run in turn.
+        def nested(i):
+            return db.fan_out(lambda j: threading.current_thread(), [1, 2])
+        for threads in db.fan_out(nested, [1, 2]):
+            self.assertEqual(threads[0], threads[1])
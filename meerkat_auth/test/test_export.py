@@ -0,0 +1,67 @@
+# !/usr/bin/env python3
+"""
+Meerkat Auth Tests
+
+Unit tests for the export.py module in Meerkat Auth.
+"""
+from decimal import Decimal
+from meerkat_auth import export
+import unittest
+import json
+import csv
+import io
+
+
+class MeerkatAuthExportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        """Setup for testing"""
+        self.pages = [
+            [{
+                'username': 'testUser1',
+                'email': 'test1@test.org.uk',
+                'countries': ['jordan'],
+                'roles': ['directorate'],
+                'data': {'name': 'Testy McTestface', 'TOKEN_LIFE': Decimal(60)}
+            }],
+            [],
+            [{
+                'username': 'testUser2',
+                'email': 'test2@test.org.uk',
+                'countries': ['demo', 'jordan'],
+                'roles': ['central', 'personal'],
+                'data': {}
+            }]
+        ]
+
+    def test_to_ndjson(self):
+        """Test accounts are written one JSON object per line, per page."""
+        chunks = list(export.to_ndjson(self.pages))
+        self.assertEqual(len(chunks), 2)
+        lines = ''.join(chunks).splitlines()
+        self.assertEqual(len(lines), 2)
+        first = json.loads(lines[0])
+        self.assertEqual(first['username'], 'testUser1')
+        self.assertEqual(first['data']['TOKEN_LIFE'], 60)
+        self.assertEqual(json.loads(lines[1])['roles'], ['central', 'personal'])
+
+    def test_to_csv(self):
+        """Test accounts are written as CSV with a header row first."""
+        chunks = export.to_csv(iter(self.pages))
+        # The header is available before any page is read.
+        self.assertEqual(
+            next(chunks).strip(), ','.join(export.EXPORT_ATTRIBUTES)
+        )
+        rows = list(csv.DictReader(io.StringIO(
+            ','.join(export.EXPORT_ATTRIBUTES) + '\n' + ''.join(chunks)
+        )))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1]['countries'], 'demo;jordan')
+        self.assertEqual(rows[1]['state'], '')
+        self.assertEqual(
+            json.loads(rows[0]['data'])['name'], 'Testy McTestface'
+        )
+
+    def test_serialise(self):
+        """Test unknown formats are rejected."""
+        self.assertRaises(ValueError, export.serialise, self.pages, 'xml')
@@ -0,0 +1,107 @@
+# !/usr/bin/env python3
+"""
+Meerkat Auth Tests
+
+Unit tests for the importer.py module in Meerkat Auth.
+"""
+from passlib.hash import pbkdf2_sha256
+from meerkat_auth.role import Role
+from meerkat_auth.role_graph import RoleGraph
+from meerkat_auth.user import UnreadUsersException
+from meerkat_auth import importer
+from unittest import mock
+import unittest
+
+
+class MeerkatAuthImporterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        """Setup for testing"""
+        self.graph = RoleGraph([
+            Role('demo', 'registered', 'Registered.', []),
+            Role('demo', 'personal', 'Personal.', ['registered']),
+            Role('jordan', 'admin', 'Admin.', ['missing'])
+        ])
+        self.row = {
+            'username': 'testUser1',
+            'email': 'test1@test.org.uk',
+            'password': 'password1',
+            'countries': ['demo'],
+            'roles': ['personal'],
+            'data': {'name': 'Testy McTestface'}
+        }
+
+    def test_parse(self):
+        """Test CSV and JSON imports are parsed into the same rows."""
+        text = (
+            'username,email,password,countries,roles,data\n'
+            'testUser1,test1@test.org.uk,password1,demo,personal,'
+            '"{""name"": ""Testy McTestface""}"\n'
+            'testUser2,test2@test.org.uk,password2,demo;demo,'
+            'personal;registered,\n'
+            'testUser3,test3@test.org.uk,password3,demo,personal,{name\n'
+        )
+        rows = importer.parse(text, 'csv')
+        self.assertEqual(rows[0], self.row)
+        self.assertEqual(rows[1]['roles'], ['personal', 'registered'])
+        self.assertEqual(rows[1]['data'], {})
+
+        # Malformed data is an error in its row, not the whole import.
+        self.assertEqual(
+            importer._validate(rows[2], self.graph, set(), None),
+            'The account data must be a JSON object.'
+        )
+
+        self.assertEqual(
+            importer.parse('[{"username": "testUser1"}]', 'json'),
+            [{'username': 'testUser1'}]
+        )
+        self.assertRaises(ValueError, importer.parse, '{}', 'json')
+        self.assertRaises(ValueError, importer.parse, '', 'xml')
+
+    def test_validate(self):
+        """Test each row is validated against the role graph."""
+        def validate(changes, taken=(), acc=None):
+            return importer._validate(
+                {**self.row, **changes}, self.graph, set(taken), acc
+            )
+
+        self.assertIsNone(validate({}))
+        self.assertIsNotNone(validate({}, taken=['testUser1']))
+        self.assertIsNotNone(validate({'email': 'not an email'}))
+        self.assertIsNotNone(validate({'password': ''}))
+        self.assertIsNotNone(validate({'data': 'not a dict'}))
+        self.assertIsNotNone(validate({'roles': ['personal', 'registered']}))
+        self.assertIsNotNone(validate({'roles': ['manager']}))
+        self.assertIn(
+            'Role not found',
+            validate({'countries': ['jordan'], 'roles': ['admin']})
+        )
+        self.assertIsNotNone(importer._validate('row', self.graph, set(), None))
+
+    def test_unread_usernames(self):
+        """Test rows whose usernames couldn't be checked are errors."""
+        rows = [self.row, dict(self.row, username='testUser2')]
+        unread = UnreadUsersException(['testUser2'], {})
+        with mock.patch.object(importer.User, 'batch_get',
+                               side_effect=unread), \
+                mock.patch.object(importer.RoleGraph, 'from_db',
+                                  return_value=self.graph):
+            result = importer.import_users(rows, dry_run=True)
+        self.assertEqual(result['created'], ['testUser1'])
+        self.assertEqual(len(result['errors']), 1)
+        self.assertEqual(result['errors'][0]['row'], 1)
+        self.assertIn('try again', result['errors'][0]['error'])
+
+    def test_hash_passwords(self):
+        """Test hashes are returned in order, with or without a pool."""
+        passwords = ['password1', 'password2', 'password3']
+        reports = []
+        for workers in [1, 2]:
+            hashes = importer.hash_passwords(
+                passwords, workers, lambda *args: reports.append(args)
+            )
+            self.assertEqual(len(hashes), 3)
+            for password, hashed in zip(passwords, hashes):
+                self.assertTrue(pbkdf2_sha256.verify(password, hashed))
+        self.assertEqual(reports, [(3, 3), (3, 3)])
@@ -0,0 +1,145 @@
+# !/usr/bin/env python3
+"""
+Meerkat Auth Tests
+
+Unit tests for the jwks.py module in Meerkat Auth.
+"""
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from meerkat_auth import jwks, app
+from unittest import mock
+import unittest
+import calendar
+import time
+import json
+import jwt
+
+
+def generate_keys(curve=None):
+    """Returns a new (private, public) PEM encoded key pair."""
+    if curve:
+        key = ec.generate_private_key(curve, default_backend())
+    else:
+        key = rsa.generate_private_key(65537, 2048, default_backend())
+    private = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption()
+    ).decode('utf-8')
+    public = key.public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode('utf-8')
+    return private, public
+
+
+class MeerkatAuthJWKSTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """Generate keys once, because RSA key generation is slow."""
+        cls.private, cls.public = generate_keys()
+        cls.old_private, cls.old_public = generate_keys()
+
+    def setUp(self):
+        """Setup for testing"""
+        self.jwks = jwks.get_jwks([self.public, self.old_public], 'RS256')
+        self.exp = calendar.timegm(time.gmtime()) + 30
+
+    def mock_response(self, cache_control='public, max-age=600'):
+        response = mock.Mock()
+        response.json.return_value = json.loads(json.dumps(self.jwks))
+        response.headers = {'Cache-Control': cache_control}
+        return response
+
+    def test_get_jwks(self):
+        """Test the key set is assembled correctly."""
+        keys = self.jwks['keys']
+        self.assertEqual(len(keys), 2)
+        self.assertEqual(keys[0]['kid'], jwks.key_id(self.public))
+        self.assertEqual(keys[1]['kid'], jwks.key_id(self.old_public))
+        self.assertNotEqual(keys[0]['kid'], keys[1]['kid'])
+        for key in keys:
+            self.assertEqual(key['kty'], 'RSA')
+            self.assertEqual(key['alg'], 'RS256')
+            self.assertEqual(key['use'], 'sig')
+
+        # Key IDs must be stable between nodes i.e. derived from the key.
+        self.assertEqual(
+            jwks.key_id(self.public),
+            jwks.key_id(self.public.encode('utf-8'))
+        )
+
+    def test_jwk_round_trip(self):
+        """Test JWKs convert back into keys that verify tokens."""
+        for curve in [None, ec.SECP256R1()]:
+            private, public = generate_keys(curve)
+            algorithm = 'ES256' if curve else 'RS256'
+            token = jwt.encode({'usr': 'a'}, private, algorithm=algorithm)
+            key = jwks.from_jwk(jwks.to_jwk(jwks.load_public_key(public)))
+            payload = jwt.decode(token, key, algorithms=[algorithm])
+            self.assertEqual(payload['usr'], 'a')
+
+    @mock.patch('meerkat_auth.jwks.requests.get')
+    def test_key_set(self, get_mock):
+        """Test the KeySet verifies tokens and caches the key set."""
+        get_mock.return_value = self.mock_response()
+        key_set = jwks.KeySet('http://auth/api/.well-known/jwks.json')
+
+        # Tokens signed with current and retired keys both verify.
+        for private, public in [(self.private, self.public),
+                                (self.old_private, self.old_public)]:
+            token = jwt.encode(
+                {'usr': 'testUser1', 'exp': self.exp},
+                private,
+                algorithm='RS256',
+                headers={'kid': jwks.key_id(public)}
+            )
+            payload = key_set.verify(token, ['RS256'])
+            self.assertEqual(payload['usr'], 'testUser1')
+
+        # The key set is only fetched once and the max-age is respected.
+        self.assertEqual(get_mock.call_count, 1)
+        self.assertAlmostEqual(
+            key_set.expires, key_set.fetched + 600, delta=1
+        )
+
+        # Unknown key IDs are rejected, and the refetch is rate limited.
+        private, public = generate_keys()
+        token = jwt.encode(
+            {'usr': 'testUser1', 'exp': self.exp},
+            private,
+            algorithm='RS256',
+            headers={'kid': jwks.key_id(public)}
+        )
+        self.assertRaises(
+            jwt.InvalidTokenError,
+            lambda: key_set.verify(token, ['RS256'])
+        )
+        self.assertEqual(get_mock.call_count, 1)
+
+        # A token signed with an unpublished key but a known kid fails.
+        token = jwt.encode(
+            {'usr': 'testUser1', 'exp': self.exp},
+            private,
+            algorithm='RS256',
+            headers={'kid': jwks.key_id(self.public)}
+        )
+        self.assertRaises(
+            jwt.InvalidTokenError,
+            lambda: key_set.verify(token, ['RS256'])
+        )
+
+    def test_jwks_endpoint(self):
+        """Test the jwks.json endpoint publishes the configured keys."""
+        config = {
+            'JWT_PUBLIC_KEY': self.public,
+            'JWT_PREVIOUS_PUBLIC_KEYS': [self.old_public],
+            'JWT_ALGORITHM': 'RS256'
+        }
+        with mock.patch.dict(app.config, config):
+            response = app.test_client().get('/api/.well-known/jwks.json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data.decode('UTF-8')), self.jwks)
+        self.assertIn('max-age', response.headers['Cache-Control'])
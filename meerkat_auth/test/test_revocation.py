@@ -0,0 +1,146 @@
+# !/usr/bin/env python3
+"""
+Meerkat Auth Tests
+
+Unit tests for the revocation.py module in Meerkat Auth.
+"""
+from meerkat_auth.revocation import RevocationList, RevocationStore
+from meerkat_auth.revocation import DynamoRevocationStore
+from meerkat_auth.authorise import Authorise
+from meerkat_auth.revocation import RevokedTokenError
+from meerkat_auth import app
+from unittest import mock
+import unittest
+import uuid
+import time
+
+
+class MemoryStore(RevocationStore):
+    """A revocation store shared between RevocationLists in the same test."""
+
+    def __init__(self):
+        self.entries = []
+
+    def add(self, entry):
+        self.entries.append({**entry, 'created': time.time()})
+
+    def load(self, since):
+        return [e for e in self.entries if e['created'] >= since]
+
+
+class MeerkatAuthRevocationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        """Setup for testing"""
+        self.now = int(time.time())
+        self.store = MemoryStore()
+        self.revocations = RevocationList(self.store, sync_interval=0)
+
+    def token(self, usr='testUser1', iat=None, exp=None, sid=None):
+        return {
+            'usr': usr,
+            'iat': self.now - 10 if iat is None else iat,
+            'exp': self.now + 3600 if exp is None else exp,
+            'jti': uuid.uuid4().hex,
+            'sid': sid
+        }
+
+    def test_revoke_token(self):
+        """Test single tokens can be revoked by jti."""
+        token1 = self.token()
+        token2 = self.token()
+        self.revocations.revoke_token(token1['jti'], token1['exp'])
+        self.assertTrue(self.revocations.is_revoked(token1))
+        self.assertFalse(self.revocations.is_revoked(token2))
+
+        # Tokens without a jti can't be revoked individually.
+        del token2['jti']
+        self.assertFalse(self.revocations.is_revoked(token2))
+
+    def test_revoke_user(self):
+        """Test all tokens issued to a user before a time can be revoked."""
+        self.revocations.revoke_user('testUser1', max_life=3600)
+        self.assertTrue(self.revocations.is_revoked(self.token()))
+        self.assertFalse(
+            self.revocations.is_revoked(self.token(usr='testUser2'))
+        )
+        self.assertFalse(
+            self.revocations.is_revoked(self.token(iat=self.now + 10))
+        )
+
+    def test_revoke_user_same_second(self):
+        """Test tokens from the revoking second are revoked, unless kept."""
+        kept = self.token(iat=self.now)
+        self.revocations.revoke_user(
+            'testUser1', self.now + 0.5, max_life=3600, keep=kept['jti']
+        )
+        self.assertTrue(self.revocations.is_revoked(self.token(iat=self.now)))
+        self.assertFalse(self.revocations.is_revoked(kept))
+
+        # Another node keeps the same token, until a later revocation.
+        other_node = RevocationList(self.store, sync_interval=0)
+        self.assertFalse(other_node.is_revoked(kept))
+        self.revocations.revoke_user('testUser1', self.now + 0.9, 3600)
+        self.assertTrue(self.revocations.is_revoked(kept))
+        self.assertTrue(other_node.is_revoked(kept))
+
+    def test_sync_and_purge(self):
+        """Test revocations are shared between nodes and expire."""
+        token = self.token()
+        other_node = RevocationList(self.store, sync_interval=0)
+        self.revocations.revoke_token(token['jti'], token['exp'])
+        self.revocations.revoke_user('testUser2', max_life=3600)
+        self.revocations.revoke_session('session1', self.now + 3600)
+        self.assertTrue(other_node.is_revoked(token))
+        self.assertTrue(other_node.is_revoked(self.token(usr='testUser2')))
+        self.assertTrue(other_node.is_revoked(self.token(sid='session1')))
+        self.assertFalse(other_node.is_revoked(self.token(sid='session2')))
+
+        # Once the tokens have expired the entries are dropped.
+        with mock.patch('meerkat_auth.revocation.time.time') as clock:
+            clock.return_value = self.now + 7200
+            other_node.purge()
+        self.assertEqual(other_node.buckets, {})
+        self.assertEqual(other_node.users, {})
+        self.assertEqual(other_node.sessions, {})
+
+    def test_dynamo_store(self):
+        """Test the DynamoDB store only queries entries since the sync."""
+        store = DynamoRevocationStore()
+        old = {'kind': 'jti', 'jti': uuid.uuid4().hex, 'expires': self.now}
+        new = {'kind': 'jti', 'jti': uuid.uuid4().hex, 'expires': self.now}
+        scan = mock.patch('meerkat_auth.storage.LocalTable.scan').start()
+        self.addCleanup(mock.patch.stopall)
+        mock.patch.dict(app.config, {'REVOCATION_BUCKET': 100}).start()
+        clock = mock.patch('meerkat_auth.revocation.time.time').start()
+
+        clock.return_value = self.now - 250
+        store.add(old)
+        clock.return_value = self.now
+        store.add(new)
+
+        def jtis(since):
+            return [
+                e['jti'] for e in store.load(since)
+                if e['jti'] in [old['jti'], new['jti']]
+            ]
+        self.assertEqual(jtis(self.now - 300), [old['jti'], new['jti']])
+        self.assertEqual(jtis(self.now - 10), [new['jti']])
+        self.assertEqual(jtis(self.now + 1), [])
+        scan.assert_not_called()
+
+    def test_decode_token(self):
+        """Test Authorise rejects revoked tokens without a database read."""
+        token = self.token()
+        config = {'JWT_PUBLIC_KEY': 'key', 'JWT_ALGORITHM': 'RS256'}
+        with mock.patch('meerkat_auth.authorise.jwt.decode') as decode, \
+                mock.patch('meerkat_auth.authorise.revocations',
+                           self.revocations), \
+                mock.patch.dict(app.config, config):
+            decode.return_value = token
+            self.assertEqual(Authorise().decode_token('token'), token)
+            self.revocations.revoke_token(token['jti'], token['exp'])
+            self.assertRaises(
+                RevokedTokenError,
+                lambda: Authorise().decode_token('token')
+            )
@@ -7,9 +7,9 @@ Unit tests for the utility class role in Meerkat Auth.
 
 from meerkat_auth.role import Role, InvalidRoleException
 from meerkat_auth import app
+from unittest import mock
 import unittest
 import logging
-import boto3
 
 
 class MeerkatAuthRoleTestCase(unittest.TestCase):
@@ -18,11 +18,6 @@ class MeerkatAuthRoleTestCase(unittest.TestCase):
         """Setup for testing"""
         app.config.from_object('meerkat_auth.config.Testing')
         app.config.from_envvar('MEERKAT_AUTH_SETTINGS')
-        Role.DB = boto3.resource(
-            'dynamodb',
-            endpoint_url=app.config['DB_URL'],
-            region_name='eu-west-1'
-        )
         logging.warning(app.config['USERS'])
         logging.warning(app.config['ROLES'])
         logging.warning(app.config['DB_URL'])
@@ -135,8 +130,23 @@ class MeerkatAuthRoleTestCase(unittest.TestCase):
         except InvalidRoleException as e:
             self.fail(repr(e))
 
+        # Check that deleting a role with children is refused.
+        self.assertRaises(
+            InvalidRoleException, lambda: Role.delete('demo', 'shared')
+        )
+        Role.validate_role('demo', 'manager')
+
+        # Check a child written by another process is seen despite the cache.
+        from meerkat_auth.role_graph import RoleGraph
+        RoleGraph.cached()
+        with mock.patch.object(Role, 'invalidate_graph'):
+            Role('demo', 'deputy', 'Deputy.', ['manager']).to_db()
+        self.assertRaises(
+            InvalidRoleException, lambda: Role.delete('demo', 'manager')
+        )
+
         # Check that breaking the ancestor tree breaks the validation.
-        Role.delete('demo', 'shared')
+        Role.delete('demo', 'shared', force=True)
         self.assertRaises(
             InvalidRoleException, lambda: Role.validate_role('demo', 'manager')
         )
@@ -162,3 +172,48 @@ class MeerkatAuthRoleTestCase(unittest.TestCase):
         # Request all roles.
         response = Role.get_all(['demo', 'jordan'])
         self.assertEqual(len(response), 6)
+
+        # Consistent loads use consistent reads, and aren't shared.
+        table = Role.DB.Table(app.config['ROLES'])
+        query = mock.Mock(wraps=table.query)
+        with mock.patch.object(Role.DB, 'Table', return_value=table), \
+                mock.patch.object(table, 'query', query), \
+                mock.patch.object(Role.LOADS, 'do') as do:
+            response = Role.get_all(['demo'], consistent=True)
+        self.assertEqual(len(response), 4)
+        self.assertTrue(query.call_args[1]['ConsistentRead'])
+        do.assert_not_called()
+
+    def test_holders(self):
+        """Test finding the users that hold or inherit a role."""
+        # Imported here as only this test needs users.
+        from meerkat_auth.user import User
+        user = User(
+            'testUser1',
+            'test1@test.org.uk',
+            User.hash_password('password1'),
+            ['demo', 'jordan'],
+            ['personal', 'registered'],
+            state='new'
+        )
+        user.to_db()
+        try:
+            self.assertEqual(
+                Role.holders('demo', 'personal', inherited=False),
+                ['testUser1']
+            )
+            self.assertEqual(Role.holders('demo', 'registered'), ['testUser1'])
+            self.assertEqual(
+                Role.holders('demo', 'registered', inherited=False), []
+            )
+            self.assertEqual(Role.holders('demo', 'manager'), [])
+
+            # The index follows changes to the user's roles.
+            user.roles = ['manager', 'registered']
+            user.to_db()
+            self.assertEqual(Role.holders('demo', 'personal', False), [])
+            self.assertEqual(Role.holders('demo', 'personal'), ['testUser1'])
+        finally:
+            User.delete('testUser1')
+        self.assertEqual(Role.holders('demo', 'personal'), [])
+        self.assertEqual(Role.holders('jordan', 'registered'), [])
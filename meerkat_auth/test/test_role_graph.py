@@ -0,0 +1,221 @@
+# !/usr/bin/env python3
+"""
+Meerkat Auth Tests
+
+Unit tests for the utility class RoleGraph in Meerkat Auth.
+"""
+
+from meerkat_auth.role import Role, InvalidRoleException
+from meerkat_auth.role_graph import RoleGraph
+import unittest
+
+
+class MeerkatAuthRoleGraphTestCase(unittest.TestCase):
+
+    def setUp(self):
+        """Setup for testing"""
+        self.roles = [
+            Role('demo', 'registered', 'Registered.', []),
+            Role('demo', 'personal', 'Personal.', ['registered']),
+            Role('demo', 'shared', 'Shared.', ['registered']),
+            Role('demo', 'manager', 'Manager.', ['personal', 'shared']),
+            Role('jordan', 'registered', 'Registered.', []),
+            Role('jordan', 'personal', 'Personal.', ['registered'])
+        ]
+        self.graph = RoleGraph(self.roles)
+
+    def test_all_access(self):
+        """Test the complete access lists are ordered as Role orders them."""
+        self.assertEqual(
+            self.graph.all_access('demo', 'manager'),
+            ['manager', 'personal', 'registered', 'shared']
+        )
+        self.assertEqual(
+            self.graph.all_access('demo', 'registered'), ['registered']
+        )
+        self.assertEqual(
+            self.graph.all_access('jordan', 'personal'),
+            ['personal', 'registered']
+        )
+
+        # Role dictionaries, as returned by Role.get_all(), also work.
+        graph = RoleGraph([{
+            'country': r.country,
+            'role': r.role,
+            'description': r.description,
+            'parents': r.parents
+        } for r in self.roles])
+        self.assertEqual(
+            graph.all_access('demo', 'manager'),
+            self.graph.all_access('demo', 'manager')
+        )
+
+    def test_get_access(self):
+        """Test the access for a set of roles matches User.get_access()."""
+        access = self.graph.get_access(
+            ['demo', 'jordan'], ['manager', 'personal']
+        )
+        self.assertEqual(access, {
+            'demo': ['manager', 'personal', 'registered', 'shared'],
+            'jordan': ['personal', 'registered']
+        })
+
+    def test_invalid(self):
+        """Test missing roles and cycles raise InvalidRoleExceptions."""
+        self.assertRaises(
+            InvalidRoleException,
+            lambda: self.graph.get('demo', 'missing')
+        )
+        graph = RoleGraph(self.roles + [
+            Role('demo', 'broken', 'Broken.', ['missing'])
+        ])
+        self.assertRaises(
+            InvalidRoleException,
+            lambda: graph.all_access('demo', 'broken')
+        )
+        graph = RoleGraph([
+            Role('demo', 'a', 'A.', ['b']),
+            Role('demo', 'b', 'B.', ['a'])
+        ])
+        self.assertRaises(
+            InvalidRoleException,
+            lambda: graph.all_access('demo', 'a')
+        )
+
+    def test_validate(self):
+        """Test every problem in a proposed graph is found in one pass."""
+        self.assertEqual(self.graph.validate(), [])
+        graph = RoleGraph(self.roles + [
+            Role('demo', 'orphan', 'Orphan.', ['missing']),
+            Role('demo', 'secret', 'Secret.', [], visible=['nobody']),
+            Role('demo', 'loop1', 'Loop.', ['loop2']),
+            Role('demo', 'loop2', 'Loop.', ['registered', 'loop1'])
+        ])
+        problems = graph.validate()
+        self.assertEqual(len(problems), 3)
+        self.assertEqual(
+            sorted(p.role for p in problems), ['loop1', 'orphan', 'secret']
+        )
+        for problem in problems:
+            self.assertIsInstance(problem, InvalidRoleException)
+
+    def test_topological_order(self):
+        """Test each role comes after its parents and bad roles are left."""
+        order = [(r.country, r.role) for r in self.graph.topological_order()]
+        self.assertEqual(len(order), len(self.roles))
+        for role in self.roles:
+            for parent in role.parents:
+                self.assertLess(
+                    order.index((role.country, parent)),
+                    order.index((role.country, role.role))
+                )
+
+        graph = RoleGraph(self.roles + [
+            Role('demo', 'orphan', 'Orphan.', ['missing']),
+            Role('demo', 'child', 'Child of orphan.', ['orphan']),
+            Role('demo', 'loop1', 'Loop.', ['loop2']),
+            Role('demo', 'loop2', 'Loop.', ['loop1'])
+        ])
+        self.assertEqual(
+            [r.role for r in graph.topological_order()],
+            [r.role for r in self.graph.topological_order()]
+        )
+
+    def test_diff(self):
+        """Test comparing a proposed graph with the current graph."""
+        proposed = RoleGraph(self.roles[:-1] + [
+            Role('demo', 'shared', 'Shared.', ['registered'], visible=['x']),
+            Role('demo', 'extra', 'Extra.', [])
+        ])
+        self.assertEqual(proposed.diff(self.graph), {
+            'added': [('demo', 'extra')],
+            'removed': [('jordan', 'personal')],
+            'changed': [('demo', 'shared')]
+        })
+        self.assertEqual(
+            RoleGraph(self.graph.to_list()).diff(self.graph),
+            {'added': [], 'removed': [], 'changed': []}
+        )
+
+    def test_descendants(self):
+        """Test finding the roles that inherit from a role."""
+        self.assertEqual(
+            self.graph.descendants('demo', 'registered'),
+            ['manager', 'personal', 'shared']
+        )
+        self.assertEqual(self.graph.descendants('demo', 'manager'), [])
+        self.assertEqual(
+            self.graph.children('demo', 'registered'), ['personal', 'shared']
+        )
+        self.assertEqual(self.graph.children('demo', 'personal'), ['manager'])
+        self.assertEqual(self.graph.descendants('jordan', 'missing'), [])
+
+        # A child with a broken co-parent still inherits from the role.
+        broken = RoleGraph([
+            Role('demo', 'shared', 'Shared.', []),
+            Role('demo', 'child', 'Child.', ['shared', 'missing']),
+            Role('demo', 'grandchild', 'Grandchild.', ['child'])
+        ])
+        self.assertEqual(
+            broken.descendants('demo', 'shared'), ['child', 'grandchild']
+        )
+        self.assertEqual(broken.children('demo', 'shared'), ['child'])
+
+    def test_closures(self):
+        """Test listing every role with its complete access."""
+        closures = self.graph.closures(['demo'])
+        self.assertEqual(list(closures.keys()), ['demo'])
+        self.assertEqual(
+            set(closures['demo']),
+            {'registered', 'personal', 'shared', 'manager'}
+        )
+        manager = closures['demo']['manager']
+        self.assertEqual(
+            manager['access'],
+            self.graph.all_access('demo', 'manager')
+        )
+        self.assertEqual(manager['parents'], ['personal', 'shared'])
+        self.assertNotIn('error', manager)
+
+        # Broken roles are reported rather than raising.
+        broken = RoleGraph([
+            {'country': 'demo', 'role': 'orphan', 'parents': ['missing']}
+        ])
+        orphan = broken.closures()['demo']['orphan']
+        self.assertEqual(orphan['access'], [])
+        self.assertTrue(orphan['error'])
+
+    def test_visible_roles(self):
+        """Test hiding roles from users without the required access."""
+        graph = RoleGraph(self.roles + [
+            Role('demo', 'admin', 'Admin.', ['manager'], visible=['admin'])
+        ])
+        visible = graph.visible_roles('demo', ['registered'])
+        self.assertEqual(
+            [r['role'] for r in visible],
+            ['manager', 'personal', 'registered', 'shared']
+        )
+        self.assertEqual(
+            [r['role'] for r in graph.visible_roles('demo', ['admin'])],
+            ['admin', 'manager', 'personal', 'registered', 'shared']
+        )
+        self.assertEqual(visible[0]['parents'], ['personal', 'shared'])
+
+        # The same access signature reuses the same result.
+        self.assertIs(
+            graph.visible_roles('demo', ['registered', 'registered']), visible
+        )
+        self.assertEqual(graph.visible_roles('missing', ['admin']), [])
+
+    def test_inheritors(self):
+        """Test finding the roles that have a role's access."""
+        self.assertEqual(
+            self.graph.inheritors('demo', 'registered'),
+            ['registered', 'manager', 'personal', 'shared']
+        )
+        self.assertEqual(
+            self.graph.inheritors('demo', 'manager'), ['manager']
+        )
+        self.assertEqual(
+            self.graph.inheritors('jordan', 'missing'), ['missing']
+        )
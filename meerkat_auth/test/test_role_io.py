@@ -0,0 +1,53 @@
+# !/usr/bin/env python3
+"""
+Meerkat Auth Tests
+
+Unit tests for the role_io.py module in Meerkat Auth.
+"""
+from meerkat_auth import role_io
+import unittest
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+class MeerkatAuthRoleIOTestCase(unittest.TestCase):
+
+    def setUp(self):
+        """Setup for testing"""
+        self.roles = [{
+            'country': 'demo',
+            'role': 'registered',
+            'description': 'Registered.',
+            'parents': [],
+            'visible': []
+        }, {
+            'country': 'demo',
+            'role': 'emails',
+            'description': 'Emails.',
+            'parents': ['registered'],
+            'visible': ['registered']
+        }]
+
+    def test_json(self):
+        """Test roles survive a round trip through JSON."""
+        text = role_io.dump(self.roles, 'json')
+        self.assertEqual(role_io.load(text, 'json'), self.roles)
+
+    @unittest.skipIf(yaml is None, 'PyYAML is not installed.')
+    def test_yaml(self):
+        """Test roles survive a round trip through YAML."""
+        text = role_io.dump(self.roles, 'yaml')
+        self.assertEqual(role_io.load(text, 'yaml'), self.roles)
+
+    def test_load(self):
+        """Test badly formed role lists are rejected."""
+        self.assertRaises(ValueError, role_io.load, '{}', 'json')
+        self.assertRaises(ValueError, role_io.load, '[{"role": "x"}]', 'json')
+        self.assertRaises(
+            ValueError, role_io.load,
+            '[{"country": "demo", "role": "x", "parents": "y"}]', 'json'
+        )
+        self.assertRaises(ValueError, role_io.load, '[]', 'xml')
@@ -0,0 +1,229 @@
+# !/usr/bin/env python3
+"""
+Meerkat Auth Tests
+
+Unit tests for the local storage backends in storage.py in Meerkat Auth.
+"""
+from meerkat_auth.storage import MemoryBackend, SQLiteBackend
+from meerkat_auth.storage import ConditionalCheckFailedException
+from meerkat_auth import app
+from boto3.dynamodb.conditions import Attr, Key
+from decimal import Decimal
+from unittest import mock
+import unittest
+import tempfile
+import os
+
+
+class BackendTests:
+    """Tests run against each local backend, created by backend()."""
+
+    def setUp(self):
+        """Setup for testing"""
+        tables = {'USERS': 'users', 'ROLE_INDEX': 'role_index'}
+        mock.patch.dict(app.config, tables).start()
+        self.db = self.backend()
+        self.users = self.db.Table('users')
+        self.index = self.db.Table('role_index')
+
+    def tearDown(self):
+        """Tear down after testing."""
+        mock.patch.stopall()
+
+    def test_items(self):
+        """Test writing, reading and deleting single items."""
+        item = {'username': 'testUser1', 'roles': ['personal'], 'age': 3}
+        self.users.put_item(Item=item)
+        self.assertEqual(
+            self.users.get_item(Key={'username': 'testUser1'})['Item'],
+            {'username': 'testUser1', 'roles': ['personal'],
+             'age': Decimal(3)}
+        )
+        self.assertEqual(self.users.get_item(Key={'username': 'other'}), {})
+
+        # Only the requested attributes are returned.
+        response = self.users.get_item(
+            Key={'username': 'testUser1'},
+            ProjectionExpression='#a',
+            ExpressionAttributeNames={'#a': 'roles'}
+        )
+        self.assertEqual(response['Item'], {'roles': ['personal']})
+
+        response = self.users.delete_item(
+            Key={'username': 'testUser1'}, ReturnValues='ALL_OLD'
+        )
+        self.assertEqual(response['Attributes']['roles'], ['personal'])
+        self.assertEqual(self.users.get_item(Key=item), {})
+
+        # Floats are rejected, as by boto3.
+        self.assertRaises(TypeError, lambda: self.users.put_item(
+            Item={'username': 'testUser1', 'age': 3.5}
+        ))
+
+    def test_updates(self):
+        """Test update expressions, attribute updates and conditions."""
+        self.users.put_item(Item={
+            'username': 'testUser1', 'countries': ['demo', 'jordan'],
+            'roles': ['personal', 'registered'], 'access': {}
+        })
+        key = {'username': 'testUser1'}
+
+        # Conditional updates only succeed if the item is as expected.
+        update = {
+            'Key': key,
+            'UpdateExpression': (
+                'SET #c = list_append(#c, :c), #r = list_append(#r, :r) '
+                'REMOVE #a'
+            ),
+            'ConditionExpression': Attr('roles').eq(['personal']),
+            'ExpressionAttributeNames': {
+                '#c': 'countries', '#r': 'roles', '#a': 'access'
+            },
+            'ExpressionAttributeValues': {':c': ['demo'], ':r': ['manager']},
+            'ReturnValues': 'UPDATED_NEW'
+        }
+        self.assertRaises(
+            self.db.meta.client.exceptions.ConditionalCheckFailedException,
+            lambda: self.users.update_item(**update)
+        )
+        update['ConditionExpression'] = (
+            Attr('roles').eq(['personal', 'registered']) &
+            Attr('countries').contains('jordan')
+        )
+        response = self.users.update_item(**update)
+        self.assertEqual(response['Attributes'], {
+            'countries': ['demo', 'jordan', 'demo'],
+            'roles': ['personal', 'registered', 'manager']
+        })
+
+        # Removing list elements removes those in the list before the update.
+        self.users.update_item(
+            Key=key,
+            UpdateExpression='REMOVE #c[0], #r[0], #c[2], #r[2]',
+            ExpressionAttributeNames={'#c': 'countries', '#r': 'roles'}
+        )
+        item = self.users.get_item(Key=key)['Item']
+        self.assertEqual(item, {
+            'username': 'testUser1',
+            'countries': ['jordan'],
+            'roles': ['registered']
+        })
+
+        # The older Expected and AttributeUpdates parameters also work, and
+        # updating an item that doesn't exist creates it.
+        self.assertRaises(
+            ConditionalCheckFailedException,
+            lambda: self.users.update_item(
+                Key={'username': 'testUser2'},
+                AttributeUpdates={'email': {'Value': 'a@b.c'}},
+                Expected={'username': {'Value': 'testUser2'}}
+            )
+        )
+        response = self.users.update_item(
+            Key={'username': 'testUser2'},
+            AttributeUpdates={'email': {'Value': 'a@b.c', 'Action': 'PUT'}},
+            ReturnValues='ALL_NEW'
+        )
+        self.assertEqual(
+            response['Attributes'], {'username': 'testUser2', 'email': 'a@b.c'}
+        )
+
+    def test_scan_and_query(self):
+        """Test scans and queries return every page of matching items."""
+        for i in range(7):
+            self.users.put_item(Item={
+                'username': 'user{}'.format(i),
+                'countries': ['demo'] if i % 2 else ['jordan']
+            })
+            self.index.put_item(Item={
+                'role_key': 'demo:personal' if i < 5 else 'demo:manager',
+                'username': 'user{}'.format(i)
+            })
+
+        def read_all(operation, **kwargs):
+            items = []
+            while True:
+                response = operation(**kwargs)
+                items += response['Items']
+                if 'LastEvaluatedKey' not in response:
+                    return items
+                kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+        items = read_all(
+            self.users.scan,
+            Limit=2,
+            FilterExpression=Attr('countries').contains('demo'),
+            ProjectionExpression='username'
+        )
+        self.assertEqual(items, [
+            {'username': 'user1'}, {'username': 'user3'},
+            {'username': 'user5'}
+        ])
+
+        items = read_all(
+            self.index.query,
+            Limit=2,
+            KeyConditionExpression=Key('role_key').eq('demo:personal')
+        )
+        self.assertEqual(
+            [i['username'] for i in items],
+            ['user0', 'user1', 'user2', 'user3', 'user4']
+        )
+        items = read_all(self.index.query, KeyConditions={'role_key': {
+            'AttributeValueList': ['demo:manager'],
+            'ComparisonOperator': 'EQ'
+        }})
+        self.assertEqual([i['username'] for i in items], ['user5', 'user6'])
+
+    def test_batches(self):
+        """Test batch reads and writes, and the batch writer."""
+        response = self.db.batch_write_item(RequestItems={'users': [
+            {'PutRequest': {'Item': {'username': 'a', 'email': 'a@b.c'}}},
+            {'PutRequest': {'Item': {'username': 'b', 'email': 'b@b.c'}}}
+        ]})
+        self.assertEqual(response['UnprocessedItems'], {})
+        with self.index.batch_writer() as batch:
+            batch.put_item(Item={'role_key': 'demo:root', 'username': 'a'})
+
+        response = self.db.batch_get_item(RequestItems={
+            'users': {'Keys': [{'username': 'a'}, {'username': 'x'}],
+                      'ProjectionExpression': 'email'},
+            'role_index': {'Keys': [{'role_key': 'demo:root',
+                                     'username': 'a'}]}
+        })
+        self.assertEqual(response['Responses'], {
+            'users': [{'email': 'a@b.c'}],
+            'role_index': [{'role_key': 'demo:root', 'username': 'a'}]
+        })
+
+        self.db.batch_write_item(RequestItems={'users': [
+            {'DeleteRequest': {'Key': {'username': 'a'}}}
+        ]})
+        self.assertEqual(
+            [i['username'] for i in self.users.scan()['Items']], ['b']
+        )
+
+
+class MeerkatAuthMemoryBackendTestCase(BackendTests, unittest.TestCase):
+
+    def backend(self):
+        return MemoryBackend()
+
+
+class MeerkatAuthSQLiteBackendTestCase(BackendTests, unittest.TestCase):
+
+    def backend(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        backend = SQLiteBackend(os.path.join(directory.name, 'auth.db'))
+        self.addCleanup(backend.connection.close)
+        return backend
+
+    def test_shared_file(self):
+        """Test processes sharing the database file see each other's writes."""
+        self.users.put_item(Item={'username': 'testUser1'})
+        other = SQLiteBackend(self.db.path)
+        self.addCleanup(other.connection.close)
+        self.assertTrue(
+            other.Table('users').get_item(Key={'username': 'testUser1'})
+        )
@@ -6,15 +6,16 @@ Unit tests for the utility class User in Meerkat Auth.
 """
 
 from meerkat_auth.user import User, InvalidCredentialException
+from meerkat_auth.user import UnreadUsersException
 from meerkat_auth.role import Role, InvalidRoleException
 from meerkat_auth import app
+from unittest import mock
 import unittest
 import jwt
 import calendar
 import time
 import logging
 import os
-import boto3
 
 # Hacky!
 # Need this module to be importable without the whole of meerkat_auth config.
@@ -32,16 +33,6 @@ class MeerkatAuthUserTestCase(unittest.TestCase):
         """Setup for testing"""
         app.config.from_object('meerkat_auth.config.Testing')
         app.config.from_envvar('MEERKAT_AUTH_SETTINGS')
-        User.DB = boto3.resource(
-            'dynamodb',
-            endpoint_url=app.config['DB_URL'],
-            region_name='eu-west-1'
-        )
-        Role.DB = boto3.resource(
-            'dynamodb',
-            endpoint_url=app.config['DB_URL'],
-            region_name='eu-west-1'
-        )
         logging.warning(app.config['USERS'])
         logging.warning(app.config['ROLES'])
         logging.warning(app.config['DB_URL'])
@@ -65,6 +56,26 @@ class MeerkatAuthUserTestCase(unittest.TestCase):
         User.delete('testUser1')
         User.delete('testUser2')
 
+    def throttle(self, processed):
+        """Patches the database to only ever read the given usernames."""
+        batch_get_item = User.DB.batch_get_item
+
+        def throttled(RequestItems):
+            requests = RequestItems[app.config['USERS']]
+            keys = [{'username': u} for u in processed]
+            keys = [k for k in requests['Keys'] if k in keys]
+            others = [k for k in requests['Keys'] if k not in keys]
+            response = batch_get_item(RequestItems={app.config['USERS']: {
+                **requests, 'Keys': keys
+            }})
+            if others:
+                response['UnprocessedKeys'] = {app.config['USERS']: {
+                    **requests, 'Keys': others
+                }}
+            return response
+
+        return mock.patch.object(User.DB, 'batch_get_item', throttled)
+
     def test_io(self):
         """Test the User class' database writing/reading/deleting functions."""
         user1 = User(
@@ -131,7 +142,7 @@ class MeerkatAuthUserTestCase(unittest.TestCase):
 
         # Check that get_access breaks appropriately if the roles are wrong.
         demo_registered = Role.from_db('demo', 'registered')
-        print(Role.delete('demo', 'registered'))
+        print(Role.delete('demo', 'registered', force=True))
         self.assertRaises(InvalidRoleException, lambda: user.get_access())
         demo_registered.to_db()
 
@@ -189,6 +200,10 @@ class MeerkatAuthUserTestCase(unittest.TestCase):
         for key in expected_acc.keys():
             self.assertEqual(set(expected_acc[key]), set(decoded_acc[key]))
 
+        # Each token has a unique ID, so that it can be revoked.
+        self.assertTrue(decoded.pop('jti'))
+        self.assertLessEqual(decoded.pop('iat'), exp)
+
         # Check the rest of the tokens are equal.
         decoded.pop('acc', None)
         self.assertEqual(expected, decoded)
@@ -398,10 +413,243 @@ class MeerkatAuthUserTestCase(unittest.TestCase):
         response = User.get_all([], None)
 
         # We don't know what order the responses will be returned in.
+        # Items also hold the users' stored access, which to_dict() omits.
         for item in response:
+            self.assertTrue(item.pop('access'))
             if item['username'] == user1.username:
                 self.assertEqual(item, user1.to_dict())
             elif item['username'] == user2.username:
                 self.assertEqual(item, user2.to_dict())
             else:
                 self.assertTrue(False)
+
+        # Filter by role, which must be held in one of the given countries.
+        response = User.get_all([], ['email'], role='manager')
+        self.assertEqual([u['username'] for u in response], [user1.username])
+        self.assertEqual(
+            User.get_all(['jordan'], ['email'], role='manager'), []
+        )
+        response = User.get_all(['demo'], ['email'], role='personal')
+        self.assertEqual(response, [{
+            'username': user2.username,
+            'email': user2.email
+        }])
+
+        # Filter by text in the username or email.
+        response = User.get_all(['demo'], ['email'], search='test1@')
+        self.assertEqual([u['username'] for u in response], [user1.username])
+        response = User.get_all(['demo'], ['email'], search='testUser')
+        self.assertEqual(len(response), 2)
+
+    def test_get_record(self):
+        """Test the projection aware record loaders."""
+        user = User(
+            'testUser1',
+            'test1@test.org.uk',
+            User.hash_password('password1'),
+            ['demo', 'jordan'],
+            ['manager', 'personal'],
+            data={'name': 'Testy McTestface'},
+            state='new'
+        )
+        user.to_db()
+
+        # Only the requested attributes (and the username) are loaded.
+        record = User.get_record('testUser1', ['email'])
+        self.assertEqual(record.username, 'testUser1')
+        self.assertEqual(record['email'], 'test1@test.org.uk')
+        self.assertNotIn('password', record)
+        self.assertRaises(AttributeError, lambda: record.roles)
+        self.assertRaises(KeyError, lambda: record['data'])
+        self.assertEqual(record.get('roles', []), [])
+        self.assertEqual(
+            record.to_dict(),
+            {'username': 'testUser1', 'email': 'test1@test.org.uk'}
+        )
+
+        # Records are read only.
+        with self.assertRaises(AttributeError):
+            record.email = 'hacked@test.org.uk'
+
+        # Password hashes are never held by a record.
+        record = User.get_record('testUser1', ['password', 'roles'])
+        self.assertNotIn('password', record)
+        self.assertEqual(record.roles, ['manager', 'personal'])
+
+        self.assertRaises(
+            InvalidCredentialException,
+            lambda: User.get_record('testUser3', ['email'])
+        )
+
+        records, errors = User.get_records(
+            ['testUser1', 'testUser3'], ['state']
+        )
+        self.assertEqual(list(records.keys()), ['testUser1'])
+        self.assertEqual(errors, {})
+        self.assertEqual(records['testUser1'].state, 'live')
+
+    def test_batch_get_throttled(self):
+        """Test users that keep being throttled are reported, not retried."""
+        for username in ['testUser1', 'testUser2']:
+            User(
+                username,
+                username + '@test.org.uk',
+                User.hash_password('password'),
+                ['demo'],
+                ['personal'],
+                state='new'
+            ).to_db()
+
+        with self.throttle(['testUser1']), \
+                mock.patch('meerkat_auth.user.time.sleep') as sleep:
+            with self.assertRaises(UnreadUsersException) as context:
+                User.batch_get(['testUser1', 'testUser2', 'testUser3'],
+                               max_retries=0)
+            self.assertEqual(sleep.call_count, 0)
+            self.assertEqual(
+                sorted(context.exception.usernames), ['testUser2', 'testUser3']
+            )
+            self.assertEqual(list(context.exception.items), ['testUser1'])
+
+            # A batch of users reports them as errors, and the rest as read.
+            users, errors = User.get_many(['testUser1', 'testUser2'])
+            self.assertEqual(sleep.call_count, 8)
+            self.assertEqual(list(users), ['testUser1'])
+            self.assertIn('try again', errors['testUser2'])
+
+            # So do the callers that read users through batch_get().
+            records, errors = User.get_records(
+                ['testUser1', 'testUser2'], ['state']
+            )
+            self.assertEqual(list(records), ['testUser1'])
+            self.assertIn('try again', errors['testUser2'])
+            with mock.patch.object(Role, 'invalidate_graph'):
+                Role('demo', 'personal', 'Personal.', []).to_db()
+            refreshed = User.refresh_access(['testUser1', 'testUser2'])
+            self.assertEqual(refreshed, ['testUser1'])
+
+    def test_batch_delete(self):
+        """Test deleting many users at once."""
+        for username in ['testUser1', 'testUser2']:
+            User(
+                username,
+                username + '@test.org.uk',
+                User.hash_password('password'),
+                ['demo'],
+                ['personal'],
+                state='new'
+            ).to_db()
+
+        failed = User.batch_delete(['testUser1', 'testUser2', 'testUser1'])
+        self.assertEqual(failed, [])
+        self.assertFalse(User.check_username('testUser1'))
+        self.assertFalse(User.check_username('testUser2'))
+
+        # Deleting users that don't exist is not an error.
+        self.assertEqual(User.batch_delete(['testUser3']), [])
+
+        # Users that couldn't be read aren't deleted, but the rest are.
+        for username in ['testUser1', 'testUser2']:
+            User(
+                username,
+                username + '@test.org.uk',
+                User.hash_password('password'),
+                ['demo'],
+                ['personal'],
+                state='new'
+            ).to_db()
+        with self.throttle(['testUser1']), \
+                mock.patch('meerkat_auth.user.time.sleep'):
+            failed = User.batch_delete(['testUser1', 'testUser2'])
+        self.assertEqual(failed, ['testUser2'])
+        self.assertFalse(User.check_username('testUser1'))
+        self.assertTrue(User.check_username('testUser2'))
+
+    def test_materialised_access(self):
+        """Test the access stored on user items is written and refreshed."""
+        user = User(
+            'testUser',
+            'test@test.org.uk',
+            User.hash_password('password'),
+            ['demo', 'jordan'],
+            ['personal', 'personal'],
+            state='new'
+        )
+        user.to_db()
+        stored = User.batch_get(['testUser'], ['access'])['testUser']
+        self.assertEqual(
+            {c: set(r) for c, r in stored['access'].items()},
+            {'demo': {'personal', 'registered'},
+             'jordan': {'personal', 'registered'}}
+        )
+
+        # Loading the user takes the access from the item.
+        user = User.from_db('testUser')
+        self.assertIsNotNone(user.access)
+        self.assertEqual(user.get_access(), stored['access'])
+
+        # Changing a role's ancestry refreshes the access of its holders.
+        Role('demo', 'personal', 'Personal.', []).to_db()
+        stored = User.batch_get(['testUser'], ['access'])['testUser']
+        self.assertEqual(stored['access']['demo'], ['personal'])
+        self.assertNotIn(
+            'testUser', [d['username'] for d in User.audit_access()]
+        )
+        Role('demo', 'personal', 'Personal.', ['registered']).to_db()
+        stored = User.batch_get(['testUser'], ['access'])['testUser']
+        self.assertEqual(
+            set(stored['access']['demo']), {'personal', 'registered'}
+        )
+
+    def test_bulk_update(self):
+        """Test granting and removing roles and changing state in bulk."""
+        for username in ['testUser1', 'testUser2']:
+            User(
+                username,
+                username + '@test.org.uk',
+                User.hash_password('password'),
+                ['demo', 'jordan'],
+                ['personal', 'personal'],
+                state='new'
+            ).to_db()
+        attributes = ['countries', 'roles', 'state']
+        records, errors = User.get_records(
+            ['testUser1', 'testUser2'], attributes
+        )
+        records = [records['testUser1'], records['testUser2']]
+
+        # Grant a role to both users.
+        results = User.bulk_update(records, add=('demo', 'manager'))
+        self.assertEqual(
+            results, {'testUser1': 'updated', 'testUser2': 'updated'}
+        )
+        record = User.get_record('testUser1', attributes)
+        self.assertEqual(record.countries, ['demo', 'jordan', 'demo'])
+        self.assertEqual(record.roles, ['personal', 'personal', 'manager'])
+
+        # The old records are out of date, so can't be used again.
+        results = User.bulk_update(records, state='suspended')
+        self.assertNotIn('updated', results.values())
+        self.assertEqual(User.get_record('testUser1', attributes).state, 'live')
+
+        # Remove a role and change state at once.
+        records = [User.get_record('testUser1', attributes)]
+        results = User.bulk_update(
+            records, remove=('demo', 'personal'), state='suspended'
+        )
+        self.assertEqual(results, {'testUser1': 'updated'})
+        record = User.get_record('testUser1', attributes)
+        self.assertEqual(record.countries, ['jordan', 'demo'])
+        self.assertEqual(record.roles, ['personal', 'manager'])
+        self.assertEqual(record.state, 'suspended')
+
+        # Swap one role for another.
+        self.assertTrue(User.update_access(
+            record, add=('jordan', 'registered'), remove=('demo', 'manager')
+        ))
+        record = User.get_record('testUser1', attributes)
+        self.assertEqual(record.countries, ['jordan', 'jordan'])
+        self.assertEqual(record.roles, ['personal', 'registered'])
+
+        # Nothing to change.
+        self.assertFalse(User.update_access(record, state='suspended'))
@@ -1,10 +1,20 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from meerkat_auth.role import Role
+from meerkat_auth.role import Role, InvalidRoleException
+from meerkat_auth.role_graph import RoleGraph
+from meerkat_auth.role_index import RoleIndex
+from meerkat_auth.cache import TTLCache, SingleFlight
+from meerkat_auth.bloom import ApproximateSet
+from meerkat_auth import jwks, circuit, db
+from boto3.dynamodb.conditions import Attr
 from passlib.hash import pbkdf2_sha256
 from flask import jsonify
 from meerkat_auth import app
+import calendar
+import copy
 import logging
-import boto3
+import uuid
+import time
 import jwt
 import re
 
@@ -17,12 +27,32 @@ class User:
 
     # The regular expression defining whether an email address is valid.
     EMAIL_REGEX = re.compile(r"[^@]+@[^@]+\.[^@]+")
-    # The database resource
-    DB = boto3.resource(
-        'dynamodb',
-        endpoint_url=app.config['DB_URL'],
-        region_name='eu-west-1'
+    # The maximum number of keys DynamoDB accepts in one BatchGetItem request.
+    BATCH_GET_SIZE = 100
+    # The maximum number of items DynamoDB accepts in one BatchWriteItem.
+    BATCH_WRITE_SIZE = 25
+    # The attributes that determine a user's access (see get_access_item).
+    ACCESS_ATTRIBUTES = ['username', 'countries', 'roles', 'state']
+    # Every attribute except the password hash, for building token payloads.
+    PUBLIC_ATTRIBUTES = [
+        'username', 'email', 'countries', 'roles', 'state', 'creation',
+        'updated', 'data'
+    ]
+    # Cache of each user's countries, roles and state (see get_access_item).
+    ACCESS_CACHE = TTLCache(maxsize=10000)
+    # The last public item read for each user (see get_public_item).
+    PUBLIC_ITEMS = TTLCache(maxsize=10000)
+    # Coalesces concurrent loads of the same user (see from_db).
+    LOADS = SingleFlight('users')
+    # Approximate set of existing usernames (see probe_username).
+    USERNAMES = ApproximateSet(
+        lambda: User.all_usernames(),
+        ttl=app.config['USERNAME_FILTER_TTL']
     )
+    # Accounts in these states can't log in or extend their sessions.
+    INACTIVE_STATES = ['suspended']
+    # The shared database resource (see meerkat_auth.db).
+    DB = db.Database('users')
 
     def __init__(self,
                  username,
@@ -33,8 +63,20 @@ class User:
                  state="live",
                  updated=None,
                  creation=None,
-                 data={}):
-        """Create a User object."""
+                 data={},
+                 role_graph=None,
+                 access=None):
+        """
+        Create a User object.
+
+        If a RoleGraph is given, the user's roles and their access are taken
+        from the graph rather than loaded from the database role by role.
+        This is much quicker when building many users at once.
+
+        If the user's complete access is given, as materialised on the user
+        item by to_db(), it is used as is and the user's roles are only
+        loaded if they are needed.
+        """
 
         # Initalise variables
         self.username = username
@@ -51,10 +93,27 @@ class User:
         self.updated = updated
         self.data = data
 
-        # Create an array of role objects from the array of roles.
-        self.role_objs = []
-        for r in enumerate(roles):
-            self.role_objs.append(Role.from_db(self.countries[r[0]], r[1]))
+        # Create an array of role objects from the array of roles, unless the
+        # access is already known, in which case it's created when needed.
+        self.role_graph = role_graph
+        self.access = access
+        self._role_objs = None
+        if access is None:
+            self._role_objs = self._load_role_objs()
+
+    @property
+    def role_objs(self):
+        """The Role objects for each of the user's roles."""
+        if self._role_objs is None:
+            self._role_objs = self._load_role_objs()
+        return self._role_objs
+
+    def _load_role_objs(self):
+        pairs = list(zip(self.countries, self.roles))
+        if self.role_graph:
+            return [self.role_graph.get(c, r) for c, r in pairs]
+        # Load the roles in every country at once.
+        return db.fan_out(lambda pair: Role.from_db(*pair), pairs)
 
     def __repr__(self):
         """
@@ -126,13 +185,20 @@ class User:
     def to_db(self):
         """
         Writes this user object to the database table specified by
-        config['USERS']. First validates content.
+        config['USERS']. First validates content. The user's complete access
+        is written to the item too, as the 'access' attribute, so that it
+        needn't be computed each time the user is loaded.
 
         Returns:
             The amazon dynamodb response.
         """
         # Validate
         self.validate()
+        self.access = User.compute_access(
+            self.countries,
+            self.roles,
+            self.role_graph or RoleGraph.from_db(sorted(set(self.countries)))
+        )
 
         # Write to DB.
         logging.info("Validated. Writing object to database.")
@@ -158,47 +224,458 @@ class User:
                 'state': {'Value': self.state, 'Action': 'PUT'},
                 'creation': {'Value': self.creation, 'Action': 'PUT'},
                 'updated': {'Value': self.updated, 'Action': 'PUT'},
-                'data': {'Value': self.data, 'Action': 'PUT'}
-            }
+                'data': {'Value': self.data, 'Action': 'PUT'},
+                'access': {'Value': self.access, 'Action': 'PUT'}
+            },
+            ReturnValues='UPDATED_OLD'
         )
         logging.info("Response from database:\n" + str(response))
+        User.ACCESS_CACHE.pop(self.username)
+        User.PUBLIC_ITEMS.pop(self.username)
+        User.USERNAMES.add(self.username)
+        old = response.get('Attributes', {})
+        RoleIndex.update(
+            self.username,
+            zip(old.get('countries', []), old.get('roles', [])),
+            zip(self.countries, self.roles)
+        )
+
+        return response
+
+    @staticmethod
+    def update_attributes(username, attributes):
+        """
+        Writes just the given attributes of an existing user to the database
+        table specified by config['USERS'], along with a new 'updated'
+        timestamp. Unlike to_db() this doesn't load or validate the whole user,
+        so it only suits attributes that don't affect the user's access.
+
+        Args:
+            username (str) The user to update.
+            attributes (dict) The new values, indexed by attribute name.
+
+        Returns:
+            The amazon dynamodb response.
+
+        Raises:
+            InvalidCredentialException if the user doesn't exist, or if the
+                email or password values are invalid.
+        """
+        if 'email' in attributes:
+            if not User.EMAIL_REGEX.match(attributes['email']):
+                raise InvalidCredentialException('email', attributes['email'])
+        if 'password' in attributes:
+            if not pbkdf2_sha256.identify(attributes['password']):
+                raise InvalidCredentialException(
+                    'password',
+                    attributes['password'],
+                    ('Password must be hashed according '
+                     'to the specified hashing policy.')
+                )
 
+        attributes = {**attributes, 'updated': datetime.now().isoformat()}
+        logging.info(
+            'Updating {} for user {}'.format(list(attributes), username)
+        )
+        users = User.DB.Table(app.config['USERS'])
+        try:
+            response = users.update_item(
+                Key={'username': username},
+                AttributeUpdates={
+                    k: {'Value': v, 'Action': 'PUT'}
+                    for k, v in attributes.items()
+                },
+                Expected={'username': {'Value': username}}
+            )
+        except User.DB.meta.client.exceptions.ConditionalCheckFailedException:
+            raise InvalidCredentialException('username', username)
+        logging.info("Response from database:\n" + str(response))
         return response
 
+    @staticmethod
+    def update_access(record, add=None, remove=None, state=None):
+        """
+        Grants and/or removes a single role, and/or changes the state, of one
+        user with a single conditional UpdateItem request. The write only
+        succeeds if the user's countries and roles are still as given by the
+        record, so concurrent edits can't be lost. Roles are not validated
+        here, so callers must validate any role they add. The user's
+        materialised access is recomputed from the cached role graph in the
+        same write.
+
+        Args:
+            record (UserRecord) The user, with their countries, roles and
+                state.
+            add ((str, str)) A (country, role) pair to grant, if not held.
+            remove ((str, str)) A (country, role) pair to remove, if held.
+            state (str) The new state, if it should change.
+
+        Returns:
+            bool True if the user was changed, False if nothing needed to be.
+
+        Raises:
+            InvalidCredentialException if the account was changed or deleted
+                since the record was loaded.
+        """
+        countries = list(record['countries'])
+        roles = list(record['roles'])
+        held = list(zip(countries, roles))
+        add = tuple(add) if add and tuple(add) not in held else None
+        remove = tuple(remove) if remove else None
+        removed = [i for i, pair in enumerate(held) if pair == remove]
+        state = state if state and state != record.get('state') else None
+        if not (add or removed or state):
+            return False
+
+        names = {'#c': 'countries', '#r': 'roles', '#u': 'updated'}
+        values = {':u': datetime.now().isoformat()}
+        sets = ['#u = :u']
+        removes = []
+        if add and removed:
+            # Paths can't overlap in one update, so set the complete lists.
+            kept = [p for i, p in enumerate(held) if i not in removed]
+            kept.append(add)
+            sets += ['#c = :c', '#r = :r']
+            values[':c'] = [c for c, r in kept]
+            values[':r'] = [r for c, r in kept]
+        elif add:
+            sets += ['#c = list_append(#c, :c)', '#r = list_append(#r, :r)']
+            values[':c'] = [add[0]]
+            values[':r'] = [add[1]]
+        elif removed:
+            for i in removed:
+                removes += ['#c[{}]'.format(i), '#r[{}]'.format(i)]
+        if state:
+            names['#s'] = 'state'
+            values[':s'] = state
+            sets.append('#s = :s')
+        if add or removed:
+            kept = [p for i, p in enumerate(held) if i not in removed]
+            kept += [add] if add else []
+            names['#a'] = 'access'
+            try:
+                values[':a'] = User.compute_access(
+                    [c for c, r in kept],
+                    [r for c, r in kept],
+                    RoleGraph.cached()
+                )
+                sets.append('#a = :a')
+            except InvalidRoleException:
+                # Broken access is computed, and fails, when next needed.
+                removes.append('#a')
+
+        expression = 'SET ' + ', '.join(sets)
+        if removes:
+            expression += ' REMOVE ' + ', '.join(removes)
+
+        users = User.DB.Table(app.config['USERS'])
+        try:
+            users.update_item(
+                Key={'username': record['username']},
+                UpdateExpression=expression,
+                ConditionExpression=(
+                    Attr('countries').eq(countries) & Attr('roles').eq(roles)
+                ),
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values
+            )
+        except User.DB.meta.client.exceptions.ConditionalCheckFailedException:
+            raise InvalidCredentialException(
+                'username',
+                record['username'],
+                'The account was changed by someone else, try again.'
+            )
+        finally:
+            User.ACCESS_CACHE.pop(record['username'])
+            User.PUBLIC_ITEMS.pop(record['username'])
+        if add or removed:
+            RoleIndex.update(record['username'], held, kept)
+        return True
+
+    @staticmethod
+    def bulk_update(records, add=None, remove=None, state=None, workers=8):
+        """
+        Applies the same role and/or state change to many users, as
+        update_access() does for one. DynamoDB has no batch update, so the
+        updates are sent in parallel on a pool of threads.
+
+        Args:
+            records ([UserRecord]) The users, with their countries, roles and
+                state.
+            add ((str, str)) A (country, role) pair to grant.
+            remove ((str, str)) A (country, role) pair to remove.
+            state (str) The new state.
+            workers (int) The number of updates to send at once.
+
+        Returns:
+            A dictionary indexed by username, with 'updated' or 'unchanged'
+            for each user, or the error message if the user couldn't be
+            updated.
+        """
+        def update(record):
+            try:
+                changed = User.update_access(record, add, remove, state)
+                return 'updated' if changed else 'unchanged'
+            except Exception as e:
+                return str(e)
+
+        logging.info('Bulk updating {} users.'.format(len(records)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(update, records)
+        return {r['username']: result for r, result in zip(records, results)}
+
     def get_access(self):
         """
         Returns an object detailing the complete list of roles this user has
-        access to in each country.
+        access to in each country. The materialised access stored with the
+        user is used if it was loaded, otherwise it is computed.
 
         Returns:
             A dictionary where each key is a country and each value is a list
             of roles this user has access to in that country.
         """
+        if self.access is not None:
+            return {c: list(r) for c, r in self.access.items()}
         access = {}
         for role in self.role_objs:
-            access.setdefault(role.country, []).extend(role.all_access())
+            if self.role_graph:
+                role_access = self.role_graph.all_access(role.country, role.role)
+            else:
+                role_access = role.all_access()
+            access.setdefault(role.country, []).extend(role_access)
+        return access
+
+    @staticmethod
+    def compute_access(countries, roles, role_graph):
+        """
+        Computes the complete access given by a list of roles, in the format
+        returned by get_access().
+
+        Args:
+            countries ([str]) The country of each role.
+            roles ([str]) The roles.
+            role_graph (RoleGraph) The graph holding the roles.
+
+        Returns:
+            A dictionary where each key is a country and each value is a list
+            of roles in that country.
+
+        Raises:
+            InvalidRoleException if a role, or one of its ancestors, is
+                missing from the graph.
+        """
+        access = {}
+        for country, role in zip(countries, roles):
+            access.setdefault(country, []).extend(
+                role_graph.all_access(country, role)
+            )
         return access
 
+    @staticmethod
+    def _same_access(a, b):
+        """Whether two access dictionaries give the same access."""
+        def normalise(access):
+            if access is None:
+                return None
+            return {c: sorted(set(r)) for c, r in access.items()}
+        return normalise(a) == normalise(b)
+
+    @staticmethod
+    def refresh_access(usernames, role_graph=None, consistent=False):
+        """
+        Recomputes the materialised access of the given users, e.g. after the
+        roles they hold have changed, and writes any that differ from what is
+        stored. The access of users with broken roles is removed, so that it
+        is computed, and fails, when it is next needed. Writes are
+        conditional on the user's roles being unchanged, so a concurrent
+        to_db() always wins.
+
+        Args:
+            usernames ([str]) The users to refresh.
+            role_graph (RoleGraph) The graph to compute the access from. If
+                not given, the graph for the users' countries is loaded.
+            consistent (bool) If true, the graph is loaded with strongly
+                consistent reads, e.g. when roles have only just been written.
+
+        Returns:
+            [str] The usernames whose access was rewritten.
+        """
+        try:
+            items = User.batch_get(
+                usernames, ['countries', 'roles', 'access']
+            )
+        except UnreadUsersException as e:
+            # Left for audit_access() to find and repair.
+            logging.warning('Could not refresh access of {}: {}'.format(
+                sorted(e.usernames), e
+            ))
+            items = e.items
+        if role_graph is None:
+            countries = set()
+            for item in items.values():
+                countries.update(item['countries'])
+            role_graph = RoleGraph.from_db(sorted(countries), consistent)
+
+        users = User.DB.Table(app.config['USERS'])
+        exceptions = User.DB.meta.client.exceptions
+        refreshed = []
+        for username, item in items.items():
+            try:
+                access = User.compute_access(
+                    item['countries'], item['roles'], role_graph
+                )
+            except InvalidRoleException:
+                access = None
+            if User._same_access(access, item.get('access')):
+                continue
+            kwargs = {'ExpressionAttributeNames': {'#a': 'access'}}
+            if access is None:
+                kwargs['UpdateExpression'] = 'REMOVE #a'
+            else:
+                kwargs['UpdateExpression'] = 'SET #a = :a'
+                kwargs['ExpressionAttributeValues'] = {':a': access}
+            try:
+                users.update_item(
+                    Key={'username': username},
+                    ConditionExpression=(
+                        Attr('countries').eq(item['countries']) &
+                        Attr('roles').eq(item['roles'])
+                    ),
+                    **kwargs
+                )
+                refreshed.append(username)
+            except exceptions.ConditionalCheckFailedException:
+                logging.info(username + ' changed while refreshing access.')
+        logging.info('Refreshed access of {} users.'.format(len(refreshed)))
+        return refreshed
+
+    @staticmethod
+    def refresh_role_holders(keys):
+        """
+        Refreshes the materialised access of every user holding one of the
+        given roles, or a role that inherits from one of them. Called when
+        roles are written or deleted, as that changes the access of these
+        users. The users are found with the reverse role index. The roles are
+        read with strongly consistent reads, so that the access written isn't
+        computed from the roles as they were before the change.
+
+        Args:
+            keys ([(str, str)]) The (country, role) keys of the changed roles.
+
+        Returns:
+            [str] The usernames whose access was rewritten.
+        """
+        countries = sorted(set(country for country, role in keys))
+        graph = RoleGraph.from_db(countries, consistent=True)
+
+        # Follow the parent links directly, rather than the ancestor lists,
+        # so the children of a deleted role are found even though broken.
+        affected = set()
+        pending = list(keys)
+        while pending:
+            country, role = pending.pop()
+            if (country, role) not in affected:
+                affected.add((country, role))
+                pending += [
+                    (country, child) for child in graph.children(country, role)
+                ]
+
+        usernames = set()
+        holders = db.fan_out(
+            lambda key: RoleIndex.direct_holders(*key), sorted(affected)
+        )
+        for held in holders:
+            usernames.update(held)
+        if not usernames:
+            return []
+        return User.refresh_access(sorted(usernames), consistent=True)
+
+    @staticmethod
+    def audit_access(role_graph=None, repair=False):
+        """
+        Checks every user's materialised access against the access computed
+        from the current role graph, to find any that has drifted, e.g. if a
+        background refresh failed.
+
+        Args:
+            role_graph (RoleGraph) The complete role graph. Loaded if not
+                given.
+            repair (bool) If true, rewrite the access of the drifted users.
+
+        Returns:
+            [dict] A dictionary for each drifted user, with the 'username'
+            and the 'problem': 'missing' if no access is stored, 'broken' if
+            access is stored but the user's roles are broken, or 'stale' if
+            the stored access is wrong.
+        """
+        if role_graph is None:
+            role_graph = RoleGraph.from_db(None)
+        drifted = []
+        pages = User.get_pages([], ['countries', 'roles', 'access'])
+        for user in (user for page in pages for user in page):
+            try:
+                access = User.compute_access(
+                    user['countries'], user['roles'], role_graph
+                )
+            except InvalidRoleException:
+                access = None
+            stored = user.get('access')
+            if User._same_access(access, stored):
+                continue
+            if stored is None:
+                problem = 'missing'
+            elif access is None:
+                problem = 'broken'
+            else:
+                problem = 'stale'
+            drifted.append({'username': user['username'], 'problem': problem})
+
+        logging.info('Found {} users with drifted access.'.format(
+            len(drifted)
+        ))
+        if repair and drifted:
+            User.refresh_access([d['username'] for d in drifted], role_graph)
+        return drifted
+
     def get_jwt(self, exp):
         """
         Returns a small secure Json Web Token (JWT) giving the username
         and the specified expiry time of the user's session.  This is
         specifically kept extremely small so it can be stored as a cookie or
-        header.
+        header. The token also has a unique ID and issue time, so that it can
+        be revoked before it expires (see meerkat_auth.revocation).
+
+        Args:
+            exp (string) The expiry time of the users session.
+        Returns:
+            The secure jwt.
+        """
+        return User.encode_jwt(self.username, exp)
+
+    @staticmethod
+    def encode_jwt(username, exp, jti=None):
+        """
+        Returns the small secure JWT described in get_jwt() for the given
+        username, without needing to load the User object.
 
         Args:
+            username (str) The user the token identifies.
             exp (string) The expiry time of the users session.
+            jti (str) The token's unique ID. Defaults to a new random ID.
         Returns:
             The secure jwt.
         """
         payload = {
             'exp': exp,
-            'usr': self.username
+            'usr': username,
+            'iat': calendar.timegm(time.gmtime()),
+            'jti': jti or uuid.uuid4().hex
         }
         return jwt.encode(
             payload,
             app.config['JWT_SECRET_KEY'],
-            algorithm=app.config['JWT_ALGORITHM']
+            algorithm=app.config['JWT_ALGORITHM'],
+            headers=User.jwt_headers()
         )
 
     def get_user_jwt(self, exp):
@@ -214,11 +691,24 @@ class User:
         token = jwt.encode(
             self.get_payload(exp),
             app.config['JWT_SECRET_KEY'],
-            algorithm=app.config['JWT_ALGORITHM']
+            algorithm=app.config['JWT_ALGORITHM'],
+            headers=User.jwt_headers()
         )
         token = token.decode('UTF-8')
         return token
 
+    @staticmethod
+    def jwt_headers():
+        """
+        Returns the extra JWT headers for tokens signed by Meerkat Auth. The
+        key ID lets services pick the right key from /api/.well-known/jwks.json
+        to verify our tokens locally.
+
+        Returns:
+            dict The JWT headers.
+        """
+        return {'kid': jwks.key_id(app.config['JWT_PUBLIC_KEY'])}
+
     def get_payload(self, exp):
         """
         Returns a dictionary giving all details for the user session
@@ -290,36 +780,43 @@ class User:
             The authenticated user.
 
         Raises:
-            InvalidCredentialException if any credentials are invalid.
+            InvalidCredentialException if any credentials are invalid, or if
+                the account is inactive.
         """
 
         # Raises an exception if the username is invalid.
         user = User.from_db(username)
         # Raises an exception if the password is invalid.
-        if pbkdf2_sha256.verify(password, user.password):
-            return user
-        else:
+        if not pbkdf2_sha256.verify(password, user.password):
             raise InvalidCredentialException('password', password)
+        # Raises an exception if the account has been suspended.
+        if user.state in User.INACTIVE_STATES:
+            raise InvalidCredentialException(
+                'account', user.state, 'The account is ' + user.state + '.'
+            )
+        return user
 
     @staticmethod
-    def from_db(username):
+    def from_db(username, role_graph=None):
         """
         Creates a python object for a given username using
         data fetched from the database table specified by config['USERS'].
 
         Args:
             username (str)
+            role_graph (RoleGraph) Optional graph from which to take the
+                user's roles, if their access isn't stored with them.
         Returns:
             The python User object for the given username.
         """
-        # Load data
+        # Load data, sharing the read with any concurrent loads of the user.
         logging.info('Loading user ' + username + ' from database.')
         users = User.DB.Table(app.config['USERS'])
-        response = users.get_item(
-            Key={
-                'username': username
-            }
+        response = User.LOADS.do(
+            username,
+            lambda: users.get_item(Key={'username': username})
         )
+        response = copy.deepcopy(response)  # The response may be shared.
         logging.info('Response from database:\n' + str(response))
 
         # Build and return object
@@ -328,24 +825,156 @@ class User:
         else:
             r = response["Item"]
             logging.info("RESPONSE------------\n" + repr(r))
-            user = User(
-                r['username'],
-                r['email'],
-                r['password'],
-                r['countries'],
-                r['roles'],
-                state=r.get('state', 'undefined'),
-                updated=r.get('updated', 'undefined'),
-                creation=r.get('creation', 'undefined'),
-                data=r.get('data', {})
-            )
-
-            # We want NO NEW USERS in the database.  Do 2nd clean up here.
-            user.state = "live" if user.state == "new" else user.state
-
+            user = User.from_item(r, role_graph)
             logging.info('Returning user:\n' + repr(user))
             return user
 
+    @staticmethod
+    def from_item(item, role_graph=None):
+        """
+        Creates a python User object from a user item loaded from the
+        database table specified by config['USERS'].
+
+        Args:
+            item (dict) The user item. If the password hash wasn't fetched the
+                object's password is None, and it mustn't be written back.
+            role_graph (RoleGraph) Optional graph from which to take the
+                user's roles, instead of loading each from the database.
+        Returns:
+            The python User object.
+        """
+        user = User(
+            item['username'],
+            item['email'],
+            item.get('password'),
+            item['countries'],
+            item['roles'],
+            state=item.get('state', 'undefined'),
+            updated=item.get('updated', 'undefined'),
+            creation=item.get('creation', 'undefined'),
+            data=item.get('data', {}),
+            role_graph=role_graph,
+            access=item.get('access')
+        )
+
+        # We want NO NEW USERS in the database.  Do 2nd clean up here.
+        user.state = "live" if user.state == "new" else user.state
+        return user
+
+    @staticmethod
+    def batch_get(usernames, attributes=None, max_retries=8):
+        """
+        Fetches many user items from the database table specified by
+        config['USERS'] using as few BatchGetItem requests as possible, all
+        sent at once. Unprocessed keys are retried with exponential backoff.
+        Usernames that aren't in the database are simply left out.
+
+        Args:
+            usernames ([str]) The usernames to fetch.
+            attributes ([str]) The attributes to fetch. If this equates to
+                false all attributes are fetched.
+            max_retries (int) The most times to retry unprocessed keys.
+
+        Returns:
+            A dictionary of user items indexed by username.
+
+        Raises:
+            UnreadUsersException if some users still couldn't be read after
+                max_retries, giving the users that were read.
+        """
+        table_name = app.config['USERS']
+        usernames = list(dict.fromkeys(usernames))  # BatchGet rejects repeats
+        logging.info('Batch loading {} users.'.format(len(usernames)))
+
+        request = {}
+        if attributes:
+            request = User.projection(list(set(attributes) | {'username'}))
+
+        def load(chunk):
+            items = {}
+            unread = []
+            request_items = {table_name: {
+                'Keys': [{'username': u} for u in chunk],
+                **request
+            }}
+            retries = 0
+            while request_items:
+                response = User.DB.batch_get_item(RequestItems=request_items)
+                for item in response['Responses'].get(table_name, []):
+                    items[item['username']] = item
+                request_items = response.get('UnprocessedKeys', {})
+                # Back off exponentially if DynamoDB is throttling us.
+                if request_items:
+                    if retries == max_retries:
+                        unread = [
+                            key['username']
+                            for key in request_items[table_name]['Keys']
+                        ]
+                        break
+                    time.sleep(min(0.05 * 2 ** retries, 1))
+                    retries += 1
+            return items, unread
+
+        # Send the requests for every chunk at once.
+        chunks = [
+            usernames[i:i + User.BATCH_GET_SIZE]
+            for i in range(0, len(usernames), User.BATCH_GET_SIZE)
+        ]
+        items = {}
+        unread = []
+        for loaded, chunk_unread in db.fan_out(load, chunks):
+            items.update(loaded)
+            unread += chunk_unread
+        if unread:
+            logging.warning('Failed to read {} users.'.format(len(unread)))
+            raise UnreadUsersException(unread, items)
+        return items
+
+    @staticmethod
+    def get_many(usernames):
+        """
+        Creates python User objects for many usernames at once. The user
+        items are loaded with BatchGetItem and the roles for all the users'
+        countries are loaded once into a shared RoleGraph, so each role's
+        access is only computed once however many users hold it.
+
+        Password hashes aren't fetched, so the users are only good for reading
+        (e.g. building token payloads) and mustn't be written back.
+
+        Args:
+            usernames ([str]) The usernames to load.
+        Returns:
+            A tuple (users, errors), where users is a dictionary of User objects
+            indexed by username and errors is a dictionary of error messages
+            indexed by username, for usernames that couldn't be loaded.
+        """
+        errors = {}
+        try:
+            items = User.batch_get(usernames, User.PUBLIC_ATTRIBUTES)
+        except UnreadUsersException as e:
+            items = e.items
+            for username in e.usernames:
+                errors[username] = str(e)
+        countries = set()
+        for item in items.values():
+            countries.update(item['countries'])
+        graph = RoleGraph.from_db(sorted(countries)) if countries else None
+
+        users = {}
+        for username in usernames:
+            if username in errors:
+                continue
+            if username not in items:
+                errors[username] = str(
+                    InvalidCredentialException('username', username)
+                )
+                continue
+            try:
+                users[username] = User.from_item(items[username], graph)
+            except InvalidRoleException as e:
+                errors[username] = str(e)
+        return users, errors
+
     @staticmethod
     def delete(username):
         """
@@ -363,11 +992,249 @@ class User:
         response = users.delete_item(
             Key={
                 'username': username
-            }
+            },
+            ReturnValues='ALL_OLD'
         )
         logging.info("Response from database:\n" + str(response))
+        User.ACCESS_CACHE.pop(username)
+        User.PUBLIC_ITEMS.pop(username)
+        old = response.get('Attributes', {})
+        RoleIndex.update(
+            username, zip(old.get('countries', []), old.get('roles', [])), []
+        )
+        # The username stays in USERNAMES until it is next rebuilt, which only
+        # means probe_username() checks the database for it.
         return response
 
+    @staticmethod
+    def batch_delete(usernames, max_retries=8):
+        """
+        Deletes many users from the database table specified by
+        config['USERS'] using as few BatchWriteItem requests as possible.
+        Items that DynamoDB leaves unprocessed are retried with exponential
+        backoff.
+
+        Args:
+            usernames ([str]) The usernames to delete.
+            max_retries (int) The number of times to retry unprocessed items.
+
+        Returns:
+            [str] The usernames that still couldn't be deleted. Users whose
+            roles couldn't be read first aren't deleted, and are included.
+        """
+        usernames = list(dict.fromkeys(usernames))  # Batches reject repeats
+        logging.info('Batch deleting {} users.'.format(len(usernames)))
+        # BatchWriteItem can't return old items, so get the roles to unindex.
+        unread = []
+        try:
+            old = User.batch_get(usernames, ['countries', 'roles'])
+        except UnreadUsersException as e:
+            old = e.items
+            unread = list(e.usernames)
+            usernames = [u for u in usernames if u not in unread]
+        failed = User._batch_write(
+            [{'DeleteRequest': {'Key': {'username': u}}} for u in usernames],
+            max_retries
+        )
+        failed = [r['DeleteRequest']['Key']['username'] for r in failed]
+        for username in usernames:
+            User.ACCESS_CACHE.pop(username)
+            User.PUBLIC_ITEMS.pop(username)
+            if username in old and username not in failed:
+                RoleIndex.update(username, zip(
+                    old[username]['countries'], old[username]['roles']
+                ), [])
+        return unread + failed
+
+    @staticmethod
+    def batch_put(items, max_retries=8, progress=None):
+        """
+        Writes many complete new user items, as given by User.to_dict(), to
+        the database table specified by config['USERS'] using as few
+        BatchWriteItem requests as possible. Unlike to_db() the items are not
+        validated, so callers must validate them first, and mustn't use this
+        to overwrite existing users. Items should include the users' complete
+        'access' (see to_db()), else it is computed whenever it is needed.
+
+        Args:
+            items ([dict]) The user items to write.
+            max_retries (int) The number of times to retry unprocessed items.
+            progress (function) Called as progress(written, total) after each
+                request.
+
+        Returns:
+            [str] The usernames that still couldn't be written.
+        """
+        logging.info('Batch writing {} users.'.format(len(items)))
+        failed = User._batch_write(
+            [{'PutRequest': {'Item': item}} for item in items],
+            max_retries,
+            progress
+        )
+        failed = [r['PutRequest']['Item']['username'] for r in failed]
+        for item in items:
+            User.ACCESS_CACHE.pop(item['username'])
+            User.PUBLIC_ITEMS.pop(item['username'])
+            if item['username'] not in failed:
+                User.USERNAMES.add(item['username'])
+                RoleIndex.update(
+                    item['username'], [],
+                    zip(item['countries'], item['roles'])
+                )
+        return failed
+
+    @staticmethod
+    def _batch_write(requests, max_retries=8, progress=None):
+        """
+        Sends write requests to the database table specified by
+        config['USERS'] in BatchWriteItem chunks, retrying unprocessed
+        requests with exponential backoff, and returns the requests that
+        still couldn't be processed.
+        """
+        table_name = app.config['USERS']
+        failed = []
+        for i in range(0, len(requests), User.BATCH_WRITE_SIZE):
+            request_items = {
+                table_name: requests[i:i + User.BATCH_WRITE_SIZE]
+            }
+            retries = 0
+            while request_items:
+                response = User.DB.batch_write_item(RequestItems=request_items)
+                request_items = response.get('UnprocessedItems', {})
+                # Back off exponentially if DynamoDB is throttling us.
+                if request_items:
+                    if retries == max_retries:
+                        failed += request_items[table_name]
+                        break
+                    time.sleep(min(0.05 * 2 ** retries, 1))
+                    retries += 1
+            if progress:
+                progress(min(i + User.BATCH_WRITE_SIZE, len(requests)),
+                         len(requests))
+        return failed
+
+    @staticmethod
+    def get_access_item(username, fresh=False):
+        """
+        Returns just the attributes of a user that determine their access:
+        'countries', 'roles' and 'state'. These are cached for
+        config['USER_ACCESS_TTL'] seconds, so that frequent access checks for
+        the same user don't each need a database read. For a further
+        config['USER_ACCESS_STALE_TTL'] seconds the expired attributes are
+        served while they are reloaded in the background, unless the reload
+        finds the user has gone.
+
+        Args:
+            username (str)
+            fresh (bool) If true, read the database even if the user is cached.
+        Returns:
+            UserRecord The user's countries, roles and state.
+        Raises:
+            InvalidCredentialException if the username isn't in the database.
+        """
+        if fresh:
+            User.ACCESS_CACHE.pop(username)
+        return User.ACCESS_CACHE.get_or_revalidate(
+            username,
+            lambda: User.get_record(username, User.ACCESS_ATTRIBUTES),
+            app.config['USER_ACCESS_TTL'],
+            app.config['USER_ACCESS_STALE_TTL'],
+            transient=circuit.is_transient
+        )
+
+    @staticmethod
+    def get_public_item(username):
+        """
+        Fetches every attribute of a user except the password hash from the
+        database table specified by config['USERS'], e.g. to build the user's
+        token payload. Concurrent reads of the same user are shared. While the
+        database is failing (see circuit.is_transient) the last item read is
+        served instead, for up to config['USER_ACCESS_STALE_TTL'] seconds, as
+        get_access_item() serves stale access.
+
+        Args:
+            username (str) The user to fetch.
+        Returns:
+            dict The user item.
+        Raises:
+            InvalidCredentialException if the username isn't in the database.
+        """
+        users = User.DB.Table(app.config['USERS'])
+        projection = User.projection(User.PUBLIC_ATTRIBUTES + ['access'])
+        try:
+            response = User.LOADS.do(
+                ('public', username),
+                lambda: users.get_item(
+                    Key={'username': username}, **projection
+                )
+            )
+        except Exception as e:
+            item = None
+            if circuit.is_transient(e):
+                item = User.PUBLIC_ITEMS.get(username)
+            if item is None:
+                raise
+            logging.warning('Serving stale user {}: {!r}'.format(username, e))
+            return copy.deepcopy(item)
+        item = response.get('Item')
+        if not item:
+            User.PUBLIC_ITEMS.pop(username)
+            raise InvalidCredentialException('username', username)
+        User.PUBLIC_ITEMS.set(
+            username, item, app.config['USER_ACCESS_STALE_TTL']
+        )
+        return copy.deepcopy(item)  # The item may be shared.
+
+    @staticmethod
+    def get_record(username, attributes):
+        """
+        Fetches only the given attributes of a user from the database table
+        specified by config['USERS'], as a lightweight read only UserRecord.
+        Use this rather than from_db() when a User object isn't needed, as
+        no roles are loaded and less is read from the database.
+
+        Args:
+            username (str) The user to fetch.
+            attributes ([str]) The attributes to fetch.
+        Returns:
+            The UserRecord object.
+        Raises:
+            InvalidCredentialException if the username isn't in the database.
+        """
+        users = User.DB.Table(app.config['USERS'])
+        response = users.get_item(
+            Key={'username': username},
+            **User.projection(UserRecord.fetch(attributes))
+        )
+        if not response.get('Item', None):
+            raise InvalidCredentialException('username', username)
+        return UserRecord(response['Item'])
+
+    @staticmethod
+    def get_records(usernames, attributes):
+        """
+        Fetches only the given attributes of many users at once, as
+        lightweight read only UserRecords. Usernames that aren't in the
+        database are simply left out.
+
+        Args:
+            usernames ([str]) The usernames to fetch.
+            attributes ([str]) The attributes to fetch.
+        Returns:
+            A tuple (records, errors), where records is a dictionary of
+            UserRecord objects indexed by username and errors is a dictionary
+            of error messages indexed by username, for users that couldn't be
+            read and should be retried.
+        """
+        errors = {}
+        try:
+            items = User.batch_get(usernames, UserRecord.fetch(attributes))
+        except UnreadUsersException as e:
+            items = e.items
+            for username in e.usernames:
+                errors[username] = str(e)
+        return {u: UserRecord(item) for u, item in items.items()}, errors
+
     @staticmethod
     def check_username(username):
         """
@@ -390,6 +1257,42 @@ class User:
         else:
             return False
 
+    @staticmethod
+    def probe_username(username):
+        """
+        Quickly checks whether a username might already exist, for giving
+        feedback as a username is typed. Most available usernames are
+        identified from an in-memory filter of existing usernames without any
+        database read. Only usernames that might exist are checked against
+        the database. The filter is rebuilt every config['USERNAME_FILTER_TTL']
+        seconds, so this can miss usernames created very recently by another
+        process: use check_username() where the answer must be exact.
+
+        Args:
+            username (str)
+
+        Returns:
+            bool True if in db, False if not in db.
+        """
+        if not User.USERNAMES.might_contain(username):
+            return False
+        return User.check_username(username)
+
+    @staticmethod
+    def all_usernames():
+        """
+        Reads every username from the database table specified by
+        config['USERS'], one page at a time.
+
+        Yields:
+            str Each username.
+        """
+        users = User.DB.Table(app.config['USERS'])
+        pages = User._pages(users.scan, **User.projection(['username']))
+        for page in pages:
+            for item in page:
+                yield item['username']
+
     @staticmethod
     def validate_username(username):
         """
@@ -491,11 +1394,35 @@ class User:
         return user
 
     @staticmethod
-    def get_all(countries, attributes):
+    def projection(attributes):
+        """
+        Creates the DynamoDB arguments to fetch only the given attributes.
+        Every attribute name is substituted, because names like 'data' and
+        'state' are reserved words in DynamoDB expressions.
+
+        Args:
+            attributes ([str]) The attribute names to fetch.
+
+        Returns:
+            dict The ProjectionExpression and ExpressionAttributeNames args.
+        """
+        return {
+            'ProjectionExpression': ', '.join(
+                '#p{}'.format(i) for i in range(len(attributes))
+            ),
+            'ExpressionAttributeNames': {
+                '#p{}'.format(i): a for i, a in enumerate(attributes)
+            }
+        }
+
+    @staticmethod
+    def get_all(countries, attributes, role=None, search=None):
         """
         Fetches from the database the requested attributes for all users that
         belong to the specified country. If country or attributes equate to
-        false then all possible options for that argument will be used.
+        false then all possible options for that argument will be used. All
+        the filters are applied by the database in a single scan, so that only
+        matching accounts are returned from the database.
 
         Args:
             country ([str]) A list of countries for which we want user
@@ -503,9 +1430,40 @@ class User:
                 of the countries in the list is retruned.
             attributes ([str]) A list of user account attribute names that we
                 want to download.
+            role (str) Only return accounts that hold this role, in one of the
+                given countries if countries are given.
+            search (str) Only return accounts whose username or email address
+                contains this string.
 
         Returns:
-            A python dictionary storing user accounts by username.
+            A python list of user account dictionaries.
+        """
+        return [
+            user for page in User.get_pages(countries, attributes, role, search)
+            for user in page
+        ]
+
+    @staticmethod
+    def get_pages(countries, attributes, role=None, search=None):
+        """
+        Like get_all(), but a generator that yields the accounts one page of
+        database results at a time, as each page is read. This keeps memory
+        use flat however many accounts there are, so is suitable for
+        streaming exports of the whole table.
+
+        Args:
+            country ([str]) A list of countries for which we want user
+                accounts. This is an OR list - i.e. any account attached to ANY
+                of the countries in the list is retruned.
+            attributes ([str]) A list of user account attribute names that we
+                want to download.
+            role (str) Only return accounts that hold this role, in one of the
+                given countries if countries are given.
+            search (str) Only return accounts whose username or email address
+                contains this string.
+
+        Yields:
+            A python list of user account dictionaries for each page.
         """
         # Set things up.
         logging.info('Loading users for ' + str(countries) + ' from database.')
@@ -527,37 +1485,133 @@ class User:
         if attributes and 'username' not in attributes:
             attributes.append('username')
 
+        # Checking a role is held in a particular country needs both lists.
+        fetch = list(attributes)
+        if role and attributes:
+            fetch += [a for a in ['countries', 'roles'] if a not in fetch]
+
         # Assemble scan arguments programatically, by building a dictionary.
         kwargs = {}
 
-        # Include AttributesToGet if any are specified.
+        # Include a ProjectionExpression if any attributes are specified.
         # By not including them we get them all.
-        if attributes:
-            kwargs["AttributesToGet"] = attributes
+        if fetch:
+            kwargs.update(User.projection(fetch))
+
+        # Assemble the filter i.e. (country1 OR country2...) AND role AND search
+        conditions = []
+        if countries:
+            condition = Attr('countries').contains(countries[0])
+            for country in countries[1:]:
+                condition = condition | Attr('countries').contains(country)
+            conditions.append(condition)
+        if role:
+            conditions.append(Attr('roles').contains(role))
+        if search:
+            conditions.append(
+                Attr('username').contains(search) |
+                Attr('email').contains(search)
+            )
+        if conditions:
+            kwargs['FilterExpression'] = conditions[0]
+            for condition in conditions[1:]:
+                kwargs['FilterExpression'] = (
+                    kwargs['FilterExpression'] & condition
+                )
 
-        if not countries:
-            # If no country is specified, get all users and return as list.
-            return table.scan(**kwargs).get("Items", [])
+        for users in User._pages(table.scan, **kwargs):
+            # The database can't check the role is held in the right country.
+            if role:
+                users = [u for u in users if any(
+                    r == role and (not countries or c in countries)
+                    for c, r in zip(u['countries'], u['roles'])
+                )]
+                for user in users:
+                    for attribute in set(fetch) - set(attributes):
+                        del user[attribute]
+            yield users
 
-        else:
-            users = {}
-            # Load data separately for each country
-            # ...because Scan can't perform OR on CONTAINS
-            for country in countries:
+    @staticmethod
+    def _pages(operation, **kwargs):
+        """
+        Calls a DynamoDB scan or query operation repeatedly until every page
+        of results has been read, yielding the items in each page.
+        """
+        response = operation(**kwargs)
+        yield response.get("Items", [])
+        while response.get("LastEvaluatedKey"):
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+            response = operation(**kwargs)
+            yield response.get("Items", [])
+
+
+class UserRecord:
+    """
+    A lightweight, read only view of some of a user's attributes, e.g. as
+    fetched with a ProjectionExpression. Unlike a User object no roles are
+    loaded, and attributes are held in slots, so many records take little
+    memory. Attributes can be read either as properties or as dict items.
+    Reading an attribute that wasn't fetched raises an error, rather than
+    quietly giving a wrong value.
+    """
+
+    __slots__ = User.PUBLIC_ATTRIBUTES + ['_loaded']
 
-                kwargs["ScanFilter"] = {
-                    'countries': {
-                        'AttributeValueList': [country],
-                        'ComparisonOperator': 'CONTAINS'
-                    }
-                }
+    def __init__(self, item):
+        """
+        Create a UserRecord object.
 
-                # Get and combine the users together in a no-duplications dict.
-                for user in table.scan(**kwargs).get("Items", []):
-                    users[user["username"]] = user
+        Args:
+            item (dict) A user item, containing any of the attributes in
+                User.PUBLIC_ATTRIBUTES. Other attributes are ignored.
+        """
+        loaded = tuple(a for a in User.PUBLIC_ATTRIBUTES if a in item)
+        for attribute in loaded:
+            object.__setattr__(self, attribute, item[attribute])
+        object.__setattr__(self, '_loaded', loaded)
 
-            # Convert the dict to a list by getting values.
-            return list(users.values())
+    def __setattr__(self, name, value):
+        raise AttributeError('UserRecord objects are read only.')
+
+    @staticmethod
+    def fetch(attributes):
+        """
+        Returns the attributes to fetch from the database for a record with
+        the given attributes: always the username, and never the password.
+        """
+        return ['username'] + [
+            a for a in User.PUBLIC_ATTRIBUTES
+            if a in attributes and a != 'username'
+        ]
+
+    def __repr__(self):
+        """
+        Override to create a better string representation of a UserRecord.
+        """
+        return '<{}: {}>'.format(self.__class__.__name__, ', '.join(
+            '{}={!r}'.format(a, getattr(self, a)) for a in self._loaded
+        ))
+
+    def __eq__(self, other):
+        """Override to define equality of UserRecord objects."""
+        return (isinstance(other, UserRecord) and
+                self.to_dict() == other.to_dict())
+
+    def __contains__(self, name):
+        return name in self._loaded
+
+    def __getitem__(self, name):
+        if name not in self._loaded:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def get(self, name, default=None):
+        """Returns the attribute if it was fetched, or else default."""
+        return getattr(self, name) if name in self._loaded else default
+
+    def to_dict(self):
+        """Returns the fetched attributes as a python dict."""
+        return {a: getattr(self, a) for a in self._loaded}
 
 
 class InvalidCredentialException(Exception):
@@ -588,3 +1642,26 @@ class InvalidCredentialException(Exception):
         return "INVALID CREDENTIALS: {} is not valid. {}".format(
             self.credential, self.message
         )
+
+
+class UnreadUsersException(Exception):
+    """
+    An exception to be raised when some users couldn't be read from the
+    database, e.g. because DynamoDB kept throttling the requests. The users
+    that were read are kept, so that callers can still use them.
+    """
+    def __init__(self, usernames, items):
+        """
+        Create the exception.
+
+        Args:
+            usernames ([str]) The usernames that couldn't be read.
+            items (dict) The user items that were read, indexed by username.
+        """
+        self.usernames = usernames
+        self.items = items
+
+    def __str__(self):
+        return "Could not read {} users. Please try again later.".format(
+            len(self.usernames)
+        )
@@ -4,19 +4,48 @@ auth.py
 A Flask Blueprint module for the authentication api calls.
 """
 from flask import Blueprint, Response, current_app, jsonify
-from flask import make_response, request, redirect
+from flask import make_response, request, redirect, g
 from meerkat_auth.user import User, InvalidCredentialException
 from meerkat_auth.role import InvalidRoleException
-from meerkat_auth import app
+from meerkat_auth.authorise import auth
+from meerkat_auth.revocation import revocations
+from meerkat_auth.refresh import RefreshToken, InvalidRefreshTokenException
+from meerkat_auth.cache import SingleFlight
+from meerkat_auth import app, jwks
+from werkzeug.exceptions import HTTPException
 
 import calendar
 import time
 import json
 import jwt
+import uuid
 
 auth_blueprint = Blueprint('auth', __name__)
 
 
+def check_auth_json(*args):
+    """
+    Checks the request is authorised exactly as auth.check_auth() does, but
+    for api calls that respond in json. The app's error page would otherwise
+    be served for unauthorised requests, with a 200 http status.
+
+    Args:
+        args: The access requirements, as for auth.check_auth().
+
+    Returns:
+        A json response with the 401 or 403 http error and a 'message' if the
+        request isn't authorised, otherwise None.
+    """
+    try:
+        auth.check_auth(*args)
+    except HTTPException as e:
+        current_app.logger.info(repr(e))
+        response = jsonify({'message': e.description})
+        response.status_code = e.code
+        return response
+    return None
+
+
 @auth_blueprint.route('/', methods=['POST'])
 @auth_blueprint.route('/login', methods=['POST'])
 def login():
@@ -25,9 +54,14 @@ def login():
     provided we return a jwt to the user that can be used to login into any
     part of meerkat. Parameters are passed in the POST request data.
 
+    If the 'refresh' parameter is true, the jwt is short lived, and a long
+    lived refresh token is also set in a cookie. The session can then be
+    extended by calling /refresh, instead of logging in again.
+
     Args:
         username (str): The users username
         password (str): The users password
+        refresh (bool): Whether to start a refreshable session.
 
     Returns:
         A json object containing a single argument 'message', stating \
@@ -52,6 +86,11 @@ def login():
             {'val': app.config['TOKEN_LIFE']}
         )['val'])
         response = jsonify({'message': 'successful'})
+        if args.get('refresh', False):
+            expiry = calendar.timegm(time.gmtime())
+            expiry += app.config['ACCESS_TOKEN_LIFE']
+            refresh_token, refresh_expiry = RefreshToken.issue(user.username)
+            set_refresh_cookie(response, refresh_token, refresh_expiry)
         response.set_cookie(
             app.config['JWT_COOKIE_NAME'],
             value=user.get_jwt(expiry)
@@ -75,6 +114,72 @@ def login():
         return response
 
 
+def set_refresh_cookie(response, token, expiry):
+    """
+    Sets the refresh token cookie on a response. The cookie is http only, so
+    that scripts in the browser can't read it.
+
+    Args:
+        response: The flask response object.
+        token (str): The refresh token.
+        expiry (int): The refresh token's expiry time.
+    """
+    response.set_cookie(
+        app.config['REFRESH_COOKIE_NAME'],
+        value=token,
+        expires=expiry,
+        httponly=True
+    )
+
+
+@auth_blueprint.route('/refresh', methods=['POST'])
+def refresh():
+    """
+    Extends a session started by logging in with 'refresh': true. Exchanges a
+    refresh token for a new short lived jwt and a new refresh token, without
+    re-checking the user's password. The refresh token can't be used again.
+    Sessions of suspended accounts and revoked sessions can't be extended.
+    The refresh token is taken from the refresh cookie, or from the POST
+    request data for clients that don't use cookies.
+
+    Args:
+        refresh_token (str): The refresh token, if not sent in a cookie.
+
+    Returns:
+        A json object containing a single argument 'message', stating \
+        'successful' or the error message. If the refresh token was sent in \
+        the request data, the new refresh token and jwt are returned in the \
+        properties 'refresh_token' and 'jwt'. Otherwise they are set as \
+        cookies.
+    """
+    args = request.get_json(silent=True) or {}
+    token = args.get('refresh_token')
+    if not token:
+        token = request.cookies.get(app.config['REFRESH_COOKIE_NAME'], '')
+
+    try:
+        username, new_token, refresh_expiry = RefreshToken.rotate(token)
+    except InvalidRefreshTokenException as e:
+        current_app.logger.info(repr(e))
+        response = jsonify({'message': str(e)})
+        response.status_code = 401
+        return response
+
+    expiry = calendar.timegm(time.gmtime()) + app.config['ACCESS_TOKEN_LIFE']
+    access_token = User.encode_jwt(username, expiry)
+
+    if args.get('refresh_token'):
+        return jsonify({
+            'message': 'successful',
+            'refresh_token': new_token,
+            'jwt': access_token.decode('UTF-8')
+        })
+    response = jsonify({'message': 'successful'})
+    set_refresh_cookie(response, new_token, refresh_expiry)
+    response.set_cookie(app.config['JWT_COOKIE_NAME'], value=access_token)
+    return response
+
+
 @auth_blueprint.route('/get_user', methods=['POST'])
 def get_user():
     """
@@ -92,11 +197,7 @@ def get_user():
     """
     try:
         token = request.json['jwt']
-        token = jwt.decode(
-            token,
-            app.config['JWT_PUBLIC_KEY'],
-            algorithms=[app.config['JWT_ALGORITHM']]
-        )
+        token = auth.decode_token(token)
 
         user = User.from_db(token['usr'])
         exp = calendar.timegm(time.gmtime()) + 60
@@ -116,14 +217,173 @@ def get_user():
         )
 
 
+@auth_blueprint.route('/get_users', methods=['POST'])
+def get_users():
+    """
+    A batch version of /get_user, for services that need the details of many
+    users at once (e.g. report mailing lists).  All the users are loaded in a
+    few batch requests and their access is computed from a single shared role
+    graph. Parameters are passed in the POST request data.
+
+    Args:
+        usernames ([str]): Usernames of the users to resolve. Resolving users
+            by username requires the request to be authenticated with the
+            access given in config['BATCH_USER_ACCESS'], and only accounts
+            whose access the requester also has are returned.
+        jwts ([str]): Signed JWTs to resolve, exactly as for /get_user.
+        signed (bool): If true, each user is returned as a signed JWT with a
+            short expiry time, rather than as a plain payload.
+
+    Returns:
+        A json object with two properties: 'users', a dictionary of user
+        payloads (or JWTs) indexed by username, and 'errors', a dictionary of
+        error messages indexed by the username or 'jwts[<index>]' that failed.
+    """
+    args = request.json
+    usernames = list(args.get('usernames', []))
+    token_usernames = []
+    errors = {}
+
+    # Usernames need authorisation, whereas a token authorises itself.
+    acc = {}
+    if usernames:
+        denied = check_auth_json(*app.config['BATCH_USER_ACCESS'])
+        if denied:
+            return denied
+        acc = g.payload['acc']
+
+    for i, token in enumerate(args.get('jwts', [])):
+        try:
+            payload = auth.decode_token(token)
+            token_usernames.append(payload['usr'])
+        except jwt.InvalidTokenError as e:
+            errors['jwts[{}]'.format(i)] = str(e)
+
+    users, load_errors = User.get_many(usernames + token_usernames)
+    errors.update(load_errors)
+
+    exp = calendar.timegm(time.gmtime()) + 60
+    return_users = {}
+    for username, user in users.items():
+        # Requesters can only see accounts with access they have themselves.
+        authorised = username in token_usernames or auth.check_access(
+            user.roles, user.countries, acc, 'AND'
+        )
+        if not authorised:
+            errors[username] = 'You are not authorised to view this user.'
+            continue
+        try:
+            if args.get('signed', False):
+                return_users[username] = user.get_user_jwt(exp)
+            else:
+                return_users[username] = user.get_payload(exp)
+        except InvalidRoleException as e:
+            errors[username] = str(e)
+
+    return jsonify({'users': return_users, 'errors': errors})
+
+
+@auth_blueprint.route('/check_access', methods=['POST'])
+def check_access():
+    """
+    Decides whether the user identified by a token has the required access.
+    This lets services make access decisions without downloading and
+    decoding the user's complete access details. Decisions are cached (see
+    Authorise.decide), so this is quick enough to call on every request.
+    Parameters are passed in the POST request data.
+
+    Args:
+        jwt (str): The signed JWT identifying the user.
+        access ([str]): The required access roles.
+        countries ([str]): The country for each role in access.
+        logic (str): 'OR' (default) if any one of the roles is required, \
+            'AND' if all are required.
+
+    Returns:
+        A json object with a single property 'allowed', stating whether the \
+        user has the required access, and a 'message' if the token or the \
+        user's account is invalid.
+    """
+    args = request.json
+    try:
+        payload = auth.decode_token(args['jwt'])
+        allowed = auth.decide(
+            payload['usr'],
+            args.get('access', ['']),
+            args.get('countries', ['']),
+            args.get('logic', 'OR')
+        )
+        return jsonify({'allowed': allowed})
+
+    # Invalid tokens and accounts are denied with a 401 http error.
+    except (jwt.InvalidTokenError, InvalidCredentialException) as e:
+        current_app.logger.info(repr(e))
+        response = jsonify({'allowed': False, 'message': str(e)})
+        response.status_code = 401
+        return response
+
+    # Broken roles are denied with a 500 http error, as in login.
+    except InvalidRoleException as e:
+        current_app.logger.info(repr(e))
+        response = jsonify({
+            'allowed': False,
+            'message': 'Your account has broken access levels.'
+        })
+        response.status_code = 500
+        return response
+
+
+@auth_blueprint.route('/.well-known/jwks.json')
+def get_jwks():
+    """
+    Publishes the public keys used to sign Meerkat Auth tokens as a JSON Web
+    Key Set. Each key is identified by the 'kid' given in the header of the
+    tokens it signs. Services can cache this response (see
+    meerkat_auth.jwks.KeySet) and verify both the cookie token and the user
+    details token locally instead of calling this api on every request.
+
+    Returns:
+        A json object with a single property 'keys', listing the public keys.
+    """
+    public_keys = [app.config['JWT_PUBLIC_KEY']]
+    public_keys += app.config.get('JWT_PREVIOUS_PUBLIC_KEYS', [])
+    response = jsonify(
+        jwks.get_jwks(public_keys, app.config['JWT_ALGORITHM'])
+    )
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['JWKS_MAX_AGE']
+    return response
+
+
+@auth_blueprint.route('/metrics')
+def metrics():
+    """
+    Reports this worker process's load coalescing stats, showing how many
+    database loads were shared between concurrent requests (see
+    meerkat_auth.cache.SingleFlight). Only admins can view the stats.
+
+    Returns:
+        A json object with a property 'single_flight', giving the 'calls',
+        'loads', 'coalesced' and coalescing 'ratio' for each kind of load.
+    """
+    denied = check_auth_json(['admin'], [''])
+    if denied:
+        return denied
+    response = jsonify({'single_flight': SingleFlight.all_stats()})
+    response.cache_control.no_store = True
+    return response
+
+
 @auth_blueprint.route('/logout')
 def logout():
     """
-    Logs a user out. This involves delete the current jwt stored in a cookie
-    and redirecting to the specified page.  We delete a cookie by changing it's
-    expiration date to immediately. Set the page to be redirected to using url
-    params, eg. /logout?url=https://www.google.com. Parameters are passed as
-    GET args in the request.
+    Logs a user out. This involves revoking and deleting the current jwt stored
+    in a cookie (and any refresh token) and redirecting to the specified
+    page.  Revoking the token means it can't be used again even if it has been
+    copied.  We delete a cookie by changing it's expiration date to
+    immediately. Set the page to be redirected to using url params, eg.
+    /logout?url=https://www.google.com.
+    Parameters are passed as GET args in the request.
 
     Args:
         url (str): The url of the page to redirect to after logging out.
@@ -133,8 +393,164 @@ def logout():
         to 0.
     """
     url = request.args.get('url', '/')
+    token = request.cookies.get(app.config["JWT_COOKIE_NAME"], '')
+    try:
+        payload = auth.decode_token(token)
+        if payload.get('jti'):
+            revocations.revoke_token(payload['jti'], payload['exp'])
+    except jwt.InvalidTokenError:
+        pass  # Nothing to revoke.
+    refresh_token = request.cookies.get(app.config['REFRESH_COOKIE_NAME'])
+    if refresh_token:
+        RefreshToken.revoke(refresh_token)
     response = make_response(redirect(url))
     response.set_cookie(app.config["JWT_COOKIE_NAME"], value="", expires=0)
+    response.set_cookie(app.config["REFRESH_COOKIE_NAME"], value="", expires=0)
+    return response
+
+
+@auth_blueprint.route('/revoke', methods=['POST'])
+def revoke():
+    """
+    Revokes tokens before they expire. Either revokes a single token, given
+    in the post data, or revokes every token issued so far for a user, e.g. to
+    log a user out everywhere. Users can revoke their own tokens, and admins
+    can revoke the tokens of any user whose access they have. Parameters are
+    passed in the POST request data.
+
+    Args:
+        jwt (str): A token to revoke. Possessing the token authorises this.
+        username (str): A user whose tokens should all be revoked.
+
+    Returns:
+        A json object containing a single argument 'message', stating \
+        'successful' or the error message.
+    """
+    args = request.json
+
+    if args.get('jwt'):
+        try:
+            payload = auth.decode_token(args['jwt'])
+        except jwt.InvalidTokenError as e:
+            response = jsonify({'message': str(e)})
+            response.status_code = 400
+            return response
+        if payload.get('jti'):
+            revocations.revoke_token(payload['jti'], payload['exp'])
+        else:
+            revocations.revoke_user(payload['usr'])
+
+    if args.get('username'):
+        denied = check_auth_json()
+        if denied:
+            return denied
+        username = args['username']
+        if username != g.payload['usr']:
+            denied = check_auth_json(['admin'], [''])
+            if denied:
+                return denied
+            try:
+                user = User.get_access_item(username)
+            except InvalidCredentialException as e:
+                response = jsonify({'message': str(e)})
+                response.status_code = 404
+                return response
+            # Admins can only edit accounts in their own countries.
+            acc = {
+                c: r for c, r in g.payload['acc'].items() if 'admin' in r
+            }
+            if not auth.check_access(
+                    user['roles'], user['countries'], acc, 'AND'):
+                response = jsonify({
+                    'message': 'You are not authorised to edit this user.'
+                })
+                response.status_code = 403
+                return response
+        revocations.revoke_user(username)
+
+    return jsonify({'message': 'successful'})
+
+
+@auth_blueprint.route('/update_account', methods=['POST'])
+def update_account():
+    """
+    An API call that lets the logged in user update their own account. Unlike
+    /update_user, this is authenticated with the user's token, so the user's
+    password is only checked (and hashed) when the password is being changed.
+    Only the attributes in config['SELF_UPDATE_ATTRIBUTES'] may be changed,
+    the keys in config['SELF_UPDATE_PROTECTED_DATA'] can't be changed in the
+    account data, and only attributes whose values have actually changed are
+    written to the database. Changing the password revokes every other
+    session. Parameters are passed as POST args in the request.
+
+    Args:
+        email (str): The new email address.
+        data (dict): Account data keys to add or update. Existing keys that \
+            aren't given are kept.
+        password (str): The new password.
+        old_password (str): The current password, required if and only if \
+            the password is being changed.
+
+    Returns:
+        A json object containing the argument 'message', stating \
+        'successful' or the error message, and the argument 'updated', \
+        listing the attributes that were changed.
+    """
+    denied = check_auth_json()
+    if denied:
+        return denied
+    args = request.json
+    username = g.payload['usr']
+
+    def error(message, status=400):
+        response = jsonify({'message': message, 'updated': []})
+        response.status_code = status
+        return response
+
+    allowed = app.config['SELF_UPDATE_ATTRIBUTES'] + ['old_password']
+    disallowed = [arg for arg in args if arg not in allowed]
+    if disallowed:
+        return error('Cannot update attributes: {}'.format(disallowed), 403)
+
+    # Only write the attributes whose values have changed.
+    changes = {}
+    if 'email' in args and args['email'] != g.payload['email']:
+        changes['email'] = args['email']
+    if 'data' in args:
+        protected = [
+            key for key in args['data']
+            if key in app.config['SELF_UPDATE_PROTECTED_DATA']
+        ]
+        if protected:
+            return error('Cannot update data: {}'.format(protected), 403)
+        data = {**g.payload['data'], **args['data']}
+        if data != g.payload['data']:
+            changes['data'] = data
+
+    # Only verify and hash passwords if the password is being changed.
+    if args.get('password'):
+        try:
+            User.authenticate(username, args.get('old_password', ''))
+        except InvalidCredentialException as e:
+            return error('Failed to authenticate. ' + str(e), 401)
+        changes['password'] = User.hash_password(args['password'])
+
+    if changes:
+        try:
+            User.update_attributes(username, changes)
+        except InvalidCredentialException as e:
+            return error(str(e))
+
+    response = jsonify({'message': 'successful', 'updated': list(changes)})
+
+    # Log out every other session, and give this session a new token.
+    if 'password' in changes:
+        jti = uuid.uuid4().hex
+        revocations.revoke_user(username, keep=jti)
+        response.set_cookie(
+            app.config['JWT_COOKIE_NAME'],
+            value=User.encode_jwt(username, g.payload['exp'], jti)
+        )
     return response
 
 
@@ -3,10 +3,14 @@ roles.py
 
 A Flask Blueprint module for the role manager page.
 """
-from flask import Blueprint, render_template, jsonify, g
+from flask import Blueprint, Response, render_template, jsonify, request, g
+from flask import abort
 from meerkat_auth.role import Role
+from meerkat_auth.role_graph import RoleGraph
 from meerkat_auth.authorise import auth
-from meerkat_auth import app
+from meerkat_auth import app, role_io
+import hashlib
+import json
 
 roles_blueprint = Blueprint('roles', __name__, url_prefix="/<language>")
 
@@ -20,31 +24,62 @@ def requires_auth():
     auth.check_auth(['admin'], [''])
 
 
+def cached_response(etag, build):
+    """
+    Returns a response for data that only changes with the given ETag, e.g.
+    data derived from the role graph. A 304 Not Modified response is returned
+    if the client already holds it, otherwise build() is called to make the
+    full response. Clients must revalidate before each use, so changes to
+    the roles show at once.
+
+    Args:
+        etag (str) Identifies the version of the response data.
+        build (function) Returns the full response.
+    """
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = build()
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def graph_etag(graph, *parts):
+    """An ETag for data derived from the graph and the given parts."""
+    return hashlib.sha1(json.dumps(
+        [graph.version] + list(parts), sort_keys=True
+    ).encode('utf-8')).hexdigest()
+
+
 @roles_blueprint.route('/get_roles')
 @roles_blueprint.route('/get_roles/<country>')
 def get_roles(country=None):
     """
-    Get all the roles for a given country.
+    Get all the roles for a given country, leaving out any roles the current
+    user isn't permitted to see. The roles are served from the cached role
+    graph, with an ETag of the graph's version and the user's access.
 
     Args:
-        country (str) The country for which we want all the roles.
+        country (str) The country for which we want all the roles. If not
+            given, the roles for every country are returned.
 
     Returns:
         A json object containing a single property 'roles' which is
             a list of the roles for that country.
     """
-    roles = Role.get_all(country)
+    graph = RoleGraph.cached()
+    acc = g.payload['acc']
+    countries = [country] if country else sorted(graph.countries())
+    signature = {c: sorted(acc.get(c, [])) for c in countries}
 
-    # Remove roles that should be hidden from the user.
-    # iterate backwards to avoid index changes when deleting items.
-    for r in range(len(roles)-1, -1, -1):
-        role = roles[r]
-        for required in role.get('visible', []):
-            if required not in g.payload['acc'][country]:
-                del roles[r]
-                break
+    def build():
+        roles = []
+        for c in countries:
+            roles += graph.visible_roles(c, signature[c])
+        return jsonify({'roles': roles})
 
-    return jsonify({'roles': roles})
+    return cached_response(graph_etag(graph, signature), build)
 
 
 @roles_blueprint.route('/get_all_access/<country>/<role>')
@@ -64,6 +99,135 @@ def get_all_access(country=None, role=None):
     return jsonify({'access': access})
 
 
+@roles_blueprint.route('/graph')
+def get_graph():
+    """
+    Gets the complete role network for one or more countries, with every
+    role's complete access list, so that the editors can resolve access
+    client side after a single request. Roles are hidden from the user as
+    in get_roles(). The response has an ETag of the network and the user's
+    access, so it is only re-sent when one of them changes.
+
+    Args:
+        country (str): Only include this country, as a GET arg. Can be
+            repeated. By default every country the user has access to.
+
+    Returns:
+        A json object with the property 'countries', a dictionary of
+        countries each holding a dictionary of role objects indexed by title.
+        Each role object has its complete access list in 'access' and an
+        'error' message if the role is broken.
+    """
+    acc = g.payload['acc']
+    countries = [
+        c for c in request.args.getlist('country') or acc.keys() if c in acc
+    ]
+    graph = RoleGraph.cached()
+
+    def build():
+        closures = graph.closures(countries)
+        for country, roles in closures.items():
+            for title in list(roles):
+                if not set(roles[title]['visible']) <= set(acc[country]):
+                    del roles[title]
+        return jsonify({'countries': closures})
+
+    return cached_response(
+        graph_etag(graph, {c: sorted(acc[c]) for c in countries}), build
+    )
+
+
+def admin_countries():
+    """Returns the countries in which the current user is an admin."""
+    return [c for c, roles in g.payload['acc'].items() if 'admin' in roles]
+
+
+@roles_blueprint.route('/export')
+def export_roles():
+    """
+    Exports the complete role networks for the countries in which the current
+    user is an admin, ordered so each role comes after its parents.
+
+    Args:
+        country (str): Only export this country. Can be repeated.
+        format (str): 'json' (the default) or 'yaml'.
+
+    Returns:
+        The roles as a list of role objects in the requested format.
+    """
+    format = request.args.get('format', 'json')
+    if format not in role_io.FORMATS:
+        abort(400, 'Format must be one of ' + ', '.join(role_io.FORMATS))
+    countries = admin_countries()
+    if request.args.getlist('country'):
+        countries = [
+            c for c in countries if c in request.args.getlist('country')
+        ]
+    roles = role_io.export_roles(countries) if countries else []
+    try:
+        text = role_io.dump(roles, format)
+    except ValueError as e:
+        abort(501, str(e))
+    return Response(text, mimetype=role_io.FORMATS[format])
+
+
+@roles_blueprint.route('/import', methods=['POST'])
+def import_roles():
+    """
+    Creates and updates many roles at once from the JSON or YAML list of
+    roles posted in the request body. The whole resulting role network is
+    validated before anything is written. The current user must be an admin
+    in every country the roles belong to.
+
+    Args:
+        format (str): 'json' (the default) or 'yaml', as a GET arg.
+        replace (str): If 'true', the roles given replace the complete
+            networks of their countries, deleting any roles not given.
+        dry_run (str): If 'true', only validate and report the changes.
+
+    Returns:
+        A json response with the validation "errors", the "diff" between the
+        current and the new networks, and whether the changes were "written".
+    """
+    try:
+        roles = role_io.load(
+            request.get_data(as_text=True),
+            request.args.get('format', 'json')
+        )
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    countries = sorted(set(r['country'] for r in roles))
+    if not set(countries) <= set(admin_countries()):
+        abort(403, "You are not authorised to edit these roles.")
+    return jsonify(role_io.import_roles(
+        roles,
+        replace=request.args.get('replace', '').lower() == 'true',
+        dry_run=request.args.get('dry_run', '').lower() == 'true'
+    ))
+
+
+@roles_blueprint.route('/get_holders/<country>/<role>')
+def get_holders(country, role):
+    """
+    Gets the users that have a role's access. Only admins of the role's
+    country can list its holders.
+
+    Args:
+        country (str) The country that the role belongs to.
+        role (str) The title of the role.
+        inherited (str) 'false' to only list users holding the role directly,
+            as a GET arg. By default users inheriting the role are included.
+
+    Returns:
+        A json object with a single property 'users', the sorted list of
+        usernames.
+    """
+    if country not in admin_countries():
+        abort(403, "You are not authorised to view this role's users.")
+    inherited = request.args.get('inherited', 'true').lower() != 'false'
+    return jsonify({'users': Role.holders(country, role, inherited)})
+
+
 @roles_blueprint.route('/')
 def index():
     """Renders the page showing the viewer/editor for access roles."""
@@ -4,17 +4,38 @@ users.py
 A Flask Blueprint module for the user manager page.
 """
 from flask import Blueprint, render_template, request, jsonify, g, abort
-from werkzeug.exceptions import HTTPException
+from flask import Response
 
-from meerkat_auth.user import User, InvalidCredentialException
+from meerkat_auth.user import User, UserRecord, InvalidCredentialException
 from meerkat_auth.role import InvalidRoleException
+from meerkat_auth.role_graph import RoleGraph
+from meerkat_auth.revocation import revocations
 from meerkat_auth.authorise import auth
+from meerkat_auth import export, importer
 from meerkat_auth import app
 import datetime
 import logging
 
 users_blueprint = Blueprint('users', __name__, url_prefix="/<language>")
 
+# The attributes the user accounts table can be sorted by.
+USER_SORT_KEYS = ['username', 'email', 'creation']
+
+
+def revoke_inactive(usernames, state):
+    """
+    Revokes every token of the given accounts if they have just been given an
+    inactive state (see User.INACTIVE_STATES), so that the users are logged
+    out at once rather than when their tokens expire.
+
+    Args:
+        usernames ([str]): The accounts that have been updated.
+        state (str): The accounts' new state.
+    """
+    if state in User.INACTIVE_STATES:
+        for username in usernames:
+            revocations.revoke_user(username)
+
 
 @users_blueprint.before_request
 def requires_auth():
@@ -63,27 +84,142 @@ def get_users():
     Get a list of users for the bootstrap table listing users.  We do not allow
     people to see accounts that have access they themselves do not have.
 
+    The table uses bootstrap-table's server side pagination, so accounts are
+    filtered, sorted and paginated here, and the browser only receives one
+    page of accounts at a time. Parameters are passed as GET args in the
+    request. If no limit is given, all of the accounts are returned.
+
+    Args:
+        offset (int): The index of the first account to return.
+        limit (int): The maximum number of accounts to return.
+        sort (str): The attribute to sort by, one of USER_SORT_KEYS.
+        order (str): 'asc' or 'desc'.
+        search (str): Only list accounts whose username or email contain this.
+        country (str): Only list accounts with access to this country.
+        role (str): Only list accounts holding this role.
+
     Returns:
         A json response containing one property "rows" which is a list of
         objects where each object represents a row of the user accounts table.
+        If a limit is given, the property "total" gives the number of
+        accounts over all pages.
     """
     # Set attributes "to get"
     # And restrict accounts shown, to those from the user's countries.
     acc = g.payload['acc']
     countries = list(acc.keys())
-    attributes = [
-        "email", "roles", "username", "countries", "creation", "data"
-    ]
-    rows = User.get_all(countries, attributes)
+    if request.args.get('country'):
+        countries = [c for c in countries if c == request.args['country']]
+        if not countries:
+            return jsonify({'total': 0, 'rows': []})
+    # Only fetch what the table shows, not password hashes or the data blob.
+    attributes = ["email", "roles", "username", "countries", "creation"]
+    rows = User.get_all(
+        countries,
+        attributes,
+        role=request.args.get('role') or None,
+        search=request.args.get('search') or None
+    )
 
     # Remove any data rows (accounts) that are outside the users access.
-    # Step backwards through the list so we can smoothly delete as we go.
-    for j in range(len(rows)-1, -1, -1):
-        access = (rows[j]['roles'], rows[j]['countries'], acc)
-        if not auth.check_access(*access, 'AND'):
-            del rows[j]
+    rows = auth.filter_access(rows, acc, 'AND')
+
+    if 'limit' not in request.args:
+        return jsonify({'rows': rows})
+
+    # Sort and paginate.
+    sort = request.args.get('sort', 'username')
+    if sort not in USER_SORT_KEYS:
+        sort = 'username'
+    rows.sort(
+        key=lambda row: str(row.get(sort, '')).lower(),
+        reverse=request.args.get('order', 'asc') == 'desc'
+    )
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = max(0, request.args.get('limit', 0, type=int))
+    return jsonify({'total': len(rows), 'rows': rows[offset:offset + limit]})
+
+
+@users_blueprint.route('/export')
+def export_users():
+    """
+    Streams every account the current user can see, as newline delimited JSON
+    or CSV. Accounts are read from the database, filtered against the current
+    user's access and written to the response one page at a time, so the
+    download starts immediately and memory use doesn't grow with the table.
+
+    Args:
+        format (str): 'ndjson' (the default) or 'csv', as a GET arg.
+        country (str): Only export accounts with access to this country.
+        role (str): Only export accounts holding this role.
+
+    Returns:
+        A streamed response containing the accounts.
+    """
+    format = request.args.get('format', 'ndjson')
+    if format not in export.FORMATS:
+        abort(400, 'Export format must be one of ' + ', '.join(export.FORMATS))
+
+    acc = g.payload['acc']
+    countries = list(acc.keys())
+    if request.args.get('country'):
+        countries = [c for c in countries if c == request.args['country']]
+    pages = User.get_pages(
+        countries,
+        list(export.EXPORT_ATTRIBUTES),
+        role=request.args.get('role') or None
+    ) if countries else []
+
+    # Remove any accounts that are outside the users access, page by page.
+    filtered = (auth.filter_access(page, acc, 'AND') for page in pages)
+
+    return Response(
+        export.serialise(filtered, format),
+        mimetype=export.FORMATS[format],
+        headers={
+            'Content-Disposition': 'attachment; filename=users.' + format
+        }
+    )
+
+
+@users_blueprint.route('/import_users', methods=['POST'])
+def import_users():
+    """
+    Creates many user accounts at once from the CSV or JSON posted in the
+    request body. Every row is validated first, and only accounts within the
+    current user's access are created. Rows that can't be created are
+    reported individually and don't stop the other rows being created.
 
-    return jsonify({'rows': rows})
+    Args:
+        format (str): 'json' or 'csv', as a GET arg. Defaults to 'csv' if
+            the request's content type is text/csv, otherwise 'json'.
+        dry_run (str): If 'true', validate the rows but don't create them.
+
+    Returns:
+        A json response with the number of rows in "total", the usernames
+        created in "created", and a list of "errors", each giving the "row"
+        index, "username" and "error" message.
+    """
+    default = 'csv' if request.mimetype == 'text/csv' else 'json'
+    format = request.args.get('format', default)
+    try:
+        rows = importer.parse(request.get_data(as_text=True), format)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    if len(rows) > app.config['IMPORT_MAX_ROWS']:
+        return jsonify({'message': 'Imports are limited to {} rows.'.format(
+            app.config['IMPORT_MAX_ROWS']
+        )}), 400
+
+    logging.warning(
+        g.payload['usr'] + ' is importing {} accounts'.format(len(rows))
+    )
+    return jsonify(importer.import_users(
+        rows,
+        acc=g.payload['acc'],
+        dry_run=request.args.get('dry_run', '').lower() == 'true',
+        workers=app.config['IMPORT_HASH_WORKERS']
+    ))
 
 
 @users_blueprint.route('/get_user/')
@@ -135,7 +271,7 @@ def check_username(username):
         and false if not.
     """
 
-    return jsonify({'valid': not User.check_username(username)})
+    return jsonify({'valid': not User.probe_username(username)})
 
 
 @users_blueprint.route('/update_user/<username>', methods=['POST'])
@@ -202,7 +338,7 @@ def update_user(username='new'):
             raise
 
     # Write the user to the database. Includes server-side validation.
-    write(user)
+    error = write(user)
 
     # Reset state once validation and writing complete
     # Changing username shouldn't wipe the state.
@@ -210,12 +346,15 @@ def update_user(username='new'):
         user = User.from_db(user.username)
         logging.warning(repr(user))
         user.state = data["state"]
-        write(user)
+        error = error or write(user)
 
     # When username changes we create a new db record, so delete old one.
     if username != data["username"]:
         User.delete(username)
 
+    if not error:
+        revoke_inactive([user.username], data["state"])
+
     return "Successfully Updated"
 
 
@@ -225,40 +364,161 @@ def delete_users():
     Delete the users specified in the post arguments.
     The post arguments takes a list of usernames to be deleted.
 
+    The accounts are loaded together, the current user's access to each is
+    checked in memory, and the permitted accounts are deleted together, so
+    deleting many accounts only takes a few database requests. To delete an
+    account the current user must be an admin in every one of the account's
+    countries, or an admin of "meerkat".
+
     Returns:
-        A string either stating success or the existance of an error.
+        A json response with a "message" summarising the outcome, an "error"
+        flag set if any account couldn't be deleted, and "results" giving
+        either "deleted" or the error message for each username.
     """
     # Load the list of users to be deleted.
-    users = request.get_json()
-    logging.warning('Users: ' + str(users))
+    usernames = request.get_json()
+    logging.warning('Users: ' + str(usernames))
 
-    # Try to delete users
-    message = ""
-    error = False
-    for username in users:
-        try:
-            # Check current user has access to delete the specified user.
-            user_to_delete = User.from_db(username)
-            try:
-                auth.check_auth(['admin'], ['meerkat'])
-            except HTTPException:
-                countries_list = user_to_delete.countries
-                admin_role_list = ['admin'] * len(countries_list)
-                auth.check_auth(admin_role_list, countries_list, logic='AND')
-            logging.warning(
-                g.payload['usr'] + ' is deleting account ' + str(username)
+    acc = g.payload['acc']
+    superuser = auth.check_access(['admin'], ['meerkat'], acc)
+    records, unread = User.get_records(usernames, ['countries'])
+
+    # Check current user has access to delete each of the specified users.
+    results = {}
+    permitted = []
+    for username in usernames:
+        record = records.get(username)
+        if username in unread:
+            results[username] = unread[username]
+        elif record is None:
+            results[username] = str(
+                InvalidCredentialException('username', username)
+            )
+        elif superuser or auth.check_access(
+                ['admin'] * len(record.countries), record.countries,
+                acc, 'AND'):
+            permitted.append(username)
+        else:
+            results[username] = (
+                "You are not authorised to view or edit this user."
             )
-            # Delete the user
-            User.delete(username)
-            message += 'Succesfully deleted "{}"\n'.format(username)
-        except Exception as e:
-            error = True
-            message += 'Cannot delete "{}": {}\n'.format(username, e)
 
-    if error:
-        return ("ERROR: There was an error deleting some users.\n" + message)
+    # Delete the users
+    if permitted:
+        logging.warning(
+            g.payload['usr'] + ' is deleting accounts ' + str(permitted)
+        )
+        failed = User.batch_delete(permitted)
+        for username in permitted:
+            if username in failed:
+                results[username] = 'The database was too busy, try again.'
+            else:
+                results[username] = 'deleted'
+
+    errors = {u: r for u, r in results.items() if r != 'deleted'}
+    if errors:
+        message = "ERROR: There was an error deleting some users.\n" + ''.join(
+            'Cannot delete "{}": {}\n'.format(u, e) for u, e in errors.items()
+        )
     else:
-        return "Users successfully deleted."
+        message = "Users successfully deleted."
+    return jsonify({
+        'message': message,
+        'error': bool(errors),
+        'results': results
+    })
+
+
+@users_blueprint.route('/bulk_update', methods=['POST'])
+def bulk_update():
+    """
+    Grants or removes a role, and/or changes the state, of many accounts at
+    once. The accounts are selected either by an explicit list of usernames,
+    or by a country and/or role held, in which case only accounts the
+    current user can see are selected. A role to be granted is validated
+    once for the whole selection. Accounts moved into an inactive state have
+    all their tokens revoked.
+
+    Post data is a json object with the following properties:
+        usernames ([str]): The accounts to update.
+        country (str): Or, select accounts with access to this country...
+        role (str): ...and/or select accounts holding this role.
+        add ({"country", "role"}): A role to grant.
+        remove ({"country", "role"}): A role to remove.
+        state (str): The new state for the accounts.
+
+    Returns:
+        A json response with a "results" object giving "updated",
+        "unchanged", or an error message for each selected username.
+    """
+    data = request.get_json()
+    acc = g.payload['acc']
+    add = remove = None
+    if data.get('add'):
+        add = (data['add']['country'], data['add']['role'])
+    if data.get('remove'):
+        remove = (data['remove']['country'], data['remove']['role'])
+    state = data.get('state')
+    if state and state not in ['live'] + User.INACTIVE_STATES:
+        abort(400, 'Invalid state "{}".'.format(state))
+    if not (add or remove or state):
+        abort(400, 'Nothing to update.')
+
+    # The current user must have the access they grant or remove.
+    for pair in [p for p in [add, remove] if p]:
+        if not auth.check_access([pair[1]], [pair[0]], acc):
+            abort(403, "You are not authorised to grant this role.")
+
+    # Check the role to be granted once, rather than once per user.
+    if add:
+        try:
+            RoleGraph.from_db([add[0]]).all_access(*add)
+        except InvalidRoleException as e:
+            abort(400, str(e))
+
+    # Select the accounts.
+    attributes = ['countries', 'roles', 'state']
+    results = {}
+    if 'usernames' in data:
+        loaded, unread = User.get_records(data['usernames'], attributes)
+        records = []
+        for username in data['usernames']:
+            if username in unread:
+                results[username] = unread[username]
+            elif username not in loaded:
+                results[username] = str(
+                    InvalidCredentialException('username', username)
+                )
+            elif not auth.check_access(loaded[username]['roles'],
+                                       loaded[username]['countries'],
+                                       acc, 'AND'):
+                results[username] = (
+                    "You are not authorised to view or edit this user."
+                )
+            else:
+                records.append(loaded[username])
+    else:
+        countries = list(acc.keys())
+        if data.get('country'):
+            countries = [c for c in countries if c == data['country']]
+        records = []
+        if countries:
+            for page in User.get_pages(countries, list(attributes),
+                                       role=data.get('role') or None):
+                records += [UserRecord(item) for item in page]
+        records = auth.filter_access(records, acc, 'AND')
+
+    logging.warning('{} is bulk updating {} accounts: {}'.format(
+        g.payload['usr'], len(records), data
+    ))
+    updated = User.bulk_update(
+        records, add, remove, state, app.config['BULK_UPDATE_WORKERS']
+    )
+    revoke_inactive(
+        [u for u, result in updated.items() if result == 'updated'], state
+    )
+    results.update(updated)
+    return jsonify({'results': results})
 
 
 @users_blueprint.route('/')